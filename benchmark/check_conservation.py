@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Regression test: compare the vectorized conservation scores, both from
+the alignment file and from the A3M matrix scored by the pipeline
+(conservation.score_msa), with the reference pure-Python implementation
+on the blind test set alignments.
+
+Usage: ./check_conservation.py [blind_test_set/blind_test_set.lst]
+"""
+import sys
+import os
+import gzip
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEEPREX_ROOT = os.environ.get('DEEPREX_ROOT', os.path.dirname(BENCHMARK_DIR))
+os.environ['DEEPREX_ROOT'] = DEEPREX_ROOT
+sys.path.append(DEEPREX_ROOT)
+
+from deeprexlib import hhblits
+from deeprexlib import alignment
+from deeprexlib import conservation
+
+def check_protein(pdbid, tmpdir):
+    """Return the names of the implementations whose scores differ from the
+    reference."""
+    a3m_gz = os.path.join(BENCHMARK_DIR, "blind_test_set", "aln", pdbid + ".a3m.gz")
+    a3m_file = os.path.join(tmpdir, pdbid + ".a3m")
+    aln_file = os.path.join(tmpdir, pdbid + ".aln")
+    faln_file = os.path.join(tmpdir, pdbid + ".aln.fa")
+    with gzip.open(a3m_gz, "rt") as iif, open(a3m_file, "w") as of:
+        of.write(iif.read())
+    hhblits.a3m_to_aln(a3m_file, aln_file)
+    msa = alignment.read_a3m(a3m_gz)
+    if hhblits.aln_to_faln(aln_file, faln_file) < 2:
+        # like utils.score_conservation, which scores these as zeros
+        return [] if msa.shape[0] < 2 else ["score_msa"]
+    expected = conservation.score_conservation_reference(faln_file)
+    mismatches = []
+    if conservation.score_conservation(faln_file) != expected:
+        mismatches.append("score_conservation")
+    if conservation.score_msa(msa) != expected:
+        mismatches.append("score_msa")
+    return mismatches
+
+def main():
+    lst = os.path.join(BENCHMARK_DIR, "blind_test_set", "blind_test_set.lst")
+    if len(sys.argv) > 1:
+        lst = sys.argv[1]
+    failed = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pdbids = open(lst).read().split()
+        for pdbid in pdbids:
+            mismatches = check_protein(pdbid, tmpdir)
+            if len(mismatches) > 0:
+                failed.append((pdbid, mismatches))
+    print("Checked %d alignments, %d mismatches" % (len(pdbids), len(failed)))
+    for (pdbid, mismatches) in failed:
+        print("MISMATCH:", pdbid, ", ".join(mismatches), sep="\t")
+    sys.exit(1 if len(failed) > 0 else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Check the HHblits runner scheduling with hhblits_stub.py standing in for
+HHblits, so that no database is needed: outputs, command line settings,
+maximum number of concurrent searches, timeouts, retries and database
+copies.
+
+Usage: ./check_hhblits_runner.py [-n 12] [-j 3]
+"""
+import sys
+import os
+import gzip
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEEPREX_ROOT = os.environ.get('DEEPREX_ROOT', os.path.dirname(BENCHMARK_DIR))
+os.environ['DEEPREX_ROOT'] = DEEPREX_ROOT
+sys.path.append(DEEPREX_ROOT)
+
+import deeprexlib.deeprexconfig as cfg
+from deeprexlib import hhblits
+from deeprexlib import workenv
+
+STUB = os.path.join(BENCHMARK_DIR, "hhblits_stub.py")
+BTS_DIR = os.path.join(BENCHMARK_DIR, "blind_test_set")
+
+failures = []
+
+def check(condition, message):
+    print("%s\t%s" % ("OK" if condition else "FAILED", message))
+    if not condition:
+        failures.append(message)
+
+def read_log(log_file):
+    events = []
+    if os.path.exists(log_file):
+        with open(log_file) as iif:
+            for line in iif:
+                fields = line.split()
+                events.append((float(fields[1]), fields[0], fields[3], fields[4:]))
+    return sorted(events)
+
+def max_concurrency(events):
+    running = 0
+    highest = 0
+    for (t, event, query, args) in events:
+        running += 1 if event == "start" else -1
+        highest = max(highest, running)
+    return highest
+
+def query_file(tmpdir, pdbid):
+    fasta_file = os.path.join(tmpdir, pdbid + ".fasta")
+    with gzip.open(os.path.join(BTS_DIR, "fasta", pdbid + ".fasta.gz"), "rb") as iif, \
+         open(fasta_file, "wb") as of:
+        of.write(iif.read())
+    return fasta_file
+
+def same_content(filename, gz_file):
+    with open(filename, "rb") as a, gzip.open(gz_file, "rb") as b:
+        return a.read() == b.read()
+
+def search_all(runner, we, queries, n_threads):
+    results = {}
+    errors = []
+    def worker(items):
+        for (pdbid, fasta_file) in items:
+            try:
+                results[pdbid] = runner.search(pdbid, fasta_file, we)
+            except Exception as exc:
+                errors.append(exc)
+    threads = [threading.Thread(target=worker, args=(queries[k::n_threads],)) for k in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the HHblits runner with a stub executable")
+    parser.add_argument("-n", dest="n", type=int, default=12, help="number of proteins to search (default: 12)")
+    parser.add_argument("-j", dest="jobs", type=int, default=3, help="concurrent searches (default: 3)")
+    ns = parser.parse_args()
+    with open(os.path.join(BTS_DIR, "blind_test_set.lst")) as iif:
+        pdbids = iif.read().split()[:ns.n]
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tmpdir)
+    try:
+        we = workenv.TemporaryEnv()
+        queries = [(pdbid, query_file(tmpdir, pdbid)) for pdbid in pdbids]
+        log_file = os.path.join(tmpdir, "stub.log")
+        os.environ["STUB_LOG"] = log_file
+
+        # outputs, settings and concurrency
+        os.environ["STUB_SLEEP"] = "0.3"
+        runner = hhblits.HHblitsRunner("db", jobs=ns.jobs, executable=STUB)
+        (results, errors) = search_all(runner, we, queries, 2 * ns.jobs)
+        check(len(errors) == 0 and len(results) == len(queries), "%d searches completed" % len(queries))
+        check(all([same_content(results[p][0], os.path.join(BTS_DIR, "aln", p + ".a3m.gz")) and
+                   same_content(results[p][1], os.path.join(BTS_DIR, "aln", p + ".hhm.gz"))
+                   for p in results]), "outputs match the precomputed alignments")
+        events = read_log(log_file)
+        args = events[0][3]
+        check(args[args.index("-n") + 1] == str(cfg.HHBLITS_ITERATIONS) and
+              args[args.index("-e") + 1] == str(cfg.HHBLITS_EVALUE) and
+              args[args.index("-maxfilt") + 1] == str(cfg.HHBLITS_MAXFILT),
+              "command line uses HHBLITS_ITERATIONS, HHBLITS_EVALUE and HHBLITS_MAXFILT")
+        check(max_concurrency(events) == ns.jobs,
+              "at most %d concurrent searches from %d threads (observed %d)" %
+              (ns.jobs, 2 * ns.jobs, max_concurrency(events)))
+        os.unlink(log_file)
+
+        # timeouts: each attempt is killed, the error is raised after the retries
+        os.environ["STUB_SLEEP"] = "5"
+        runner = hhblits.HHblitsRunner("db", timeout=0.5, retries=1, executable=STUB)
+        try:
+            runner.search(*queries[0], we)
+            check(False, "timed out search raises TimeoutExpired")
+        except subprocess.TimeoutExpired:
+            check(len([e for e in read_log(log_file) if e[1] == "start"]) == 2,
+                  "timed out search is retried once, then raises TimeoutExpired")
+        os.unlink(log_file)
+
+        # retries: the first run of each query fails
+        os.environ["STUB_SLEEP"] = "0"
+        os.environ["STUB_FAILURES"] = "1"
+        os.environ["STUB_STATE"] = tempfile.mkdtemp(dir=tmpdir)
+        runner = hhblits.HHblitsRunner("db", retries=1, executable=STUB)
+        check(runner.search(*queries[1], we) is not None, "failed search succeeds when retried")
+        os.environ["STUB_STATE"] = tempfile.mkdtemp(dir=tmpdir)
+        runner = hhblits.HHblitsRunner("db", retries=0, executable=STUB)
+        try:
+            runner.search(*queries[1], we)
+            check(False, "failed search without retries raises CalledProcessError")
+        except subprocess.CalledProcessError:
+            check(True, "failed search without retries raises CalledProcessError")
+        del os.environ["STUB_FAILURES"]
+
+        # database copies are made once and then reused
+        db_dir = os.path.join(tmpdir, "db")
+        os.makedirs(db_dir)
+        for name in ("cs219", "a3m", "hhm"):
+            for ext in ("ffdata", "ffindex"):
+                with open(os.path.join(db_dir, "testdb_%s.%s" % (name, ext)), "wb") as of:
+                    of.write(os.urandom(4096))
+        runner = hhblits.HHblitsRunner(os.path.join(db_dir, "testdb"), executable=STUB)
+        copy_dir = os.path.join(tmpdir, "shm")
+        copied = runner.copy_database(copy_dir)
+        check(copied == 6 * 4096 and runner.db_prefix == os.path.join(copy_dir, "testdb"),
+              "database copied and searched from the copy")
+        runner = hhblits.HHblitsRunner(os.path.join(db_dir, "testdb"), executable=STUB)
+        check(runner.copy_database(copy_dir) == 0, "existing database copy reused")
+        check(runner.preload() == 6 * 4096, "database files preloaded")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+    sys.exit(1 if len(failures) > 0 else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Check the peak RSS of the bounded-memory mode on a synthetic protein of
+L residues with an N-sequence alignment (by default a 20,000 residue
+protein and 20,000 sequences, a 400 MB A3M file).
+
+Usage: ./check_memory.py [-L 20000] [-N 20000] [-r 10000] [-W 4096]
+
+The alignment is encoded and the protein predicted in a child process,
+once reading the whole alignment and once in bounded-memory mode (at most
+-r sequences, selected by Henikoff weight, and windows of -W residues).
+For each run the script reports the RSS after loading the model and the
+peak RSS, and it fails if the bounded run exceeds the bound documented in
+README.md: RSS after loading the model + 3 x r x L bytes + 512 MB.
+"""
+import sys
+import os
+import json
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEEPREX_ROOT = os.environ.get('DEEPREX_ROOT', os.path.dirname(BENCHMARK_DIR))
+os.environ['DEEPREX_ROOT'] = DEEPREX_ROOT
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+sys.path.append(DEEPREX_ROOT)
+
+import numpy
+
+AMINO_ACIDS = numpy.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=numpy.uint8)
+MB = 1024 * 1024
+OVERHEAD = 512 * MB
+
+def make_alignment(a3m_file, length, n_seqs, seed=0):
+    """Write a random query and n_seqs - 1 homologs with 30% substitutions,
+    10% gaps and a few insertions; return the query."""
+    rng = numpy.random.default_rng(seed)
+    query = AMINO_ACIDS[rng.integers(0, 20, length)]
+    with open(a3m_file, "wb") as of:
+        of.write(b">query\n" + query.tobytes() + b"\n")
+        for k in range(1, n_seqs):
+            row = query.copy()
+            changed = rng.random(length) < 0.3
+            row[changed] = AMINO_ACIDS[rng.integers(0, 20, changed.sum())]
+            row[rng.random(length) < 0.1] = ord('-')
+            of.write(b">seq%d\n" % k + row.tobytes() + b"ac\n")
+    return query.tobytes().decode()
+
+def rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 / MB
+
+def child(a3m_file, max_rows, window_length):
+    """Encode and predict the protein, print RSS figures as JSON."""
+    import deeprexlib.deeprexconfig as cfg
+    from deeprexlib import alignment
+    from deeprexlib import hhm
+    from deeprexlib import utils
+    from deeprexlib import predictor as dpred
+    from deeprexlib import workenv
+    model = dpred.Predictor(cfg.DEEPREX_MODEL_FILE)
+    model.load()
+    base = rss_mb()
+    msa = alignment.read_a3m(a3m_file, max_rows=max_rows, selection="henikoff")
+    sequence = msa[0].tobytes().decode()
+    length = len(sequence)
+    conservation = utils.score_conservation(msa)
+    profile = utils.build_sequence_profile("query", msa, workenv.TemporaryEnv(), debug=False)
+    rows = msa.shape[0]
+    del msa
+    rng = numpy.random.default_rng(0)
+    hhm_profile = hhm.HHMProfile(rng.random((length, 20)), rng.random((length, 7)),
+                                 rng.random((length, 3)), sequence)
+    protein = utils.encode_protein(sequence, profile, hhm_profile)
+    predictions = model.predict_batch([protein], window_length=window_length)
+    assert len(predictions[0]) == length and len(conservation) == length
+    print(json.dumps({'base_mb': base, 'peak_mb': rss_mb(), 'rows': rows}))
+
+def run(script_args):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__)] + script_args,
+                         check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the peak RSS of the bounded-memory mode")
+    parser.add_argument("-L", dest="length", type=int, default=20000, help="protein length (default: 20000)")
+    parser.add_argument("-N", dest="n_seqs", type=int, default=20000,
+                        help="sequences in the alignment (default: 20000)")
+    parser.add_argument("-r", dest="max_rows", type=int, default=None,
+                        help="bounded mode: sequences kept (default: BOUNDED_MSA_ROWS)")
+    parser.add_argument("-W", dest="window_length", type=int, default=None,
+                        help="bounded mode: prediction window (default: BOUNDED_WINDOW_LENGTH)")
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    ns = parser.parse_args()
+    if ns.child is not None:
+        (a3m_file, max_rows, window_length) = ns.child
+        child(a3m_file, int(max_rows) if max_rows != "all" else None,
+              int(window_length) if window_length != "none" else None)
+        return
+    import deeprexlib.deeprexconfig as cfg
+    max_rows = ns.max_rows if ns.max_rows is not None else cfg.BOUNDED_MSA_ROWS
+    window_length = ns.window_length if ns.window_length is not None else cfg.BOUNDED_WINDOW_LENGTH
+    tmpdir = tempfile.mkdtemp()
+    try:
+        a3m_file = os.path.join(tmpdir, "synthetic.a3m")
+        make_alignment(a3m_file, ns.length, ns.n_seqs)
+        print("Protein of %d residues, %d sequences (%.0f MB A3M)" %
+              (ns.length, ns.n_seqs, os.path.getsize(a3m_file) / MB))
+        full = run(["--child", a3m_file, "all", "none"])
+        bounded = run(["--child", a3m_file, str(max_rows), str(window_length)])
+    finally:
+        shutil.rmtree(tmpdir)
+    bound = bounded['base_mb'] + (3 * min(max_rows, ns.n_seqs) * ns.length + OVERHEAD) / MB
+    print("%-8s %8s %12s %12s" % ("mode", "rows", "model MB", "peak MB"))
+    for (mode, result) in (("full", full), ("bounded", bounded)):
+        print("%-8s %8d %12.0f %12.0f" % (mode, result['rows'], result['base_mb'], result['peak_mb']))
+    print("bound for the bounded mode: %.0f MB" % bound)
+    if bounded['peak_mb'] > bound:
+        print("FAILED\tpeak RSS %.0f MB exceeds the bound" % bounded['peak_mb'])
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
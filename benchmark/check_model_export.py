@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Check the SavedModel export of the DeepREx model (deeprex.py
+export-model) against the HDF5 model on the blind test set.
+
+Usage: ./check_model_export.py [-n 200] [-b 32] [-l 1024]
+
+The proteins are encoded from their precomputed alignments and predicted
+with both models in the same process. The script reports load, warm-up and
+inference times of each, the largest difference between predicted
+probabilities and the residues whose label or TSV output line differ. It
+fails if the largest difference exceeds MODEL_EXPORT_TOLERANCE, if a
+label differs or if, on the whole set, the scores of the export differ
+from the published ones.
+"""
+import sys
+import os
+import argparse
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEEPREX_ROOT = os.environ.get('DEEPREX_ROOT', os.path.dirname(BENCHMARK_DIR))
+os.environ['DEEPREX_ROOT'] = DEEPREX_ROOT
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+sys.path.append(DEEPREX_ROOT)
+
+import numpy
+
+import deeprexlib.deeprexconfig as cfg
+from deeprexlib import utils
+from deeprexlib import alignment
+from deeprexlib import hhm
+from deeprexlib import output
+from deeprexlib import predictor as dpred
+import perf_benchmark
+
+BTS_DIR = os.path.join(BENCHMARK_DIR, "blind_test_set")
+
+def encode(pdbids):
+    records = []
+    proteins = []
+    hydrophobicities = []
+    conservations = []
+    for pdbid in pdbids:
+        record = perf_benchmark.read_fasta(pdbid)
+        sequence = str(record.seq)
+        msa = alignment.read_a3m(os.path.join(BTS_DIR, "aln", pdbid + ".a3m.gz"))
+        conservations.append(utils.score_conservation(msa, 0.7))
+        profile = utils.build_sequence_profile(pdbid, msa, None, debug=False)
+        hydrophobicities.append(utils.score_hp(sequence, 5))
+        hhm_profile = hhm.parse_hhm(os.path.join(BTS_DIR, "aln", pdbid + ".hhm.gz"))
+        proteins.append(utils.encode_protein(sequence, profile, hhm_profile))
+        records.append(record)
+    return records, proteins, hydrophobicities, conservations
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the SavedModel export against the HDF5 model")
+    parser.add_argument("-n", dest="n", type=int, default=None,
+                        help="check only the first n proteins of the blind test set (default: all)")
+    parser.add_argument("-b", dest="batch_size", type=int, default=cfg.PREDICT_BATCH_SIZE,
+                        help="maximum number of proteins per prediction batch (default: %d)" % cfg.PREDICT_BATCH_SIZE)
+    parser.add_argument("-l", dest="max_padded_length", type=int, default=cfg.PREDICT_MAX_PADDED_LENGTH,
+                        help="maximum padded length of a prediction batch (default: %d)" % cfg.PREDICT_MAX_PADDED_LENGTH)
+    ns = parser.parse_args()
+    if dpred.usable_export(cfg.DEEPREX_MODEL_FILE) is None:
+        print("No export of %s: run deeprex.py export-model first" % cfg.DEEPREX_MODEL_FILE)
+        sys.exit(1)
+    with open(os.path.join(BTS_DIR, "blind_test_set.lst")) as iif:
+        pdbids = iif.read().split()
+    whole_set = ns.n is None or ns.n >= len(pdbids)
+    pdbids = pdbids[:ns.n]
+    (records, proteins, hydrophobicities, conservations) = encode(pdbids)
+
+    # import TensorFlow and Keras beforehand, so that load times compare the
+    # model formats only
+    import tensorflow
+    import keras.models
+    predictions = {}
+    print("%-11s %9s %9s %11s" % ("model", "load s", "warm-up s", "inference s"))
+    for (name, use_export) in (("HDF5", False), ("SavedModel", True)):
+        model = dpred.Predictor(cfg.DEEPREX_MODEL_FILE, use_export=use_export)
+        predictions[name] = model.predict_batch(proteins, ns.batch_size, ns.max_padded_length)
+        print("%-11s %9.3f %9.3f %11.3f" % (model.model_format, model.load_time, model.warmup_time,
+                                          model.inference_time))
+
+    failures = []
+    difference = 0.0
+    n_labels = 0
+    n_lines = 0
+    n_residues = 0
+    tsv = []
+    for (k, record) in enumerate(records):
+        original = numpy.array(predictions["HDF5"][k])[:, 0]
+        exported = numpy.array(predictions["SavedModel"][k])[:, 0]
+        difference = max(difference, numpy.abs(original - exported).max())
+        n_labels += numpy.count_nonzero((original > 0.5) != (exported > 0.5))
+        n_residues += len(original)
+        args = (record.id, str(record.seq))
+        lines = (output.format_tsv(*args, predictions["HDF5"][k], hydrophobicities[k], conservations[k]),
+                 output.format_tsv(*args, predictions["SavedModel"][k], hydrophobicities[k], conservations[k]))
+        n_lines += sum([a != b for (a, b) in zip(*[l.splitlines() for l in lines])])
+        tsv.append(lines[1])
+    print("%d proteins, %d residues" % (len(records), n_residues))
+    print("largest probability difference: %g" % difference)
+    print("residues with a different label: %d, with a different TSV line: %d" % (n_labels, n_lines))
+    if difference > cfg.MODEL_EXPORT_TOLERANCE:
+        failures.append("probabilities differ by %g, more than %g" % (difference, cfg.MODEL_EXPORT_TOLERANCE))
+    if n_labels > 0:
+        failures.append("%d labels differ" % n_labels)
+    scores = perf_benchmark.score(pdbids, "".join(tsv))
+    for (name, value) in scores.items():
+        print("%s:" % name, value, sep="\t")
+    if whole_set:
+        for (name, value) in perf_benchmark.PUBLISHED.items():
+            if scores[name] != value:
+                failures.append("%s %r differs from the published %r" % (name, scores[name], value))
+    for failure in failures:
+        print("FAILED", failure, sep="\t")
+    sys.exit(1 if len(failures) > 0 else 0)
+
+if __name__ == "__main__":
+    main()
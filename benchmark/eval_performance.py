@@ -49,10 +49,14 @@ def f1(cm):
     else:
         return 0.0
 
-ytrue, ypred = read_data(sys.argv[1])
-cm = confusion_matrix(ytrue, ypred)
-print("SENSITIVITY:", sens(cm), sep="\t")
-print("PRECISION:", prec(cm), sep="\t")
-print("F1:", f1(cm), sep="\t")
-print("Q2:", q2(cm), sep="\t")
-print("MCC:", mcc(cm), sep="\t")
+def main():
+    ytrue, ypred = read_data(sys.argv[1])
+    cm = confusion_matrix(ytrue, ypred)
+    print("SENSITIVITY:", sens(cm), sep="\t")
+    print("PRECISION:", prec(cm), sep="\t")
+    print("F1:", f1(cm), sep="\t")
+    print("Q2:", q2(cm), sep="\t")
+    print("MCC:", mcc(cm), sep="\t")
+
+if __name__ == "__main__":
+    main()
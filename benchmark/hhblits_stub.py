@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Stand-in for the hhblits executable, serving the precomputed blind test
+set alignments: the query sequence (-i) is looked up among the blind test
+set proteins and their A3M and HHM files are written to -oa3m and -ohhm.
+Unknown sequences fail with exit status 2.
+
+Use it by setting DEEPREX_HHBLITS to the path of this script. The
+following environment variables change its behaviour:
+
+STUB_SLEEP     seconds to sleep before writing the outputs
+STUB_FAILURES  fail (exit status 1) the first n runs for each query
+STUB_STATE     directory keeping run counts per query (for STUB_FAILURES)
+STUB_LOG       append "start/end <time> <pid> <query> <args>" lines here
+"""
+import sys
+import os
+import gzip
+import time
+import hashlib
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BTS_DIR = os.path.join(BENCHMARK_DIR, "blind_test_set")
+
+def log(event, query, args):
+    if "STUB_LOG" in os.environ:
+        with open(os.environ["STUB_LOG"], "a") as of:
+            of.write("%s %.6f %d %s %s\n" % (event, time.time(), os.getpid(), query, " ".join(args)))
+
+def read_sequence(handle):
+    return "".join([line.strip() for line in handle if not line.startswith(">")])
+
+def find_protein(sequence):
+    with open(os.path.join(BTS_DIR, "blind_test_set.lst")) as iif:
+        pdbids = iif.read().split()
+    for pdbid in pdbids:
+        with gzip.open(os.path.join(BTS_DIR, "fasta", pdbid + ".fasta.gz"), "rt") as iif:
+            if read_sequence(iif) == sequence:
+                return pdbid
+    return None
+
+def copy_gz(source, target):
+    with gzip.open(source, "rb") as iif, open(target, "wb") as of:
+        of.write(iif.read())
+
+def main():
+    args = sys.argv[1:]
+    opts = dict(zip(args[::2], args[1::2]))
+    with open(opts['-i']) as iif:
+        sequence = read_sequence(iif)
+    query = hashlib.sha1(sequence.encode()).hexdigest()[:12]
+    log("start", query, args)
+    if "STUB_FAILURES" in os.environ:
+        state = os.path.join(os.environ["STUB_STATE"], query)
+        runs = int(open(state).read()) if os.path.exists(state) else 0
+        with open(state, "w") as of:
+            of.write(str(runs + 1))
+        if runs < int(os.environ["STUB_FAILURES"]):
+            log("end", query, args)
+            sys.exit(1)
+    time.sleep(float(os.environ.get("STUB_SLEEP", "0")))
+    pdbid = find_protein(sequence)
+    if pdbid is None:
+        log("end", query, args)
+        sys.exit(2)
+    copy_gz(os.path.join(BTS_DIR, "aln", pdbid + ".a3m.gz"), opts['-oa3m'])
+    copy_gz(os.path.join(BTS_DIR, "aln", pdbid + ".hhm.gz"), opts['-ohhm'])
+    with open(opts['-o'], 'w') as of:
+        of.write("")
+    log("end", query, args)
+
+if __name__ == "__main__":
+    main()
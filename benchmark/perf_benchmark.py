@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""End-to-end performance benchmark on the blind test set: time each stage
+of an aln prediction of the 200 bundled proteins separately and check
+that the predictions still score as published.
+
+Usage: ./perf_benchmark.py [-n 200] [-b 32] [-l 1024] [--save perf.json]
+                           [--baseline perf.json] [--tolerance 1.5]
+
+Stages are run one after the other on all proteins, in process: reading
+the FASTA files, A3M parsing, conservation, sequence profile,
+hydrophobicity, HHM parsing and encoding, model load, inference and TSV
+output. For each stage the script reports the time spent and the
+throughput in proteins/s and residues/s, then the peak RSS of the process.
+The predictions are joined with the true exposure labels as
+run_benchmark.sh does and scored with eval_performance.py.
+
+The script fails if, on the whole set, Q2 or MCC differ from the published
+values, or, with --baseline, if the scores differ from the baseline file
+written by --save, a stage is more than tolerance times (plus 50ms) slower
+or the peak RSS more than tolerance times larger.
+"""
+import sys
+import os
+import io
+import gzip
+import json
+import time
+import resource
+import argparse
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEEPREX_ROOT = os.environ.get('DEEPREX_ROOT', os.path.dirname(BENCHMARK_DIR))
+os.environ['DEEPREX_ROOT'] = DEEPREX_ROOT
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+sys.path.append(DEEPREX_ROOT)
+
+import deeprexlib.deeprexconfig as cfg
+from deeprexlib import utils
+from deeprexlib import alignment
+from deeprexlib import hhm
+from deeprexlib import output
+from deeprexlib import predictor as dpred
+import eval_performance
+
+BTS_DIR = os.path.join(BENCHMARK_DIR, "blind_test_set")
+
+# blind test set scores reported in README.md
+PUBLISHED = {'Q2': 0.8181155036828809, 'MCC': 0.6365228220061144}
+
+STAGES = ["fasta", "a3m", "conservation", "profile", "hydrophobicity", "hhm",
+          "model_load", "inference", "output"]
+
+class StageTimer():
+    def __init__(self):
+        self.seconds = dict([(stage, 0.0) for stage in STAGES])
+
+    def run(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        ret = func(*args, **kwargs)
+        self.seconds[stage] += time.perf_counter() - start
+        return ret
+
+def read_fasta(pdbid):
+    from Bio import SeqIO
+    with gzip.open(os.path.join(BTS_DIR, "fasta", pdbid + ".fasta.gz"), "rt") as iif:
+        return SeqIO.read(iif, "fasta")
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def run(pdbids, batch_size, max_padded_length):
+    timer = StageTimer()
+    records = [timer.run("fasta", read_fasta, pdbid) for pdbid in pdbids]
+    sequences = [str(record.seq) for record in records]
+    proteins = []
+    hydrophobicities = []
+    conservations = []
+    for (pdbid, sequence) in zip(pdbids, sequences):
+        msa = timer.run("a3m", alignment.read_a3m, os.path.join(BTS_DIR, "aln", pdbid + ".a3m.gz"))
+        conservations.append(timer.run("conservation", utils.score_conservation, msa, 0.7))
+        profile = timer.run("profile", utils.build_sequence_profile, pdbid, msa, None, debug=False)
+        hydrophobicities.append(timer.run("hydrophobicity", utils.score_hp, sequence, 5))
+        hhm_profile = timer.run("hhm", hhm.parse_hhm, os.path.join(BTS_DIR, "aln", pdbid + ".hhm.gz"))
+        proteins.append(timer.run("hhm", utils.encode_protein, sequence, profile, hhm_profile))
+    model = dpred.Predictor(cfg.DEEPREX_MODEL_FILE)
+    timer.run("model_load", model.load)
+    predictions = timer.run("inference", model.predict_batch, proteins, batch_size, max_padded_length)
+    out = io.StringIO()
+    def write_output():
+        for (record, prediction, hydrophobicity, conservation) in zip(records, predictions,
+                                                                      hydrophobicities, conservations):
+            out.write(output.format_tsv(record.id, str(record.seq), prediction,
+                                        hydrophobicity, conservation))
+    timer.run("output", write_output)
+    return timer, sequences, out.getvalue()
+
+def score(pdbids, tsv):
+    """Join predictions and true labels as run_benchmark.sh does and score
+    them with eval_performance.py."""
+    rsa = []
+    for pdbid in pdbids:
+        with gzip.open(os.path.join(BTS_DIR, "rsa", pdbid + ".rsa.gz"), "rt") as iif:
+            rsa += iif.read().splitlines()
+    predicted = tsv.splitlines()
+    if len(predicted) != len(rsa):
+        raise ValueError("%d predicted residues, %d in the RSA files" % (len(predicted), len(rsa)))
+    with tempfile.NamedTemporaryFile("w", suffix=".tsv") as of:
+        print("PROTEIN\tPOSITION\tRES\tPRED_EXP\tRI\tHYDRO\tCONS\tTRUE_EXP\tRSA", file=of)
+        for (p, r) in zip(predicted, rsa):
+            print(p, "\t".join(r.split("\t")[4:6]), sep="\t", file=of)
+        of.flush()
+        (ytrue, ypred) = eval_performance.read_data(of.name)
+    cm = eval_performance.confusion_matrix(ytrue, ypred)
+    return {'SENSITIVITY': eval_performance.sens(cm), 'PRECISION': eval_performance.prec(cm),
+            'F1': eval_performance.f1(cm), 'Q2': eval_performance.q2(cm),
+            'MCC': eval_performance.mcc(cm)}
+
+def main():
+    parser = argparse.ArgumentParser(description="DeepREx end-to-end performance benchmark")
+    parser.add_argument("-n", dest="n", type=int, default=None,
+                        help="benchmark only the first n proteins of the blind test set (default: all)")
+    parser.add_argument("-b", dest="batch_size", type=int, default=cfg.PREDICT_BATCH_SIZE,
+                        help="maximum number of proteins per prediction batch (default: %d)" % cfg.PREDICT_BATCH_SIZE)
+    parser.add_argument("-l", dest="max_padded_length", type=int, default=cfg.PREDICT_MAX_PADDED_LENGTH,
+                        help="maximum padded length of a prediction batch (default: %d)" % cfg.PREDICT_MAX_PADDED_LENGTH)
+    parser.add_argument("--save", help="write timings, peak RSS and scores to this JSON file")
+    parser.add_argument("--baseline", help="compare with a JSON file written by --save")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="allowed slowdown factor with respect to the baseline (default: 1.5)")
+    ns = parser.parse_args()
+    with open(os.path.join(BTS_DIR, "blind_test_set.lst")) as iif:
+        pdbids = iif.read().split()
+    whole_set = ns.n is None or ns.n >= len(pdbids)
+    pdbids = pdbids[:ns.n]
+    baseline = json.load(open(ns.baseline)) if ns.baseline is not None else None
+
+    (timer, sequences, tsv) = run(pdbids, ns.batch_size, ns.max_padded_length)
+    n_residues = sum([len(sequence) for sequence in sequences])
+    results = {'proteins': len(pdbids), 'residues': n_residues,
+               'seconds': timer.seconds, 'peak_rss_mb': peak_rss_mb(),
+               'scores': score(pdbids, tsv)}
+
+    failures = []
+    if baseline is not None and baseline['proteins'] != results['proteins']:
+        failures.append("baseline has %d proteins, this run %d" % (baseline['proteins'], results['proteins']))
+        baseline = None
+    print("%-15s %9s %9s %12s %12s" % ("stage", "seconds", "baseline", "proteins/s", "residues/s"))
+    for stage in STAGES + ["total"]:
+        if stage == "total":
+            seconds = sum(timer.seconds.values())
+            base = sum(baseline['seconds'].values()) if baseline is not None else None
+        else:
+            seconds = timer.seconds[stage]
+            base = baseline['seconds'].get(stage) if baseline is not None else None
+        print("%-15s %9.3f %9s %12.1f %12.0f" % (stage, seconds, "%.3f" % base if base is not None else "-",
+                                                 len(pdbids) / seconds if seconds > 0 else 0.0,
+                                                 n_residues / seconds if seconds > 0 else 0.0))
+        if base is not None and seconds > base * ns.tolerance + 0.05:
+            failures.append("%s: %.3fs, baseline %.3fs" % (stage, seconds, base))
+    print("peak RSS %.1f MB%s" % (results['peak_rss_mb'],
+                                  ", baseline %.1f MB" % baseline['peak_rss_mb'] if baseline is not None else ""))
+    if baseline is not None and results['peak_rss_mb'] > baseline['peak_rss_mb'] * ns.tolerance:
+        failures.append("peak RSS: %.1f MB, baseline %.1f MB" % (results['peak_rss_mb'], baseline['peak_rss_mb']))
+    for (name, value) in results['scores'].items():
+        print("%s:" % name, value, sep="\t")
+    if whole_set:
+        for (name, value) in PUBLISHED.items():
+            if results['scores'][name] != value:
+                failures.append("%s %r differs from the published %r" % (name, results['scores'][name], value))
+    if baseline is not None:
+        for (name, value) in baseline['scores'].items():
+            if results['scores'].get(name) != value:
+                failures.append("%s %r differs from the baseline %r" % (name, results['scores'].get(name), value))
+    if ns.save is not None:
+        with open(ns.save, "w") as of:
+            json.dump(results, of, indent=2, sort_keys=True)
+    for failure in failures:
+        print("REGRESSION:", failure, sep="\t")
+    sys.exit(1 if len(failures) > 0 else 0)
+
+if __name__ == "__main__":
+    main()
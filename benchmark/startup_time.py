@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Startup-time benchmark: time deeprex.py invocations that should not pay
+for heavy imports (--help, argument errors) and report the import cost of
+each subcommand.
+
+Usage: ./startup_time.py [-n 5] [--inference] [--save startup.json]
+                         [--baseline startup.json] [--tolerance 1.5]
+
+Each case is run n times; the median wall time is reported together with
+the slowest top-level imports (python -X importtime). The script fails if
+a help or argument-error case imports TensorFlow/Keras, or, with
+--baseline, if a median is more than tolerance times (plus 50ms) slower
+than in the baseline file written by --save.
+"""
+import sys
+import os
+import json
+import time
+import argparse
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEEPREX_ROOT = os.environ.get('DEEPREX_ROOT', os.path.dirname(BENCHMARK_DIR))
+DEEPREX = os.path.join(DEEPREX_ROOT, "deeprex.py")
+EXAMPLE = os.path.join(DEEPREX_ROOT, "example")
+
+# (name, arguments, whether TensorFlow/Keras may be imported)
+CASES = [("help", ["-h"], False),
+         ("fasta-help", ["fasta", "-h"], False),
+         ("aln-help", ["aln", "-h"], False),
+         ("singleseq-help", ["singleseq", "-h"], False),
+         ("cache-help", ["cache", "-h"], False),
+         ("export-model-help", ["export-model", "-h"], False),
+         ("serve-help", ["serve", "-h"], False),
+         ("argument-error", ["singleseq"], False)]
+
+INFERENCE_CASES = [("singleseq-run", ["singleseq", "-f", os.path.join(EXAMPLE, "Q46GQ4.fasta"),
+                                      "-o", os.devnull], True)]
+
+HEAVY_MODULES = ("tensorflow", "keras")
+
+def environment():
+    env = dict(os.environ)
+    env['DEEPREX_ROOT'] = DEEPREX_ROOT
+    return env
+
+def time_case(args, n):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, DEEPREX] + args, env=environment(),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+def import_profile(args):
+    """Return ({top-level package: cumulative import seconds}, heavy modules
+    imported) for one run."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", DEEPREX] + args,
+                          env=environment(), stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    packages = {}
+    heavy = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1]) / 1e6
+        except ValueError:
+            continue
+        module = fields[2].strip()
+        package = module.split(".")[0]
+        if package in HEAVY_MODULES:
+            heavy.add(package)
+        # top-level imports are not indented
+        if not fields[2].startswith("  "):
+            packages[package] = packages.get(package, 0.0) + cumulative
+    return packages, sorted(heavy)
+
+def main():
+    parser = argparse.ArgumentParser(description="DeepREx startup-time benchmark")
+    parser.add_argument("-n", dest="n", type=int, default=5, help="runs per case (default: 5)")
+    parser.add_argument("--inference", action="store_true",
+                        help="also time a singleseq prediction (loads TensorFlow)")
+    parser.add_argument("--save", help="write the median times to this JSON file")
+    parser.add_argument("--baseline", help="compare with a JSON file written by --save")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="allowed slowdown factor with respect to the baseline (default: 1.5)")
+    ns = parser.parse_args()
+    cases = CASES + (INFERENCE_CASES if ns.inference else [])
+    baseline = json.load(open(ns.baseline)) if ns.baseline is not None else {}
+    results = {}
+    failures = []
+    print("%-16s %9s %9s  %s" % ("case", "median s", "baseline", "slowest imports"))
+    for (name, args, heavy_allowed) in cases:
+        results[name] = time_case(args, ns.n)
+        packages, heavy = import_profile(args)
+        slowest = sorted(packages.items(), key=lambda p: -p[1])[:3]
+        print("%-16s %9.3f %9s  %s" % (name, results[name],
+                                       "%.3f" % baseline[name] if name in baseline else "-",
+                                       ", ".join(["%s %.3fs" % p for p in slowest])))
+        if len(heavy) > 0 and not heavy_allowed:
+            failures.append("%s imports %s" % (name, ", ".join(heavy)))
+        if name in baseline and results[name] > baseline[name] * ns.tolerance + 0.05:
+            failures.append("%s: %.3fs, baseline %.3fs" % (name, results[name], baseline[name]))
+    if ns.save is not None:
+        with open(ns.save, "w") as of:
+            json.dump(results, of, indent=2, sort_keys=True)
+    for failure in failures:
+        print("REGRESSION:", failure, sep="\t")
+    sys.exit(1 if len(failures) > 0 else 0)
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,10 @@ import sys
 import os
 import argparse
 import logging
+import functools
+import shutil
+import threading
+from time import localtime, strftime
 if 'DEEPREX_ROOT' in os.environ:
     sys.path.append(os.environ['DEEPREX_ROOT'])
 else:
@@ -13,99 +17,434 @@ else:
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
-from Bio import SeqIO
+# Biopython and TensorFlow/Keras are imported only where they are used, so
+# that --help, argument errors and cache maintenance start quickly
 
 from deeprexlib import workenv
 import deeprexlib.deeprexconfig as cfg
 from deeprexlib import hhblits
 from deeprexlib import utils
-from deeprexlib import conservation
+from deeprexlib import alignment
+from deeprexlib import hhm
+from deeprexlib import pipeline
+from deeprexlib import features
+from deeprexlib import output
+from deeprexlib import instrument
+
+_query_files = threading.local()
+
+def query_file(we):
+    """Query FASTA file of the calling search thread, rewritten for each
+    record instead of creating one file per record."""
+    if getattr(_query_files, 'name', None) is None:
+        _query_files.name = we.createFile("query.", ".fasta")
+    return _query_files.name
+
+def fasta_search(ns, we, data_cache, record):
+    from Bio import SeqIO
+    prefix = record.id.replace("|","_")
+    sequence = str(record.seq)
+    cache_entry = data_cache.entry(sequence) if data_cache is not None else None
+    if ns.prediction_ext is not None:
+        cached = utils.load_cached_predictions(cache_entry, ns.prediction_ext)
+        if cached is not None:
+            utils.print_date("Using cached predictions [protein=%s]" % record.id)
+            predictions, hydrophobicity, msa_conservation = cached
+            return pipeline.Completed((None, hydrophobicity, msa_conservation), predictions)
+    if cache_entry is not None:
+        cached_features = utils.load_cached_features(cache_entry, ns.feature_ext)
+        if cached_features is not None:
+            utils.print_date("Using cached features [protein=%s]" % record.id)
+            return None, cached_features, cache_entry
+    fasta_seq = query_file(we)
+    SeqIO.write([record], fasta_seq, 'fasta')
+    utils.print_date("Running HHBlits and building sequence profile [protein=%s]" % record.id)
+    hhblits_out = ns.hhblits.run(prefix, fasta_seq, we, cache_entry=cache_entry)
+    return hhblits_out, None, cache_entry
+
+def fasta_extract(ns, we, pool, record, search_result):
+    hhblits_out, cached_features, cache_entry = search_result
+    if cached_features is not None:
+        return cached_features
+    prefix = record.id.replace("|","_")
+    hhblits_a3m_out, hhblits_hhm_out = hhblits_out
+    sequence = str(record.seq)
+    utils.print_date("Encode protein sequence [protein=%s]" % record.id)
+    if cache_entry is not None:
+        hhm_profile = hhm.load_cached_hhm(cache_entry)
+        if hhm_profile is not None:
+            hhblits_hhm_out = hhm_profile
+    profile_file = None
+    if ns.profile_protein is not None and record.id == ns.profile_protein:
+        profile_file = instrument.profile_file(ns.outf, record.id)
+    protein, hydrophobicity, msa_conservation, hhm_npz_file = pool.apply(
+        features.msa_features, sequence, prefix, hhblits_a3m_out, hhblits_hhm_out, we,
+        ns.gapth, ns.hpwin, ns.max_msa_rows, cache_entry is not None, profile_file=profile_file,
+        msa_selection=ns.msa_selection)
+    if cache_entry is not None:
+        if hhm_npz_file is not None:
+            cache_entry.store(hhm_npz_file, hhm.HHM_CACHE_EXT)
+        utils.store_cached_features(cache_entry, ns.feature_ext, we,
+                                    protein, hydrophobicity, msa_conservation)
+    return protein, hydrophobicity, msa_conservation
+
+def fasta_predict(ns, batch):
+    utils.print_date("Predict residue solvent exposure [proteins=%d]" % len(batch))
+    return utils.predict_batch([protein for (protein, hydrophobicity, msa_conservation) in batch],
+                               cfg.DEEPREX_MODEL_FILE, batch_size=ns.batch_size,
+                               max_padded_length=ns.max_padded_length,
+                               window_length=ns.window_length, window_overlap=ns.window_overlap)
+
+def write_report(ns, data_cache, **info):
+    if ns.report is not None:
+        instrument.write_report(ns.report, instrument.recorder.report(data_cache, **info))
+        utils.print_date("Run report written to %s" % ns.report)
+
+def setup_prediction_cache(ns, data_cache, features_tag):
+    ns.prediction_ext = None
+    if ns.cache_predictions:
+        if data_cache is None:
+            logging.warning("Prediction cache requested but DEEPREX_DATA_CACHE_DIR is not set")
+        else:
+            ns.prediction_ext = utils.prediction_cache_ext(cfg.DEEPREX_MODEL_FILE, features_tag)
+
+def fasta_records(ns, done):
+    """Input records of this shard not yet completed, with their index in
+    the input file in annotations['index']."""
+    from Bio import SeqIO
+    for (index, record) in utils.shard_records(SeqIO.parse(ns.fasta, 'fasta'), ns.shard):
+        if index in done:
+            if done[index] != record.id:
+                raise ValueError("Checkpoint %s does not match the input: record %d is %s, not %s" %
+                                 (ns.outf + ".done", index + 1, record.id, done[index]))
+            continue
+        record.annotations['index'] = index
+        yield record
 
 def run_fasta(ns):
+    ofs = checkpoint = pool = None
     try:
         we = workenv.TemporaryEnv()
         data_cache = utils.get_data_cache()
-        ofs = open(ns.outf, 'w')
-        for record in SeqIO.parse(ns.fasta, 'fasta'):
-            prefix = record.id.replace("|","_")
-            fasta_seq  = we.createFile(prefix+".", ".fasta")
-            SeqIO.write([record], fasta_seq, 'fasta')
-            utils.print_date("Running HHBlits and building sequence profile [protein=%s]" % record.id)
-            hhblits_aln_out, hhblits_hhm_out, msa_conservation = hhblits.run_hhblits(prefix, ns.hhblits_db, fasta_seq, we, gap_cutoff=ns.gapth, cpus=ns.cpus, data_cache=data_cache)
-            sequence_profile_file = utils.build_sequence_profile(prefix, hhblits_aln_out, we)
-            sequence = str(record.seq)
-            hydrophobicity = utils.score_hp(sequence, ns.hpwin)
-            utils.print_date("Encode protein sequence [protein=%s]" % record.id)
-            protein = utils.encode_protein(sequence, sequence_profile_file, hhblits_hhm_out)
-            utils.print_date("Predict residue solvent exposure [protein=%s]" % record.id)
-            predictions = utils.predict(protein, cfg.DEEPREX_MODEL_FILE)
-            utils.print_date("Writing predictions to TSV file [protein=%s]" % record.id)
-            utils.write_tsv_output(record.id, sequence, predictions,
-                                   hydrophobicity, msa_conservation, ofs)
+        ns.feature_ext = utils.feature_cache_ext(ns.gapth, ns.hpwin, ns.max_msa_rows, ns.msa_selection)
+        setup_prediction_cache(ns, data_cache, ns.feature_ext[:-len(".npz")] +
+                               utils.window_tag(ns.window_length, ns.window_overlap))
+        ns.hhblits = hhblits.HHblitsRunner(ns.hhblits_db, cpus=ns.cpus, jobs=ns.hhblits_jobs,
+                                           timeout=ns.hhblits_timeout, retries=ns.hhblits_retries)
+        if ns.hhblits_db_copy is not None:
+            utils.print_date("Copying HHblits database to %s" % ns.hhblits_db_copy)
+            copied = ns.hhblits.copy_database(ns.hhblits_db_copy)
+            utils.print_date("HHblits database in %s, %s copied" % (ns.hhblits_db_copy, utils.format_size(copied)))
+        if ns.hhblits_db_preload:
+            size = ns.hhblits.preload()
+            utils.print_date("Preloaded HHblits database files (%s)" % utils.format_size(size))
+        # TSV output is checkpointed after each protein, so that the run
+        # can be resumed; NPZ archives are only valid once closed
+        checkpoint = output.Checkpoint(ns.outf) if ns.output_format == "tsv" else None
+        (done, offset) = checkpoint.read() if ns.resume else ({}, None)
+        if len(done) > 0:
+            utils.print_date("Resuming: %d proteins already predicted" % len(done))
+        ofs = output.open_writer(ns.outf, ns.output_format, offset)
+        if checkpoint is not None:
+            checkpoint.open(ns.resume)
+        dedup = utils.SequenceDeduplicator(fasta_records(ns, done))
+        if dedup.n_duplicates() > 0:
+            utils.print_date("%d duplicate sequences will be predicted once" % dedup.n_duplicates())
+        pool = features.WorkerPool(ns.cpus)
+        fasta_pipeline = pipeline.StreamingPipeline(functools.partial(fasta_search, ns, we, data_cache),
+                                                    functools.partial(fasta_extract, ns, we, pool),
+                                                    functools.partial(fasta_predict, ns),
+                                                    n_search=ns.hhblits_jobs,
+                                                    batch_size=ns.batch_size,
+                                                    n_extract=ns.cpus,
+                                                    skip_errors=True)
+        results = fasta_pipeline.run(dedup.unique(fasta_records(ns, done)))
+        failed = []
+        for (record, result, first) in dedup.fan_out(fasta_records(ns, done), results):
+            (unique_record, protein_features, predictions) = result
+            if isinstance(protein_features, pipeline.Failed):
+                logging.error("Prediction failed, skipping protein %s: %s" % (record.id, protein_features.error))
+                failed.append(record.id)
+                continue
+            protein, hydrophobicity, msa_conservation = protein_features
+            if ns.prediction_ext is not None and protein is not None and first:
+                utils.store_cached_predictions(data_cache.entry(str(record.seq)), ns.prediction_ext, we,
+                                               predictions, hydrophobicity, msa_conservation)
+            utils.print_date("Writing predictions [protein=%s]" % record.id)
+            ofs.write(record.id, str(record.seq), predictions,
+                      hydrophobicity, msa_conservation)
+            if checkpoint is not None:
+                checkpoint.add(record.annotations['index'], record.id, ofs.flush())
     except:
-        ofs.close()
+        if ofs is not None:
+            ofs.close()
+        if checkpoint is not None:
+            checkpoint.close()
         logging.exception("Errors occurred:")
         sys.exit(1)
     else:
+        utils.print_model_summary(cfg.DEEPREX_MODEL_FILE)
+        utils.print_cache_summary(data_cache)
+        write_report(ns, data_cache, command="fasta", failed=failed)
+        utils.close_data_cache(data_cache)
+        if len(failed) > 0:
+            utils.print_date("%d protein(s) failed and were skipped: %s" % (len(failed), ", ".join(failed)))
         utils.print_date("Cleaning temporary environment end exit")
         ofs.close()
-        we.destroy()
-        sys.exit(0)
+        if checkpoint is not None:
+            checkpoint.close()
+        if cfg.DEBUG:
+            utils.print_date("Debug mode: temporary files kept in %s" % we.tempdir)
+        else:
+            we.destroy()
+        sys.exit(2 if len(failed) > 0 else 0)
+    finally:
+        if pool is not None:
+            pool.close()
+
+def set_memory_options(ns):
+    """Resolve the MSA row selection and the defaults of --bounded-memory."""
+    if ns.bounded_memory and ns.window_length is None:
+        ns.window_length = cfg.BOUNDED_WINDOW_LENGTH
+    if hasattr(ns, "max_msa_rows"):
+        if ns.bounded_memory and ns.max_msa_rows is None:
+            ns.max_msa_rows = cfg.BOUNDED_MSA_ROWS
+        if ns.msa_selection is None:
+            ns.msa_selection = "henikoff" if ns.bounded_memory else "first"
+
+def aln_inputs(ns):
+    if ns.manifest is not None:
+        return features.read_manifest(ns.manifest)
+    if ns.input_dir is not None:
+        return features.find_triples(ns.input_dir)
+    return [(ns.fasta, ns.a3m, ns.hhm)]
 
 def run_aln(ns):
+    pool = None
     try:
         we = workenv.TemporaryEnv()
-        record = SeqIO.read(ns.fasta, 'fasta')
-        prefix = record.id.replace("|","_")
-        fasta_seq  = we.createFile(prefix+".", ".fasta")
-        SeqIO.write([record], fasta_seq, 'fasta')
-        aln_file = we.createFile(prefix+".", ".aln")
-        faln_file = we.createFile(prefix+".", ".aln.fa")
-        hhblits.a3m_to_aln(ns.a3m, aln_file)
-        hhblits.aln_to_faln(aln_file, faln_file)
-        msa_conservation = conservation.score_conservation(faln_file, gap_cutoff=ns.gapth)
-        sequence_profile_file = utils.build_sequence_profile(prefix, aln_file, we)
-        sequence = str(record.seq)
-        hydrophobicity = utils.score_hp(sequence, ns.hpwin)
-        utils.print_date("Encode protein sequence [protein=%s]" % record.id)
-        protein = utils.encode_protein(sequence, sequence_profile_file, ns.hhm)
-        utils.print_date("Predict residue solvent exposure [protein=%s]" % record.id)
-        predictions = utils.predict(protein, cfg.DEEPREX_MODEL_FILE)
-        utils.print_date("Writing predictions to TSV file [protein=%s]" % record.id)
-        ofs = open(ns.outf, 'w')
-        utils.write_tsv_output(record.id, sequence, predictions,
-                               hydrophobicity, msa_conservation, ofs)
+        triples = aln_inputs(ns)
+        utils.print_date("Encode %d protein(s) using %d process(es)" % (len(triples), max(1, ns.cpus)))
+        extract = functools.partial(features.aln_features, we=we, gap_cutoff=ns.gapth,
+                                    hp_window=ns.hpwin, max_msa_rows=ns.max_msa_rows,
+                                    msa_selection=ns.msa_selection,
+                                    profile_id=ns.profile_protein, profile_prefix=ns.outf)
+        pool = features.WorkerPool(ns.cpus)
+        results = pool.imap(extract, triples)
+        ofs = output.open_writer(ns.outf, ns.output_format)
+        for chunk in utils.chunks(results, cfg.PREDICT_BUCKET_POOL):
+            utils.print_date("Predict residue solvent exposure [proteins=%d]" % len(chunk))
+            predictions = utils.predict_batch([protein for (record, protein, hydrophobicity, msa_conservation) in chunk],
+                                              cfg.DEEPREX_MODEL_FILE, batch_size=ns.batch_size,
+                                              max_padded_length=ns.max_padded_length,
+                                              window_length=ns.window_length,
+                                              window_overlap=ns.window_overlap)
+            utils.print_date("Writing predictions [proteins=%d]" % len(chunk))
+            for ((record, protein, hydrophobicity, msa_conservation), prediction) in zip(chunk, predictions):
+                ofs.write(record.id, str(record.seq), prediction,
+                          hydrophobicity, msa_conservation)
     except:
         logging.exception("Errors occurred:")
         sys.exit(1)
     else:
+        utils.print_model_summary(cfg.DEEPREX_MODEL_FILE)
+        write_report(ns, None, command="aln")
         utils.print_date("Cleaning temporary environment end exit")
         ofs.close()
-        we.destroy()
+        if cfg.DEBUG:
+            utils.print_date("Debug mode: temporary files kept in %s" % we.tempdir)
+        else:
+            we.destroy()
         sys.exit(0)
+    finally:
+        if pool is not None:
+            pool.close()
+
+def ss_predict(ns, data_cache, we, pool, records):
+    """Yield (predictions, hydrophobicity) for each record, in order."""
+    for chunk in utils.chunks(records, cfg.PREDICT_BUCKET_POOL):
+        sequences = [str(record.seq) for record in chunk]
+        results = [None] * len(chunk)
+        entries = [None] * len(chunk)
+        if ns.prediction_ext is not None:
+            for (i, sequence) in enumerate(sequences):
+                entries[i] = data_cache.entry(sequence)
+                cached = utils.load_cached_predictions(entries[i], ns.prediction_ext)
+                if cached is not None:
+                    results[i] = cached[:2]
+        todo = [i for i in range(len(chunk)) if results[i] is None]
+        if len(todo) > 0:
+            utils.print_date("Encode %d protein sequences" % len(todo))
+            # one batch per worker process
+            batches = list(utils.chunks([sequences[i] for i in todo],
+                                        -(-len(todo) // max(1, pool.processes))))
+            proteins = []
+            hydrophobicities = []
+            for (batch, (batch_features, batch_hydrophobicity)) in zip(
+                    batches, pool.imap(functools.partial(features.singleseq_features, hp_window=ns.hpwin),
+                                       batches)):
+                proteins += features.split_proteins(batch_features, batch)
+                hydrophobicities += batch_hydrophobicity
+            utils.print_date("Predict residue solvent exposure [proteins=%d]" % len(todo))
+            predictions = utils.predict_batch(proteins, cfg.DEEPREX_MODEL_FILE,
+                                              batch_size=ns.batch_size,
+                                              max_padded_length=ns.max_padded_length,
+                                              window_length=ns.window_length,
+                                              window_overlap=ns.window_overlap)
+            for (i, hydrophobicity, prediction) in zip(todo, hydrophobicities, predictions):
+                results[i] = (prediction, hydrophobicity)
+                if ns.prediction_ext is not None:
+                    utils.store_cached_predictions(entries[i], ns.prediction_ext, we,
+                                                   prediction, hydrophobicity, [0.0]*len(sequences[i]))
+        utils.print_date("Writing predictions [proteins=%d]" % len(chunk))
+        for result in results:
+            yield result
 
 def run_ss(ns):
+    from Bio import SeqIO
+    pool = None
     try:
         we = workenv.TemporaryEnv()
-        ofs = open(ns.outf, 'w')
-        for record in SeqIO.parse(ns.fasta, 'fasta'):
+        data_cache = utils.get_data_cache() if ns.cache_predictions else None
+        setup_prediction_cache(ns, data_cache, "singleseq.w%d" % ns.hpwin +
+                               utils.window_tag(ns.window_length, ns.window_overlap))
+        ofs = output.open_writer(ns.outf, ns.output_format)
+        dedup = utils.SequenceDeduplicator(SeqIO.parse(ns.fasta, 'fasta'))
+        if dedup.n_duplicates() > 0:
+            utils.print_date("%d duplicate sequences will be predicted once" % dedup.n_duplicates())
+        pool = features.WorkerPool(ns.cpus)
+        results = ss_predict(ns, data_cache, we, pool, dedup.unique(SeqIO.parse(ns.fasta, 'fasta')))
+        for (record, (prediction, hydrophobicity), first) in dedup.fan_out(SeqIO.parse(ns.fasta, 'fasta'), results):
             sequence = str(record.seq)
-            hydrophobicity = utils.score_hp(sequence, ns.hpwin)
-            utils.print_date("Encode protein sequence [protein=%s]" % record.id)
-            protein = utils.encode_protein_single_seq(sequence)
-            utils.print_date("Predict residue solvent exposure [protein=%s]" % record.id)
-            predictions = utils.predict(protein, cfg.DEEPREX_MODEL_FILE)
-            utils.print_date("Writing predictions to TSV file [protein=%s]" % record.id)
-            
-            utils.write_tsv_output(record.id, sequence, predictions,
-                                   hydrophobicity, [0.0]*len(sequence), ofs)
+            ofs.write(record.id, sequence, prediction,
+                      hydrophobicity, [0.0]*len(sequence))
     except:
         logging.exception("Errors occurred:")
         sys.exit(1)
     else:
+        utils.print_model_summary(cfg.DEEPREX_MODEL_FILE)
+        utils.print_cache_summary(data_cache)
+        write_report(ns, data_cache, command="singleseq")
+        utils.close_data_cache(data_cache)
         utils.print_date("Cleaning temporary environment end exit")
         ofs.close()
-        we.destroy()
+        if cfg.DEBUG:
+            utils.print_date("Debug mode: temporary files kept in %s" % we.tempdir)
+        else:
+            we.destroy()
+        sys.exit(0)
+    finally:
+        if pool is not None:
+            pool.close()
+
+def run_serve(ns):
+    import signal
+    from deeprexlib import server
+    try:
+        we = workenv.TemporaryEnv()
+        service = server.DeepRExService(cfg.DEEPREX_MODEL_FILE, we, batch_size=ns.batch_size,
+                                        max_padded_length=ns.max_padded_length,
+                                        max_delay=ns.batch_delay / 1000.0)
+        utils.print_date("Loading model")
+        service.start()
+        httpd = server.make_server(service, host=ns.host, port=ns.port,
+                                   unix_socket=ns.socket, quiet=ns.quiet)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        utils.print_date("Serving on %s" % (ns.socket if ns.socket is not None else "http://%s:%d" % (ns.host, ns.port)))
+        try:
+            httpd.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            httpd.server_close()
+            if ns.socket is not None and os.path.exists(ns.socket):
+                os.unlink(ns.socket)
+    except:
+        logging.exception("Errors occurred:")
+        sys.exit(1)
+    else:
+        utils.print_model_summary(cfg.DEEPREX_MODEL_FILE)
+        utils.print_date("Cleaning temporary environment end exit")
+        if cfg.DEBUG:
+            utils.print_date("Debug mode: temporary files kept in %s" % we.tempdir)
+        else:
+            we.destroy()
+        sys.exit(0)
+
+def run_cache(ns):
+    try:
+        data_cache = utils.get_data_cache()
+        if data_cache is None:
+            logging.error("DEEPREX_DATA_CACHE_DIR is not set")
+            sys.exit(1)
+        if ns.action == "stats":
+            usage = {}
+            for (digest, ext, size, last_use) in data_cache.entries():
+                (n, total, oldest, newest) = usage.get(ext, (0, 0, last_use, last_use))
+                usage[ext] = (n + 1, total + size, min(oldest, last_use), max(newest, last_use))
+            print("%-40s %10s %10s  %-10s  %-10s" % ("entry type", "entries", "size", "oldest use", "newest use"))
+            for ext in sorted(usage):
+                (n, total, oldest, newest) = usage[ext]
+                print("%-40s %10d %10s  %-10s  %-10s" % (ext, n, utils.format_size(total),
+                                                         strftime("%Y-%m-%d", localtime(oldest)),
+                                                         strftime("%Y-%m-%d", localtime(newest))))
+            print("%-40s %10d %10s" % ("total", sum([u[0] for u in usage.values()]),
+                                       utils.format_size(sum([u[1] for u in usage.values()]))))
+            if hasattr(data_cache, "pack_usage"):
+                (packs, live) = data_cache.pack_usage()
+                print("pack files: %s, %s of evicted entries" % (utils.format_size(packs),
+                                                                    utils.format_size(packs - live)))
+        elif ns.action == "prune":
+            max_size = utils.parse_size(ns.max_size) if ns.max_size is not None else data_cache.max_size
+            max_age = ns.max_age * 86400 if ns.max_age is not None else data_cache.max_age
+            if max_size is None and max_age is None:
+                logging.error("No limit given: use --max-size/--max-age or set "
+                              "DEEPREX_DATA_CACHE_MAX_SIZE/DEEPREX_DATA_CACHE_MAX_AGE")
+                sys.exit(1)
+            (n_removed, removed_size) = data_cache.prune(max_size, max_age)
+            utils.print_date("Removed %d entries (%s)" % (n_removed, utils.format_size(removed_size)))
+        elif ns.action == "verify":
+            n_invalid = 0
+            for (digest, ext, problem) in data_cache.verify(delete=ns.delete):
+                n_invalid += 1
+                print("%s.%s: %s" % (digest, ext, problem))
+            utils.print_date("%d invalid entries%s" % (n_invalid, " removed" if ns.delete and n_invalid > 0 else ""))
+            if n_invalid > 0 and not ns.delete:
+                sys.exit(2)
+    except SystemExit:
+        raise
+    except:
+        logging.exception("Errors occurred:")
+        sys.exit(1)
+    else:
+        sys.exit(0)
+
+def run_export(ns):
+    import numpy
+    from deeprexlib import predictor as dpred
+    try:
+        utils.print_date("Exporting %s" % ns.model)
+        export_dir = dpred.export_model(ns.model)
+        utils.print_date("SavedModel written to %s" % export_dir)
+        # quick check on random proteins: benchmark/check_model_export.py
+        # compares the predictions on the blind test set
+        n_features = dpred.read_export_info(export_dir)['n_features']
+        rng = numpy.random.default_rng(0)
+        proteins = [rng.random((1, length, n_features)).astype(numpy.float32) for length in (8, 50, 300, 1000)]
+        exported = dpred.Predictor(ns.model, use_export=True).predict_batch(proteins)
+        original = dpred.Predictor(ns.model, use_export=False).predict_batch(proteins)
+        difference = max([numpy.abs(numpy.array(a) - numpy.array(b)).max() for (a, b) in zip(exported, original)])
+        utils.print_date("Largest difference from the HDF5 model: %g" % difference)
+        if difference > cfg.MODEL_EXPORT_TOLERANCE:
+            shutil.rmtree(export_dir)
+            logging.error("The export differs from the HDF5 model by more than %g, removed" % cfg.MODEL_EXPORT_TOLERANCE)
+            sys.exit(1)
+    except SystemExit:
+        raise
+    except:
+        logging.exception("Errors occurred:")
+        sys.exit(1)
+    else:
         sys.exit(0)
 
 def main():
@@ -127,15 +466,42 @@ def main():
                         dest = "fasta", required = True)
 
     singless.add_argument("-o", "--outf",
-                        help = "The output TSV file",
+                        help = "The output file",
                         dest = "outf", required = True)
+    singless.add_argument("--report",
+                        help = "Write a run report with per-stage wall and CPU time, residues processed, "
+                               "data cache hits and misses and peak memory: JSON, or Prometheus text format "
+                               "if the file name ends in .prom",
+                        dest = "report", default = None)
+    singless.add_argument("-F", "--output-format",
+                        help = "Output format: per-residue TSV, or compressed NPZ with one record per protein (default: tsv)",
+                        dest = "output_format", choices = output.OUTPUT_FORMATS, default = "tsv")
 
     singless.add_argument("-w", "--hp-window",
                         help = "Window size for hydrophobicity computation (default: 5)",
                         dest = "hpwin", required = False, type = int, default= 5)
     singless.add_argument("-t", "--cpus",
-                        help = "Number of CPUs to use",
+                        help = "Number of processes encoding proteins in parallel (default: 1)",
                         dest = "cpus", type = int, default = 1)
+    singless.add_argument("-b", "--batch-size",
+                        help = "Maximum number of proteins per prediction batch (default: %d)" % cfg.PREDICT_BATCH_SIZE,
+                        dest = "batch_size", type = int, default = cfg.PREDICT_BATCH_SIZE)
+    singless.add_argument("-l", "--max-padded-length",
+                        help = "Maximum padded length of a prediction batch; longer proteins are predicted alone (default: %d)" % cfg.PREDICT_MAX_PADDED_LENGTH,
+                        dest = "max_padded_length", type = int, default = cfg.PREDICT_MAX_PADDED_LENGTH)
+    singless.add_argument("-W", "--window-length",
+                        help = "Predict proteins longer than this in overlapping windows of this length (default: whole proteins)",
+                        dest = "window_length", type = int, default = None)
+    singless.add_argument("--window-overlap",
+                        help = "Residues shared by consecutive prediction windows (default: %d)" % cfg.PREDICT_WINDOW_OVERLAP,
+                        dest = "window_overlap", type = int, default = cfg.PREDICT_WINDOW_OVERLAP)
+    singless.add_argument("-M", "--bounded-memory",
+                        help = "Bounded-memory mode: predict proteins longer than %d residues in overlapping windows "
+                               "(default of -W)" % cfg.BOUNDED_WINDOW_LENGTH,
+                        dest = "bounded_memory", action = "store_true")
+    singless.add_argument("-p", "--cache-predictions",
+                        help = "Cache final predictions in DEEPREX_DATA_CACHE_DIR and reuse them for sequences already predicted with the same model",
+                        dest = "cache_predictions", action = "store_true")
     singless.set_defaults(func=run_ss)
     multifasta.add_argument("-f", "--fasta",
                         help = "The input multi-FASTA file name",
@@ -144,44 +510,214 @@ def main():
                         help = "The HHBlits database file",
                         dest = "hhblits_db", required = True)
     multifasta.add_argument("-o", "--outf",
-                        help = "The output TSV file",
+                        help = "The output file",
                         dest = "outf", required = True)
+    multifasta.add_argument("--report",
+                        help = "Write a run report with per-stage wall and CPU time, residues processed, "
+                               "data cache hits and misses and peak memory: JSON, or Prometheus text format "
+                               "if the file name ends in .prom",
+                        dest = "report", default = None)
+    multifasta.add_argument("--profile-protein",
+                        help = "Profile the feature extraction of the protein with this id with cProfile; "
+                               "stats are written to <output file>.<id>.prof",
+                        dest = "profile_protein", default = None)
+    multifasta.add_argument("-F", "--output-format",
+                        help = "Output format: per-residue TSV, or compressed NPZ with one record per protein (default: tsv)",
+                        dest = "output_format", choices = output.OUTPUT_FORMATS, default = "tsv")
     multifasta.add_argument("-g", "--gap-th",
                         help = "Score conservation of MSA columns with less than this gap threshold (default: 0.7)",
                         dest = "gapth", required = False, type = float, default= 0.7)
+    multifasta.add_argument("-r", "--max-msa-rows",
+                        help = "Read at most this number of sequences from each alignment (default: all)",
+                        dest = "max_msa_rows", required = False, type = int, default = None)
+    multifasta.add_argument("--msa-selection",
+                        help = "Sequences kept when an alignment has more than --max-msa-rows: the first ones, "
+                               "a random sample or those with the largest Henikoff weights (default: first, "
+                               "henikoff with --bounded-memory)",
+                        dest = "msa_selection", choices = alignment.MSA_SELECTIONS, default = None)
     multifasta.add_argument("-w", "--hp-window",
                         help = "Window size for hydrophobicity computation (default: 5)",
                         dest = "hpwin", required = False, type = int, default= 5)
     multifasta.add_argument("-t", "--cpus",
-                        help = "Number of CPUs to use",
+                        help = "Number of CPUs to use for each HHblits search and number of processes "
+                               "encoding proteins in parallel (default: 1)",
                         dest = "cpus", type = int, default = 1)
+    multifasta.add_argument("-j", "--hhblits-jobs",
+                        help = "Number of concurrent HHblits searches (default: 1)",
+                        dest = "hhblits_jobs", type = int, default = 1)
+    multifasta.add_argument("--hhblits-timeout",
+                        help = "Kill HHblits searches running longer than this number of seconds (default: no limit)",
+                        dest = "hhblits_timeout", type = float, default = cfg.HHBLITS_TIMEOUT)
+    multifasta.add_argument("--hhblits-retries",
+                        help = "Retry failed or killed HHblits searches this number of times (default: %d)" % cfg.HHBLITS_RETRIES,
+                        dest = "hhblits_retries", type = int, default = cfg.HHBLITS_RETRIES)
+    multifasta.add_argument("--hhblits-db-preload",
+                        help = "Read the HHblits database files into the page cache before searching",
+                        dest = "hhblits_db_preload", action = "store_true")
+    multifasta.add_argument("--hhblits-db-copy",
+                        help = "Copy the HHblits database files to this directory, e.g. on a tmpfs such as /dev/shm, "
+                               "and search the copy; copies made by earlier runs are reused",
+                        dest = "hhblits_db_copy", default = None)
+    multifasta.add_argument("-b", "--batch-size",
+                        help = "Maximum number of proteins per prediction batch (default: %d)" % cfg.PREDICT_BATCH_SIZE,
+                        dest = "batch_size", type = int, default = cfg.PREDICT_BATCH_SIZE)
+    multifasta.add_argument("-l", "--max-padded-length",
+                        help = "Maximum padded length of a prediction batch; longer proteins are predicted alone (default: %d)" % cfg.PREDICT_MAX_PADDED_LENGTH,
+                        dest = "max_padded_length", type = int, default = cfg.PREDICT_MAX_PADDED_LENGTH)
+    multifasta.add_argument("-W", "--window-length",
+                        help = "Predict proteins longer than this in overlapping windows of this length (default: whole proteins)",
+                        dest = "window_length", type = int, default = None)
+    multifasta.add_argument("--window-overlap",
+                        help = "Residues shared by consecutive prediction windows (default: %d)" % cfg.PREDICT_WINDOW_OVERLAP,
+                        dest = "window_overlap", type = int, default = cfg.PREDICT_WINDOW_OVERLAP)
+    multifasta.add_argument("-M", "--bounded-memory",
+                        help = "Bounded-memory mode: keep at most %d sequences of each alignment, those with the largest "
+                               "Henikoff weights, and predict proteins longer than %d residues in overlapping windows "
+                               "(defaults of -r, --msa-selection and -W)" % (cfg.BOUNDED_MSA_ROWS, cfg.BOUNDED_WINDOW_LENGTH),
+                        dest = "bounded_memory", action = "store_true")
+    multifasta.add_argument("-s", "--shard",
+                        help = "Predict only shard i of N, e.g. 2/4: records 2, 6, 10, ... of the input (default: all records)",
+                        dest = "shard", type = utils.parse_shard, default = None)
+    multifasta.add_argument("-R", "--resume",
+                        help = "Resume an interrupted run: keep the proteins already written to the output file "
+                               "(as recorded in <output file>.done) and predict the others",
+                        dest = "resume", action = "store_true")
+    multifasta.add_argument("-p", "--cache-predictions",
+                        help = "Cache final predictions in DEEPREX_DATA_CACHE_DIR and reuse them for sequences already predicted with the same model",
+                        dest = "cache_predictions", action = "store_true")
     multifasta.set_defaults(func=run_fasta)
     aln.add_argument("-f", "--fasta",
                         help = "The input FASTA file name (single sequence)",
-                        dest = "fasta", required = True)
+                        dest = "fasta")
     aln.add_argument("-a", "--a3m",
                         help = "The input multiple sequence alignment in A3M format",
-                        dest = "a3m", required = True)
+                        dest = "a3m")
     aln.add_argument("-m", "--hhm",
                         help = "The input HHM file from HHblits",
-                        dest = "hhm", required = True)
+                        dest = "hhm")
+    aln.add_argument("-i", "--manifest",
+                        help = "Predict many proteins: a file listing one FASTA, A3M and HHM file triple per line "
+                               "(instead of -f, -a and -m)",
+                        dest = "manifest", default = None)
+    aln.add_argument("-D", "--input-dir",
+                        help = "Predict many proteins: a directory tree with <id>.fasta, <id>.a3m and <id>.hhm files "
+                               "(instead of -f, -a and -m)",
+                        dest = "input_dir", default = None)
     aln.add_argument("-o", "--outf",
-                        help = "The output TSV file",
+                        help = "The output file",
                         dest = "outf", required = True)
+    aln.add_argument("--report",
+                        help = "Write a run report with per-stage wall and CPU time, residues processed, "
+                               "data cache hits and misses and peak memory: JSON, or Prometheus text format "
+                               "if the file name ends in .prom",
+                        dest = "report", default = None)
+    aln.add_argument("--profile-protein",
+                        help = "Profile the feature extraction of the protein with this id with cProfile; "
+                               "stats are written to <output file>.<id>.prof",
+                        dest = "profile_protein", default = None)
+    aln.add_argument("-F", "--output-format",
+                        help = "Output format: per-residue TSV, or compressed NPZ with one record per protein (default: tsv)",
+                        dest = "output_format", choices = output.OUTPUT_FORMATS, default = "tsv")
     aln.add_argument("-g", "--gap-th",
                         help = "Score conservation of MSA columns with less than this gap threshold (default: 0.7)",
                         dest = "gapth", required = False, type = float, default= 0.7)
+    aln.add_argument("-r", "--max-msa-rows",
+                        help = "Read at most this number of sequences from each alignment (default: all)",
+                        dest = "max_msa_rows", required = False, type = int, default = None)
+    aln.add_argument("--msa-selection",
+                        help = "Sequences kept when an alignment has more than --max-msa-rows: the first ones, "
+                               "a random sample or those with the largest Henikoff weights (default: first, "
+                               "henikoff with --bounded-memory)",
+                        dest = "msa_selection", choices = alignment.MSA_SELECTIONS, default = None)
     aln.add_argument("-w", "--hp-window",
                         help = "Window size for hydrophobicity computation (default: 5)",
                         dest = "hpwin", required = False, type = int, default= 5)
     aln.add_argument("-t", "--cpus",
-                        help = "Number of CPUs to use",
+                        help = "Number of processes encoding proteins in parallel (default: 1)",
                         dest = "cpus", type = int, default = 1)
+    aln.add_argument("-b", "--batch-size",
+                        help = "Maximum number of proteins per prediction batch (default: %d)" % cfg.PREDICT_BATCH_SIZE,
+                        dest = "batch_size", type = int, default = cfg.PREDICT_BATCH_SIZE)
+    aln.add_argument("-l", "--max-padded-length",
+                        help = "Maximum padded length of a prediction batch; longer proteins are predicted alone (default: %d)" % cfg.PREDICT_MAX_PADDED_LENGTH,
+                        dest = "max_padded_length", type = int, default = cfg.PREDICT_MAX_PADDED_LENGTH)
+    aln.add_argument("-W", "--window-length",
+                        help = "Predict proteins longer than this in overlapping windows of this length (default: whole proteins)",
+                        dest = "window_length", type = int, default = None)
+    aln.add_argument("--window-overlap",
+                        help = "Residues shared by consecutive prediction windows (default: %d)" % cfg.PREDICT_WINDOW_OVERLAP,
+                        dest = "window_overlap", type = int, default = cfg.PREDICT_WINDOW_OVERLAP)
+    aln.add_argument("-M", "--bounded-memory",
+                        help = "Bounded-memory mode: keep at most %d sequences of each alignment, those with the largest "
+                               "Henikoff weights, and predict proteins longer than %d residues in overlapping windows "
+                               "(defaults of -r, --msa-selection and -W)" % (cfg.BOUNDED_MSA_ROWS, cfg.BOUNDED_WINDOW_LENGTH),
+                        dest = "bounded_memory", action = "store_true")
     aln.set_defaults(func=run_aln)
+    cache = subparsers.add_parser("cache", help = "Data cache maintenance",
+                                  description = "DeepREx: maintenance of the data cache in DEEPREX_DATA_CACHE_DIR.")
+    cache.add_argument("action", choices = ["stats", "prune", "verify"],
+                        help = "stats: report entries and sizes; prune: evict least recently used entries; "
+                               "verify: check the integrity of every entry")
+    cache.add_argument("-s", "--max-size",
+                        help = "prune: evict least recently used entries beyond this size, e.g. 20G "
+                               "(default: DEEPREX_DATA_CACHE_MAX_SIZE)",
+                        dest = "max_size", default = None)
+    cache.add_argument("-a", "--max-age",
+                        help = "prune: evict entries unused for more than this number of days "
+                               "(default: DEEPREX_DATA_CACHE_MAX_AGE)",
+                        dest = "max_age", type = float, default = None)
+    cache.add_argument("--delete",
+                        help = "verify: remove invalid entries",
+                        dest = "delete", action = "store_true")
+    cache.set_defaults(func=run_cache)
+    export = subparsers.add_parser("export-model", help = "Convert the model to a faster-loading SavedModel",
+                                   description = "DeepREx: convert the Keras model to a TensorFlow SavedModel, "
+                                                 "written next to the model file and loaded instead of it from then on.")
+    export.add_argument("-m", "--model",
+                        help = "The Keras model file (default: %s)" % cfg.DEEPREX_MODEL_FILE,
+                        dest = "model", default = cfg.DEEPREX_MODEL_FILE)
+    export.set_defaults(func=run_export)
+    serve = subparsers.add_parser("serve", help = "Prediction server with a resident model",
+                                  description = "DeepREx: prediction server. POST JSON jobs to /singleseq "
+                                                "({\"fasta\": ...}) or /aln ({\"fasta\": ..., \"a3m\": ..., \"hhm\": ...}) "
+                                                "to get TSV predictions; GET /stats for queue depth and latencies.")
+    serve.add_argument("-H", "--host",
+                        help = "Address to listen on (default: %s)" % cfg.SERVE_HOST,
+                        dest = "host", default = cfg.SERVE_HOST)
+    serve.add_argument("-P", "--port",
+                        help = "TCP port to listen on (default: %d)" % cfg.SERVE_PORT,
+                        dest = "port", type = int, default = cfg.SERVE_PORT)
+    serve.add_argument("-u", "--socket",
+                        help = "Listen on this Unix socket instead of TCP",
+                        dest = "socket", default = None)
+    serve.add_argument("-b", "--batch-size",
+                        help = "Maximum number of proteins per prediction batch (default: %d)" % cfg.PREDICT_BATCH_SIZE,
+                        dest = "batch_size", type = int, default = cfg.PREDICT_BATCH_SIZE)
+    serve.add_argument("-l", "--max-padded-length",
+                        help = "Maximum padded length of a prediction batch; longer proteins are predicted alone (default: %d)" % cfg.PREDICT_MAX_PADDED_LENGTH,
+                        dest = "max_padded_length", type = int, default = cfg.PREDICT_MAX_PADDED_LENGTH)
+    serve.add_argument("-d", "--batch-delay",
+                        help = "Milliseconds to wait for more jobs before running a batch (default: %g)" % (cfg.SERVE_BATCH_DELAY * 1000),
+                        dest = "batch_delay", type = float, default = cfg.SERVE_BATCH_DELAY * 1000)
+    serve.add_argument("-q", "--quiet",
+                        help = "Do not log requests",
+                        dest = "quiet", action = "store_true")
+    serve.set_defaults(func=run_serve)
     if len(sys.argv) == 1:
         parser.print_help()
     else:
         ns = parser.parse_args()
+        if ns.func is run_aln:
+            single = [ns.fasta, ns.a3m, ns.hhm]
+            n_inputs = (ns.manifest is not None) + (ns.input_dir is not None) + any([x is not None for x in single])
+            if n_inputs != 1 or (ns.manifest is None and ns.input_dir is None and None in single):
+                aln.error("give either -f, -a and -m, or -i, or -D")
+        if ns.func is run_fasta and ns.resume and ns.output_format != "tsv":
+            multifasta.error("--resume requires TSV output")
+        if ns.func in (run_fasta, run_aln, run_ss):
+            set_memory_options(ns)
+            if ns.window_length is not None and not 0 <= ns.window_overlap < ns.window_length:
+                parser.error("--window-overlap must be less than --window-length")
         ns.func(ns)
 
 if __name__ == "__main__":
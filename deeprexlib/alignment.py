@@ -0,0 +1,165 @@
+import heapq
+import random
+
+import numpy
+
+from .datacache import open_source
+from . import instrument
+from . import conservation
+from . import deeprexconfig as cfg
+
+# lower-case letters are insertions with respect to the query in A3M format
+A3M_INSERTIONS = bytes(range(ord('a'), ord('z') + 1))
+# symbol used to fill rows shorter than the query
+PAD_SYMBOL = ord('-')
+
+def _source_name(source):
+    return source if isinstance(source, str) else "<cached buffer>"
+
+MSA_SELECTIONS = ("first", "sample", "henikoff")
+
+def _rows(iif):
+    """Yield the sequences of an open A3M file, insertions dropped."""
+    current = []
+    for line in iif:
+        if line[:1] == b'>':
+            if len(current) > 0:
+                yield b"".join(current).translate(None, A3M_INSERTIONS)
+                current = []
+            continue
+        line = line.rstrip()
+        if len(line) > 0:
+            current.append(line)
+    if len(current) > 0:
+        yield b"".join(current).translate(None, A3M_INSERTIONS)
+
+def _fit(row, width):
+    """Pad a row with gaps or truncate it to width."""
+    return row[:width].ljust(width, b'-')
+
+def _stack(rows, width):
+    return numpy.frombuffer(b"".join([_fit(row, width) for row in rows]),
+                            dtype=numpy.uint8).reshape(len(rows), width)
+
+def _chunks(rows, width):
+    """Group rows into (n x width) matrices of about conservation.BLOCK_CELLS
+    cells."""
+    size = max(1, conservation.BLOCK_CELLS // max(1, width))
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield _stack(chunk, width)
+            chunk = []
+    if len(chunk) > 0:
+        yield _stack(chunk, width)
+
+@instrument.stage("a3m", result_residues=lambda msa: msa.shape[1])
+def read_a3m(a3m_file, max_rows=None, selection="first"):
+    """Read an A3M alignment in a single pass.
+
+    Insertions (lower-case letters) are dropped while reading, so the
+    returned alignment is a (rows x query length) uint8 matrix of ASCII
+    symbols, query first. Sequences split over several lines are joined and
+    rows of a different length are padded with gaps or truncated to the
+    query length. a3m_file is a file name or a buffer (e.g. a cache entry).
+
+    If max_rows is set, at most max_rows sequences are kept, the query
+    always being one of them: with selection "first" the first ones in the
+    file (the rest is not read), with "sample" a uniform random sample and
+    with "henikoff" those with the largest Henikoff weights in the whole
+    alignment, i.e. the least redundant. Memory is bounded by max_rows x
+    query length bytes in all cases; sampled and selected rows keep their
+    order in the file.
+    """
+    if max_rows is not None and selection == "sample":
+        msa = _read_sample(a3m_file, max_rows)
+    elif max_rows is not None and selection == "henikoff":
+        msa = _read_henikoff(a3m_file, max_rows)
+    elif selection in MSA_SELECTIONS:
+        msa = _read_first(a3m_file, max_rows)
+    else:
+        raise ValueError("Unknown MSA row selection %s" % selection)
+    if msa is None:
+        raise ValueError("No sequences found in alignment file %s" % _source_name(a3m_file))
+    return msa
+
+def _read_first(a3m_file, max_rows):
+    msa = None
+    n_rows = 0
+    with open_source(a3m_file) as iif:
+        for row in _rows(iif):
+            if msa is None:
+                size = 64 if max_rows is None else min(64, max_rows)
+                msa = numpy.full((size, len(row)), PAD_SYMBOL, dtype=numpy.uint8)
+            elif n_rows == msa.shape[0]:
+                size = 2 * n_rows if max_rows is None else min(2 * n_rows, max_rows)
+                grown = numpy.full((size, msa.shape[1]), PAD_SYMBOL, dtype=numpy.uint8)
+                grown[:n_rows] = msa
+                msa = grown
+            row = row[:msa.shape[1]]
+            msa[n_rows, :len(row)] = numpy.frombuffer(row, dtype=numpy.uint8)
+            n_rows += 1
+            if max_rows is not None and n_rows >= max_rows:
+                break
+    return msa[:n_rows] if msa is not None else None
+
+def _read_sample(a3m_file, max_rows):
+    """Reservoir sample of max_rows - 1 sequences besides the query, with a
+    fixed seed so that results are reproducible."""
+    rng = random.Random(cfg.MSA_SAMPLE_SEED)
+    query = None
+    sample = []
+    with open_source(a3m_file) as iif:
+        for (n, row) in enumerate(_rows(iif)):
+            if query is None:
+                query = row
+            elif len(sample) < max_rows - 1:
+                sample.append((n, row))
+            else:
+                k = rng.randrange(n)
+                if k < max_rows - 1:
+                    sample[k] = (n, row)
+    if query is None:
+        return None
+    sample.sort(key=lambda item: item[0])
+    return _stack([query] + [row for (n, row) in sample], len(query))
+
+def _read_henikoff(a3m_file, max_rows):
+    """Keep the query and the max_rows - 1 sequences with the largest
+    Henikoff weights, in two passes over the file: column counts first,
+    then the weight of each sequence."""
+    with open_source(a3m_file) as iif:
+        first = next(_rows(iif), None)
+    if first is None:
+        return None
+    width = len(first)
+    counts = numpy.zeros((width, conservation.N_CODES), dtype=numpy.int64)
+    columns = numpy.arange(width)
+    with open_source(a3m_file) as iif:
+        for chunk in _chunks(_rows(iif), width):
+            counts += conservation._column_counts(conservation.ascii_code_table[chunk])
+    n_seqs = counts[0].sum()
+    if n_seqs <= max_rows:
+        return _read_first(a3m_file, None)
+    counts[:, conservation.GAP_CODE:] = 0
+    d = counts * numpy.count_nonzero(counts, axis=1)[:, None]
+    with numpy.errstate(divide='ignore'):
+        inv = numpy.where(d > 0, 1. / d, 0.)
+    # min-heap of the (weight, -index, row) of the sequences kept so far
+    kept = []
+    n = 0
+    with open_source(a3m_file) as iif:
+        rows = _rows(iif)
+        next(rows)
+        for chunk in _chunks(rows, width):
+            weights = inv[columns, conservation.ascii_code_table[chunk]].sum(axis=1)
+            for (row, weight) in zip(chunk, weights.tolist()):
+                n += 1
+                item = (weight, -n, row.tobytes())
+                if len(kept) < max_rows - 1:
+                    heapq.heappush(kept, item)
+                elif item > kept[0]:
+                    heapq.heapreplace(kept, item)
+    kept.sort(key=lambda item: -item[1])
+    return _stack([first] + [row for (weight, n, row) in kept], width)
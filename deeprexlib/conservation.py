@@ -18,9 +18,14 @@
 # -----------------------------------------------------------------------------
 
 import math
+import numpy
 
 PSEUDOCOUNT = .0000001
 
+# Maximum number of MSA cells (rows x columns) processed at once by the
+# vectorized scoring functions
+BLOCK_CELLS = 1 << 22
+
 amino_acids = ['A', 'R', 'N', 'D', 'C', 'Q', 'E', 'G', 'H', 'I', 'L', 'K', 'M', 'F', 'P', 'S', 'T', 'W', 'Y', 'V', '-']
 iupac_alphabet = ["A", "B", "C", "D", "E", "F", "G", "H", "I", "K", "L", "M", "N", "P", "Q", "R", "S", "T", "U", "V", "W", "Y", "Z", "X", "*", "-"]
 
@@ -29,6 +34,25 @@ aa_to_index = {}
 for i, aa in enumerate(amino_acids):
     aa_to_index[aa] = i
 
+# integer codes used by the vectorized implementation: 0-19 amino acids,
+# 20 gap, 21 any other symbol (e.g. U or *)
+GAP_CODE = 20
+OTHER_CODE = 21
+N_CODES = 22
+aa_code_table = numpy.full(256, OTHER_CODE, dtype=numpy.uint8)
+for i, aa in enumerate(amino_acids):
+    aa_code_table[ord(aa)] = i
+
+# codes for raw ASCII alignment symbols, applying the same clean-up as
+# read_fasta_alignment: upper case, B -> D, Z -> Q, X and any non IUPAC
+# symbol -> gap
+ascii_code_table = numpy.full(256, GAP_CODE, dtype=numpy.uint8)
+for c in range(256):
+    aa = chr(c).upper()
+    if len(aa) == 1 and aa in iupac_alphabet:
+        aa = {'B': 'D', 'Z': 'Q', 'X': '-'}.get(aa, aa)
+        ascii_code_table[c] = aa_code_table[ord(aa)]
+
 def weighted_gap_penalty(col, seq_weights):
     """ Calculate the simple gap penalty multiplier for the column. If the
     sequences are weighted, the gaps, when penalized, are weighted
@@ -183,9 +207,164 @@ def window_score(scores, window_len, lam=.5):
             w_scores[i] = (1 - lam) * (sum / num_terms) + lam * scores[i]
     return w_scores
 
+def encode_alignment(alignment):
+    """ Encode a list of aligned sequences, as returned by
+    read_fasta_alignment, into a (sequences x columns) matrix of integer
+    codes. Return None if the sequences do not all have the same length. """
+
+    seq_len = len(alignment[0])
+    for seq in alignment:
+        if len(seq) != seq_len:
+            return None
+    msa = numpy.frombuffer("".join(alignment).encode("ascii"), dtype=numpy.uint8)
+    return aa_code_table[msa.reshape(len(alignment), seq_len)]
+
+def _column_blocks(msa):
+    n_seqs, seq_len = msa.shape
+    block = max(1, BLOCK_CELLS // max(1, n_seqs))
+    for s in range(0, seq_len, block):
+        yield s, min(seq_len, s + block)
+
+def _column_counts(block):
+    """Per-column counts of each code in a block of MSA columns."""
+    n_cols = block.shape[1]
+    idx = block.astype(numpy.intp) + N_CODES * numpy.arange(n_cols)
+    counts = numpy.bincount(idx.ravel(), minlength=N_CODES * n_cols)
+    return counts.reshape(n_cols, N_CODES)
+
+def _log(x):
+    """Natural log of the positive entries of x, computed with math.log on
+    the distinct values so that results match the pure-Python code to the
+    last bit (numpy.log may differ in the last ulp)."""
+    values, inverse = numpy.unique(x, return_inverse=True)
+    logs = numpy.array([math.log(v) if v > 0 else 0. for v in values.tolist()])
+    return logs[inverse].reshape(x.shape)
+
+def _block(msa, s, e, table):
+    """Columns s to e of msa, encoded with table if given (so that a raw
+    alignment is never encoded as a whole)."""
+    if table is None:
+        return msa[:, s:e]
+    return table[msa[:, s:e]]
+
+def sequence_weights(msa, table=None):
+    """ Vectorized Henikoff '94 sequence weights for an encoded msa, or for
+    a raw one and the table encoding it. Weights are accumulated column by
+    column, in the same order as calculate_sequence_weights, so that
+    results are identical. """
+
+    n_seqs, seq_len = msa.shape
+    seq_weights = numpy.zeros(n_seqs)
+    for (s, e) in _column_blocks(msa):
+        block = _block(msa, s, e, table)
+        counts = _column_counts(block)
+        counts[:, GAP_CODE:] = 0
+        num_observed_types = numpy.count_nonzero(counts, axis=1)
+        cols = numpy.arange(e - s)
+        d = counts[cols, block] * num_observed_types
+        with numpy.errstate(divide='ignore'):
+            inv = numpy.where(d > 0, 1. / d, 0.)
+        for j in range(e - s):
+            seq_weights += inv[:, j]
+    seq_weights /= seq_len
+    return seq_weights
+
+def column_scores(msa, seq_weights, gap_cutoff=0.7, use_gap_penalty=1, table=None):
+    """ Vectorized Shannon entropy scores for all columns of an encoded msa
+    (or a raw one and its encoding table), equivalent to calling
+    shannon_entropy on each column whose gap percentage is not above
+    gap_cutoff. """
+
+    n_seqs, seq_len = msa.shape
+    n_aa = len(amino_acids)
+    weight_sum = sum(seq_weights.tolist())
+    norm = weight_sum + n_aa * PSEUDOCOUNT
+    log_norm = math.log(min(n_aa, n_seqs))
+    scores = numpy.zeros(seq_len)
+    for (s, e) in _column_blocks(msa):
+        block = _block(msa, s, e, table)
+        n_cols = e - s
+        gap_frac = _column_counts(block)[:, GAP_CODE] / n_seqs
+        # column-major order, so that each column is accumulated sequence by
+        # sequence after its pseudocounts, as in weighted_freq_count_pseudocount
+        idx = (block.astype(numpy.intp) + N_CODES * numpy.arange(n_cols)).T.ravel()
+        w = numpy.tile(seq_weights, n_cols)
+        pc_idx = (numpy.arange(n_aa) + N_CODES * numpy.arange(n_cols)[:, None]).ravel()
+        freq = numpy.bincount(numpy.concatenate((pc_idx, idx)),
+                              weights=numpy.concatenate((numpy.full(len(pc_idx), PSEUDOCOUNT), w)),
+                              minlength=N_CODES * n_cols).reshape(n_cols, N_CODES)
+        fc = freq[:, :n_aa] / norm
+        h = numpy.zeros(n_cols)
+        fc_log = _log(fc)
+        for k in range(n_aa):
+            h += numpy.where(fc[:, k] != 0, fc[:, k] * fc_log[:, k], 0.)
+        h /= log_norm
+        inf_score = 1 - (-1 * h)
+        if use_gap_penalty == 1:
+            gap_sum = numpy.bincount(idx, weights=w,
+                                     minlength=N_CODES * n_cols).reshape(n_cols, N_CODES)[:, GAP_CODE]
+            inf_score = inf_score * (1 - (gap_sum / weight_sum))
+        scores[s:e] = numpy.where(gap_frac <= gap_cutoff, inf_score, 0.0)
+    return scores
+
+def window_score_array(scores, window_len, lam=.5):
+    """ Vectorized window_score. """
+
+    scores = numpy.asarray(scores, dtype=float)
+    w_scores = scores.copy()
+    n = len(scores)
+    if n - 2 * window_len <= 0:
+        return w_scores
+    center = scores[window_len:n - window_len]
+    total = numpy.zeros(len(center))
+    num_terms = numpy.zeros(len(center))
+    for j in range(-window_len, window_len + 1):
+        if j == 0:
+            continue
+        neighbour = scores[window_len + j:n - window_len + j]
+        valid = neighbour >= 0
+        num_terms += valid
+        total += numpy.where(valid, neighbour, 0.)
+    update = (center >= 0) & (num_terms > 0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        smoothed = (1 - lam) * (total / num_terms) + lam * center
+    w_scores[window_len:n - window_len] = numpy.where(update, smoothed, center)
+    return w_scores
+
+def score_alignment(alignment, gap_cutoff=0.7, window_size=1,
+                    use_gap_penalty=1, win_lam=.5):
+    msa = encode_alignment(alignment)
+    if msa is None:
+        # ragged alignment: columns have different depths
+        return _score_alignment_reference(alignment, gap_cutoff, window_size,
+                                          use_gap_penalty, win_lam)
+    seq_weights = sequence_weights(msa)
+    scores = column_scores(msa, seq_weights, gap_cutoff, use_gap_penalty)
+    if window_size > 0:
+        scores = window_score_array(scores, window_size, win_lam)
+    return scores.tolist()
+
+def score_msa(msa, gap_cutoff=0.7, window_size=1,
+              use_gap_penalty=1, win_lam=.5):
+    """ Score the conservation of an alignment given as a (sequences x
+    columns) uint8 matrix of ASCII symbols, e.g. as returned by
+    alignment.read_a3m. Symbols are encoded one block of columns at a
+    time. """
+
+    seq_weights = sequence_weights(msa, ascii_code_table)
+    scores = column_scores(msa, seq_weights, gap_cutoff, use_gap_penalty, ascii_code_table)
+    if window_size > 0:
+        scores = window_score_array(scores, window_size, win_lam)
+    return scores.tolist()
+
 def score_conservation(align_file, gap_cutoff=0.7, window_size=1,
                        use_gap_penalty=1, win_lam=.5):
     names, alignment = read_fasta_alignment(align_file)
+    return score_alignment(alignment, gap_cutoff, window_size,
+                           use_gap_penalty, win_lam)
+
+def _score_alignment_reference(alignment, gap_cutoff, window_size,
+                               use_gap_penalty, win_lam):
     seq_len = len(alignment[0])
     seq_weights = calculate_sequence_weights(alignment)
     scores = []
@@ -198,3 +377,11 @@ def score_conservation(align_file, gap_cutoff=0.7, window_size=1,
     if window_size > 0:
         scores = window_score(scores, window_size, win_lam)
     return scores
+
+def score_conservation_reference(align_file, gap_cutoff=0.7, window_size=1,
+                                 use_gap_penalty=1, win_lam=.5):
+    """ Pure-Python implementation of score_conservation, kept as a reference
+    for regression testing. """
+    names, alignment = read_fasta_alignment(align_file)
+    return _score_alignment_reference(alignment, gap_cutoff, window_size,
+                                      use_gap_penalty, win_lam)
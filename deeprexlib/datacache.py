@@ -6,16 +6,192 @@ Created on Wed Oct 18 15:58:18 2017
 """
 
 import os
+import io
+import gzip
+import mmap
 import hashlib
 import shutil
 import errno
+import threading
+import tempfile
+import time
+import fcntl
+import zipfile
+import contextlib
+
+# Entry locks are shared by the sequences whose digests start with the same
+# LOCK_PREFIX_CHARS hex digits, bounding the number of lock files
+LOCK_PREFIX_CHARS = 3
+
+class BufferReader(io.RawIOBase):
+    """Read-only, seekable binary file object over a buffer (e.g. a
+    memory-mapped cache entry); the buffer itself is never copied."""
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self.buffer) - self.pos)
+        b[:n] = self.buffer[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = len(self.buffer) + offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+def open_source(source):
+    """Open a file name (gzip-compressed if it ends in .gz) or a buffer
+    (e.g. from CacheEntry.source) as a binary file object."""
+    if isinstance(source, str):
+        if source.endswith(".gz"):
+            return gzip.open(source, 'rb')
+        return open(source, 'rb')
+    return io.BufferedReader(BufferReader(source))
+
+def map_file(filename):
+    """Memory-map a whole file read-only and return a memoryview on it."""
+    with open(filename, 'rb') as iif:
+        if os.fstat(iif.fileno()).st_size == 0:
+            return memoryview(b'')
+        return memoryview(mmap.mmap(iif.fileno(), 0, access=mmap.ACCESS_READ))
+
+@contextlib.contextmanager
+def locked(lock_file, shared=False):
+    """Hold an flock on lock_file (created if needed) inside the block.
+
+    flock locks belong to the open file, so they exclude other threads of
+    the same process as well as other processes.
+    """
+    with open(lock_file, 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+def check_content(ext, data):
+    """Return a description of what is wrong with the data of an entry of
+    type ext, or None if it looks valid."""
+    if len(data) == 0:
+        return "empty entry"
+    if ext.endswith('.npz'):
+        try:
+            with zipfile.ZipFile(BufferReader(data)) as archive:
+                bad = archive.testzip()
+        except (zipfile.BadZipFile, OSError, EOFError) as exc:
+            return "invalid npz archive (%s)" % exc
+        if bad is not None:
+            return "corrupted npz member %s" % bad
+    elif ext == 'hhblits.a3m':
+        if bytes(data[:1]) != b'>':
+            return "not an A3M alignment"
+    elif ext == 'hhblits.hhm':
+        if b'\nHMM ' not in bytes(data):
+            return "not an HHM file"
+    return None
+
+class CacheEntry():
+    """Handle on the cached artifacts of one sequence.
+
+    The sequence digest is computed once, when the handle is created by
+    DataCache.entry, and reused by every operation.
+    """
+    def __init__(self, cache, digest):
+        self.cache = cache
+        self.digest = digest
+
+    def lookup(self, ext):
+        found = self.cache._exists(self.digest, ext)
+        self.cache._count(ext, found)
+        if found:
+            self.cache._touch(self.digest, ext)
+        return found
+
+    def exists(self, ext):
+        """Like lookup, without counting a hit or a miss."""
+        return self.cache._exists(self.digest, ext)
+
+    def lock(self, name):
+        """Context manager serializing the computation of the entries of
+        this sequence named name, e.g. an HHblits search, across threads
+        and processes sharing the cache."""
+        return self.cache._lock(self.digest, name)
+
+    def store(self, filename, ext):
+        self.cache._store(self.digest, filename, ext)
+
+    def retrieve(self, ext, outfile):
+        if self.exists(ext):
+            self.cache._retrieve(self.digest, ext, outfile)
+
+    def path(self, ext):
+        """File name of an entry, or None if missing or not file-backed."""
+        if not self.lookup(ext):
+            return None
+        return self.cache._path(self.digest, ext)
+
+    def buffer(self, ext):
+        """Read-only memory-mapped view of an entry, or None.
+
+        The view stays valid if the entry is evicted afterwards, e.g. by
+        prune() in another job sharing the cache.
+        """
+        if not self.lookup(ext):
+            return None
+        try:
+            return self.cache._buffer(self.digest, ext)
+        except FileNotFoundError:
+            # evicted since the lookup
+            return None
+
+    def source(self, ext):
+        """An entry to pass directly to the alignment and HHM readers, or
+        None: a buffer, which unlike a file name survives eviction."""
+        return self.buffer(ext)
+
+    def open_binary(self, ext):
+        """Binary file object reading an entry, or None."""
+        source = self.source(ext)
+        if source is None:
+            return None
+        return open_source(source)
 
 class DataCache():
-    def __init__(self, cacheDir, forceRebuild=False, levels=2, dir_name_chars=2):
+    """Cache of per-sequence artifacts, one file per entry.
+
+    Entries are published atomically (written to a temporary file and
+    renamed), so concurrent jobs sharing cacheDir never see partial files.
+    The modification time of an entry records its last use: if max_size
+    (bytes) or max_age (seconds) are set, close() evicts the least recently
+    used entries beyond the size cap and those unused for longer than
+    max_age.
+    """
+    def __init__(self, cacheDir, forceRebuild=False, levels=2, dir_name_chars=2,
+                 max_size=None, max_age=None):
         self.cacheDir = cacheDir
         self.forceRebuild = forceRebuild
         self.levels = levels
         self.dir_name_chars = dir_name_chars
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = {}
+        self.misses = {}
+        self._stats_lock = threading.Lock()
 
     def _create_path(self, digest):
         path = self.cacheDir
@@ -38,34 +214,166 @@ class DataCache():
             path = os.path.join(path, digest[s:e])
         return path
 
-    def lookup(self, sequence, ext):
-        digest = hashlib.sha512(sequence.encode("utf-8")).hexdigest()
-        name = os.path.join(self._get_path(digest), '%s.%s' % (digest, ext))
+    def _name(self, digest, ext):
+        return os.path.join(self._get_path(digest), '%s.%s' % (digest, ext))
+
+    def _count(self, ext, hit):
+        with self._stats_lock:
+            counter = self.hits if hit else self.misses
+            counter[ext] = counter.get(ext, 0) + 1
+
+    def _exists(self, digest, ext):
+        return os.path.isfile(self._name(digest, ext)) and not self.forceRebuild
+
+    def _store(self, digest, filename, ext):
+        if not self._exists(digest, ext) or self.forceRebuild:
+            self._create_path(digest)
+            name = self._name(digest, ext)
+            (fd, tmp_name) = tempfile.mkstemp(prefix=".%s." % os.path.basename(name),
+                                              suffix=".tmp", dir=os.path.dirname(name))
+            try:
+                with os.fdopen(fd, 'wb') as of, open(filename, 'rb') as iif:
+                    shutil.copyfileobj(iif, of)
+                    of.flush()
+                    os.fsync(of.fileno())
+                os.chmod(tmp_name, 0o644)
+                os.replace(tmp_name, name)
+            except:
+                os.unlink(tmp_name)
+                raise
+
+    def _touch(self, digest, ext):
         try:
-            f=open(name)
-        except:
-            return False
-        else:
-            f.close()
-            return (True and (not self.forceRebuild))
+            os.utime(self._name(digest, ext))
+        except OSError:
+            # e.g. a read-only cache: entries are still usable
+            pass
+
+    def _lock(self, digest, name):
+        os.makedirs(self.cacheDir, exist_ok=True)
+        return locked(os.path.join(self.cacheDir, ".%s.%s.lock" % (digest[:LOCK_PREFIX_CHARS], name)))
+
+    def _retrieve(self, digest, ext, outfile):
+        shutil.copyfile(self._name(digest, ext), outfile)
+
+    def _path(self, digest, ext):
+        return self._name(digest, ext)
+
+    def _buffer(self, digest, ext):
+        return map_file(self._name(digest, ext))
+
+    def entry(self, sequence):
+        digest = hashlib.sha512(sequence.encode("utf-8")).hexdigest()
+        return CacheEntry(self, digest)
+
+    def lookup(self, sequence, ext):
+        return self.entry(sequence).lookup(ext)
 
     def store(self, filename, sequence, ext):
-        if not self.lookup(sequence, ext) or self.forceRebuild:
-            digest = hashlib.sha512(sequence.encode("utf-8")).hexdigest()
-            self._create_path(digest)
-            dest = os.path.join(self._get_path(digest), '%s.%s' % (digest, ext))
-            shutil.copyfile(filename, dest)
+        self.entry(sequence).store(filename, ext)
 
     def retrieve(self, sequence, ext, outfile):
-        if self.lookup(sequence, ext):
-            digest = hashlib.sha512(sequence.encode("utf-8")).hexdigest()
-            name = os.path.join(self._get_path(digest), '%s.%s' % (digest, ext))
-            shutil.copyfile(name, outfile)
+        self.entry(sequence).retrieve(ext, outfile)
+
+    def get_path(self, sequence, ext):
+        return self.entry(sequence).path(ext)
+
+    def get_buffer(self, sequence, ext):
+        return self.entry(sequence).buffer(ext)
+
+    def open_binary(self, sequence, ext):
+        return self.entry(sequence).open_binary(ext)
 
     def get_handle(self, sequence, ext):
-        fh = None
-        if self.lookup(sequence, ext):
-            digest = hashlib.sha512(sequence.encode("utf-8")).hexdigest()
-            name = os.path.join(self._get_path(digest), '%s.%s' % (digest, ext))
-            fh = open(name)
+        fh = self.entry(sequence).open_binary(ext)
+        if fh is not None:
+            fh = io.TextIOWrapper(fh)
         return fh
+
+    def _remove(self, digest, ext):
+        try:
+            os.unlink(self._name(digest, ext))
+        except FileNotFoundError:
+            pass
+
+    def _check(self, digest, ext):
+        return check_content(ext, self._buffer(digest, ext))
+
+    def entries(self):
+        """Yield (digest, ext, size in bytes, last use time) for every
+        entry. Temporary and lock files (names starting with '.') are
+        skipped."""
+        for (path, dirs, files) in os.walk(self.cacheDir):
+            dirs.sort()
+            for name in sorted(files):
+                if name.startswith('.'):
+                    continue
+                (digest, sep, ext) = name.partition('.')
+                if len(sep) == 0:
+                    continue
+                try:
+                    st = os.stat(os.path.join(path, name))
+                except FileNotFoundError:
+                    continue
+                yield (digest, ext, st.st_size, st.st_mtime)
+
+    def _remove_stale_files(self, max_age):
+        # temporary files of interrupted stores, and the per-sequence lock
+        # files (named after the full digest) of older versions
+        now = time.time()
+        for (path, dirs, files) in os.walk(self.cacheDir):
+            for name in files:
+                temporary = name.startswith('.') and name.endswith('.tmp')
+                old_lock = name.endswith('.lock') and len(name.lstrip('.').partition('.')[0]) == 128
+                if temporary or old_lock:
+                    stale_name = os.path.join(path, name)
+                    try:
+                        if now - os.stat(stale_name).st_mtime > max_age:
+                            os.unlink(stale_name)
+                    except FileNotFoundError:
+                        pass
+
+    def prune(self, max_size=None, max_age=None):
+        """Evict least recently used entries until the cache is at most
+        max_size bytes, and entries unused for more than max_age seconds.
+        Return (removed entries, removed bytes)."""
+        entries = sorted(self.entries(), key=lambda e: e[3])
+        total = sum([e[2] for e in entries])
+        now = time.time()
+        n_removed = 0
+        removed_size = 0
+        for (digest, ext, size, last_use) in entries:
+            too_old = max_age is not None and now - last_use > max_age
+            too_big = max_size is not None and total > max_size
+            if not too_old and not too_big:
+                break
+            self._remove(digest, ext)
+            total -= size
+            n_removed += 1
+            removed_size += size
+        self._remove_stale_files(24 * 3600)
+        return n_removed, removed_size
+
+    def verify(self, delete=False):
+        """Check the integrity of every entry; yield (digest, ext, problem)
+        for the invalid ones, which are removed if delete is set."""
+        for (digest, ext, size, last_use) in list(self.entries()):
+            try:
+                problem = self._check(digest, ext)
+            except (OSError, ValueError) as exc:
+                problem = str(exc)
+            if problem is not None:
+                if delete:
+                    self._remove(digest, ext)
+                yield (digest, ext, problem)
+
+    def close(self):
+        """Enforce the size and age limits, if any."""
+        if self.max_size is not None or self.max_age is not None:
+            self.prune(self.max_size, self.max_age)
+
+    def stats(self):
+        """Return (artifact type, hits, misses) tuples for this session."""
+        with self._stats_lock:
+            exts = sorted(set(self.hits) | set(self.misses))
+            return [(ext, self.hits.get(ext, 0), self.misses.get(ext, 0)) for ext in exts]
@@ -7,12 +7,76 @@ except:
     logging.error("$ export DEEPREX_ROOT=/path/to/deeprex")
     sys.exit(1)
 
+# HHblits searches (fasta module): executable, number of iterations (-n),
+# E-value inclusion threshold (-e) and maximum number of prefilter hits
+# (-maxfilt); the last two are the HHblits defaults. Cached HHblits outputs
+# are not keyed on these settings: use a new DEEPREX_DATA_CACHE_DIR after
+# changing them. A search running for more than HHBLITS_TIMEOUT seconds is
+# killed (None: no limit); failed searches are retried HHBLITS_RETRIES times.
+HHBLITS_EXECUTABLE = os.environ.get('DEEPREX_HHBLITS', 'hhblits')
 HHBLITS_ITERATIONS = 2
+HHBLITS_EVALUE = 0.001
+HHBLITS_MAXFILT = 20000
+HHBLITS_TIMEOUT = None
+HHBLITS_RETRIES = 1
 
 DEEPREX_MODEL_FILE = os.path.join(DEEPREX_ROOT, "data", "model_final.h5")
+# Load the SavedModel export of the model (deeprex.py export-model) when it
+# exists and matches the model file; set DEEPREX_MODEL_EXPORT=0 to always
+# load the HDF5 file
+USE_MODEL_EXPORT = os.environ.get('DEEPREX_MODEL_EXPORT', '1') not in ('', '0')
+# Largest difference allowed between the predicted probabilities of the
+# export and of the HDF5 model
+MODEL_EXPORT_TOLERANCE = 1e-5
 
 KD = {'A': 1.8, 'C': 2.5, 'E': -3.5, 'D': -3.5,
       'G': -0.4, 'F': 2.8, 'I': 4.5, 'H': -3.2,
       'K': -3.9, 'M': 1.9, 'L': 3.8, 'N': -3.5,
       'Q': -3.5, 'P': -1.6, 'S': -0.8, 'R': -4.5,
       'T': -0.7, 'W': -0.9, 'V': 4.2, 'Y': -1.3, 'X': 0.0}
+
+# Batched inference: maximum number of proteins per forward pass and maximum
+# padded length of a batch (proteins longer than this are predicted alone).
+PREDICT_BATCH_SIZE = 32
+PREDICT_MAX_PADDED_LENGTH = 1024
+# Number of input records grouped together before length bucketing
+PREDICT_BUCKET_POOL = 1024
+
+# Bounded-memory mode (--bounded-memory): keep at most BOUNDED_MSA_ROWS
+# sequences of each alignment, those with the largest Henikoff weights, and
+# predict proteins longer than BOUNDED_WINDOW_LENGTH residues in windows of
+# that length overlapping by PREDICT_WINDOW_OVERLAP residues. Random MSA
+# row samples (--msa-selection sample) use the seed MSA_SAMPLE_SEED.
+BOUNDED_MSA_ROWS = 10000
+BOUNDED_WINDOW_LENGTH = 4096
+PREDICT_WINDOW_OVERLAP = 1024
+MSA_SAMPLE_SEED = 0
+
+# Write buffer of TSV output files (bytes)
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Capacity of the queues between the stages of the streaming fasta pipeline
+PIPELINE_QUEUE_SIZE = 16
+
+# Feature extraction results computed ahead of the consumer, per worker
+# process (each holds its encoded features in a shared memory block)
+WORKER_READ_AHEAD = 2
+
+# Keep intermediate files (e.g. sequence profiles) and the temporary working
+# directory when DEEPREX_DEBUG is set to a non-empty value other than 0
+DEBUG = os.environ.get('DEEPREX_DEBUG', '') not in ('', '0')
+
+# Version tag of the encoded feature layout, part of the feature cache keys:
+# bump it whenever encoding, profile or conservation computations change
+FEATURE_VERSION = "v1"
+
+# Prediction server (deeprex.py serve): default address, how long the
+# micro-batcher waits for more proteins after the first one (seconds), size
+# of the in-memory result cache (proteins), number of requests kept for
+# latency percentiles and largest accepted request body (bytes)
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8765
+SERVE_BATCH_DELAY = 0.01
+SERVE_RESULT_CACHE_SIZE = 4096
+SERVE_LATENCY_WINDOW = 1000
+SERVE_MAX_REQUEST_SIZE = 256 << 20
@@ -0,0 +1,288 @@
+import os
+import io
+import functools
+import collections
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy
+
+from . import utils
+from . import deeprexconfig as cfg
+from . import alignment
+from . import hhm
+from . import instrument
+from .datacache import open_source
+
+FASTA_SUFFIXES = (".fasta", ".fa", ".faa")
+A3M_SUFFIXES = (".a3m",)
+HHM_SUFFIXES = (".hhm",)
+
+def open_text(filename):
+    """Open a text file for reading, decompressing it if it ends in .gz."""
+    return io.TextIOWrapper(open_source(filename))
+
+def read_manifest(manifest_file):
+    """Read (fasta, a3m, hhm) triples, one per line, whitespace separated.
+
+    Empty lines and lines starting with # are skipped; relative paths are
+    relative to the directory of the manifest.
+    """
+    base = os.path.dirname(os.path.abspath(manifest_file))
+    triples = []
+    with open(manifest_file) as iif:
+        for (n, line) in enumerate(iif):
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            fields = line.split()
+            if len(fields) != 3:
+                raise ValueError("Line %d of manifest %s: expected fasta, a3m and hhm files, found %d fields" %
+                                 (n + 1, manifest_file, len(fields)))
+            triples.append(tuple([os.path.join(base, f) for f in fields]))
+    return triples
+
+def _split_name(filename):
+    """Return (protein id, kind) for an input file name, kind being one of
+    fasta, a3m, hhm, or None for other files."""
+    name = filename[:-3] if filename.endswith(".gz") else filename
+    for (kind, suffixes) in (("fasta", FASTA_SUFFIXES), ("a3m", A3M_SUFFIXES), ("hhm", HHM_SUFFIXES)):
+        for suffix in suffixes:
+            if name.endswith(suffix):
+                return name[:-len(suffix)], kind
+    return None, None
+
+def find_triples(directory):
+    """Collect (fasta, a3m, hhm) triples from a directory tree.
+
+    Files are matched by protein id: <id>.fasta (or .fa, .faa), <id>.a3m and
+    <id>.hhm, optionally gzip-compressed, possibly in different
+    subdirectories. Triples are returned sorted by id.
+    """
+    files = {}
+    for (path, dirs, names) in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            (pid, kind) = _split_name(name)
+            if kind is None:
+                continue
+            found = files.setdefault(pid, {})
+            if kind in found:
+                raise ValueError("Several %s files for protein %s in %s" % (kind, pid, directory))
+            found[kind] = os.path.join(path, name)
+    triples = []
+    for pid in sorted(files):
+        missing = [kind for kind in ("fasta", "a3m", "hhm") if kind not in files[pid]]
+        if len(missing) > 0:
+            raise ValueError("Missing %s file(s) for protein %s in %s" % (", ".join(missing), pid, directory))
+        triples.append((files[pid]["fasta"], files[pid]["a3m"], files[pid]["hhm"]))
+    if len(triples) == 0:
+        raise ValueError("No (fasta, a3m, hhm) triples found in %s" % directory)
+    return triples
+
+def aln_features(triple, we, gap_cutoff=0.7, hp_window=5, max_msa_rows=None,
+                 profile_id=None, profile_prefix=None, msa_selection="first"):
+    """Encode one protein from its (fasta, a3m, hhm) files.
+
+    Returns (record, protein, hydrophobicity, conservation). The encoding
+    of the protein with id profile_id is profiled with cProfile, see
+    instrument.profile_file.
+    """
+    from Bio import SeqIO
+    (fasta_file, a3m_file, hhm_file) = triple
+    with open_text(fasta_file) as iif:
+        record = SeqIO.read(iif, 'fasta')
+    profile_file = None
+    if profile_id is not None and record.id == profile_id:
+        profile_file = instrument.profile_file(profile_prefix, record.id)
+    (protein, hydrophobicity, msa_conservation, hhm_npz_file) = msa_features(
+        str(record.seq), record.id.replace("|","_"), a3m_file, hhm_file, we,
+        gap_cutoff, hp_window, max_msa_rows, profile_file=profile_file,
+        msa_selection=msa_selection)
+    return record, protein, hydrophobicity, msa_conservation
+
+def singleseq_features(sequences, hp_window=5):
+    """Encode a batch of proteins from their sequences only.
+
+    Returns (features, hydrophobicity): the feature rows of all proteins
+    stacked in one array, to be split with split_proteins, and one
+    hydrophobicity list per protein.
+    """
+    features = utils.encode_single_seq_features(sequences)
+    return features, utils.score_hp_batch(sequences, hp_window)
+
+def split_proteins(features, sequences):
+    """Split stacked feature rows into one (1, L, F) array per sequence."""
+    proteins = []
+    start = 0
+    for sequence in sequences:
+        proteins.append(features[None, start:start + len(sequence)])
+        start += len(sequence)
+    return proteins
+
+def msa_features(sequence, prefix, a3m_source, hhm_source, we, gap_cutoff=0.7, hp_window=5,
+                 max_msa_rows=None, hhm_npz=False, profile_file=None, msa_selection="first"):
+    """Encode one protein from HHblits outputs.
+
+    a3m_source and hhm_source are file names or buffers; hhm_source may also
+    be an already parsed hhm.HHMProfile. Returns (protein, hydrophobicity,
+    conservation, hhm_npz_file); if hhm_npz is set and the HHM file was
+    parsed, the parsed profile is saved in the working environment and its
+    file name returned, so that it can be cached, else hhm_npz_file is
+    None. With profile_file, the encoding is profiled with cProfile and
+    the stats are written there. max_msa_rows and msa_selection are passed
+    to alignment.read_a3m.
+    """
+    with instrument.profiled(profile_file):
+        return _msa_features(sequence, prefix, a3m_source, hhm_source, we, gap_cutoff,
+                             hp_window, max_msa_rows, hhm_npz, msa_selection)
+
+def _msa_features(sequence, prefix, a3m_source, hhm_source, we, gap_cutoff, hp_window,
+                  max_msa_rows, hhm_npz, msa_selection):
+    msa = alignment.read_a3m(a3m_source, max_rows=max_msa_rows, selection=msa_selection)
+    msa_conservation = utils.score_conservation(msa, gap_cutoff=gap_cutoff)
+    sequence_profile = utils.build_sequence_profile(prefix, msa, we)
+    hydrophobicity = utils.score_hp(sequence, hp_window)
+    hhm_npz_file = None
+    hhm_profile = hhm_source
+    if not isinstance(hhm_profile, hhm.HHMProfile):
+        hhm_profile = hhm.parse_hhm(hhm_source)
+        if hhm_npz:
+            hhm_npz_file = we.createFile("hhm.", ".npz")
+            hhm_profile.save(hhm_npz_file)
+    protein = utils.encode_protein(sequence, sequence_profile, hhm_profile)
+    return protein, hydrophobicity, msa_conservation, hhm_npz_file
+
+class SharedArray():
+    """Descriptor of an array moved into a shared memory block."""
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+def _share(result):
+    # runs in the worker: the receiving process owns and unlinks the blocks,
+    # which stay registered with the resource tracker of the parent process
+    # (see WorkerPool) so that blocks never received are unlinked at exit
+    shared = []
+    for value in result:
+        if isinstance(value, numpy.ndarray) and value.nbytes > 0:
+            block = shared_memory.SharedMemory(create=True, size=value.nbytes)
+            numpy.ndarray(value.shape, value.dtype, buffer=block.buf)[...] = value
+            block.close()
+            value = SharedArray(block.name, value.shape, value.dtype.str)
+        shared.append(value)
+    return tuple(shared)
+
+def _unshare(result):
+    values = []
+    for value in result:
+        if isinstance(value, SharedArray):
+            block = shared_memory.SharedMemory(name=value.name)
+            try:
+                value = numpy.ndarray(value.shape, value.dtype, buffer=block.buf).copy()
+            finally:
+                block.close()
+                block.unlink()
+        values.append(value)
+    return tuple(values)
+
+def _release(result):
+    # unlink the blocks of a result that will not be used
+    for value in result:
+        if isinstance(value, SharedArray):
+            try:
+                block = shared_memory.SharedMemory(name=value.name)
+            except FileNotFoundError:
+                continue
+            block.close()
+            block.unlink()
+
+def _call_shared(func, args, kwargs):
+    # stage counters recorded in the worker travel back with the result
+    before = instrument.recorder.snapshot()
+    result = _share(func(*args, **kwargs))
+    return result, instrument.recorder.delta(before)
+
+def _call_shared_item(func, item):
+    return _call_shared(func, (item,), {})
+
+def _unshare_recorded(shared):
+    (result, stages) = shared
+    instrument.recorder.merge(stages)
+    return _unshare(result)
+
+class WorkerPool():
+    """Pool of worker processes for CPU-bound feature extraction.
+
+    Functions run by the pool return tuples; numpy arrays in them (e.g.
+    encoded feature matrices) come back through shared memory blocks
+    instead of being pickled through a pipe. With processes <= 1 functions
+    run in the calling process. Stage counters (instrument.recorder)
+    recorded in the workers are added to those of the calling process.
+    Create the pool before loading the model or starting threads: workers
+    are forked from the current process. Closing the pool unlinks the
+    blocks of results computed but not consumed.
+    """
+    def __init__(self, processes=1):
+        self.processes = processes
+        self.pool = None
+        self._pending = set()
+        if processes > 1:
+            # workers inherit the tracker and register their blocks with it
+            resource_tracker.ensure_running()
+            self.pool = multiprocessing.Pool(processes)
+
+    def apply(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in a worker, blocking the calling
+        thread only: several threads can submit jobs concurrently."""
+        if self.pool is None:
+            return func(*args, **kwargs)
+        # memory-mapped buffers (e.g. cache entries) cannot be pickled
+        args = [bytes(a) if isinstance(a, memoryview) else a for a in args]
+        return _unshare_recorded(self.pool.apply(_call_shared, (func, args, kwargs)))
+
+    def imap(self, func, items):
+        """Apply func to items, yielding results in order as they come.
+
+        At most WORKER_READ_AHEAD results per worker process are computed
+        ahead of the consumer.
+        """
+        if self.pool is None:
+            for item in items:
+                yield func(item)
+            return
+        call = functools.partial(_call_shared_item, func)
+        read_ahead = self.processes * cfg.WORKER_READ_AHEAD
+        queue = collections.deque()
+        for item in items:
+            queue.append(self._submit(call, item))
+            if len(queue) >= read_ahead:
+                yield self._take(queue.popleft())
+        while len(queue) > 0:
+            yield self._take(queue.popleft())
+
+    def _submit(self, call, item):
+        pending = self.pool.apply_async(call, (item,))
+        self._pending.add(pending)
+        return pending
+
+    def _take(self, pending):
+        self._pending.discard(pending)
+        return _unshare_recorded(pending.get())
+
+    def close(self):
+        if self.pool is not None:
+            for pending in self._pending:
+                if pending.ready() and pending.successful():
+                    _release(pending.get()[0])
+            self._pending.clear()
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,8 +1,13 @@
-import subprocess
-import logging
+import os
 import re
+import glob
+import shutil
+import logging
+import threading
+import subprocess
 from . import deeprexconfig as cfg
-from . import conservation as cons
+from . import instrument
+from .datacache import locked
 
 def a3m_to_aln(a3m_file, aln_file):
     of = open(aln_file, 'w')
@@ -25,45 +30,137 @@ def aln_to_faln(aln_file, faln_file):
     aln_f.close()
     return seq_c
 
-def run_hhblits(acc, db_prefix, fasta_file, we, gap_cutoff=0.7, cpus=1, data_cache=None):
-    hhblits_a3m_out = we.createFile(acc+".hhblits.", ".a3m")
-    hhblits_aln_out = we.createFile(acc+".hhblits.", ".aln")
-    hhblits_hhm_out = we.createFile(acc+".hhblits.", ".hhm")
-    hhblits_fal_out = we.createFile(acc+".hhblits.", ".aln.fa")
-    hhblits_stdout = we.createFile(acc+".hhblits.stdout.", ".log")
-    hhblits_stderr = we.createFile(acc+".hhblits.stderr.", ".log")
+def _cached_outputs(cache_entry):
+    hhblits_hhm_out = cache_entry.source('hhblits.hhm')
+    if hhblits_hhm_out is not None:
+        hhblits_a3m_out = cache_entry.source('hhblits.a3m')
+        if hhblits_a3m_out is not None:
+            return hhblits_a3m_out, hhblits_hhm_out
+    return None
+
+def database_files(db_prefix):
+    """The ffindex files of an HHblits database, <prefix>_*.ffdata/ffindex."""
+    return sorted(glob.glob(db_prefix + "_*.ffdata") + glob.glob(db_prefix + "_*.ffindex"))
+
+class HHblitsRunner():
+    """Runs HHblits searches against one database.
+
+    At most jobs searches run at the same time, whatever the number of
+    calling threads. A search is killed after timeout seconds (None: no
+    limit) and a failed or killed search is retried up to retries times
+    before its error is raised. Iterations, E-value and maxfilt default to
+    the cfg.HHBLITS_* settings; executable (cfg.HHBLITS_EXECUTABLE, set by
+    DEEPREX_HHBLITS) can point to a stub for testing.
+    """
+    def __init__(self, db_prefix, cpus=1, jobs=1, iterations=cfg.HHBLITS_ITERATIONS,
+                 evalue=cfg.HHBLITS_EVALUE, maxfilt=cfg.HHBLITS_MAXFILT,
+                 timeout=cfg.HHBLITS_TIMEOUT, retries=cfg.HHBLITS_RETRIES,
+                 executable=cfg.HHBLITS_EXECUTABLE):
+        self.db_prefix = db_prefix
+        self.cpus = cpus
+        self.iterations = iterations
+        self.evalue = evalue
+        self.maxfilt = maxfilt
+        self.timeout = timeout
+        self.retries = max(0, retries)
+        self.executable = executable
+        self._jobs = threading.BoundedSemaphore(max(1, jobs))
+
+    def command(self, fasta_file, a3m_file, hhm_file, out_file):
+        return [self.executable, '-i', fasta_file,
+                '-d', self.db_prefix,
+                '-n', str(self.iterations),
+                '-e', str(self.evalue),
+                '-maxfilt', str(self.maxfilt),
+                '-cpu', str(self.cpus),
+                '-oa3m', a3m_file,
+                '-ohhm', hhm_file,
+                '-o', out_file]
+
+    def preload(self):
+        """Ask the kernel to read the database files into the page cache, so
+        that the first searches do not wait for the disk."""
+        size = 0
+        for filename in database_files(self.db_prefix):
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+            size += os.path.getsize(filename)
+        return size
+
+    def copy_database(self, directory):
+        """Copy the database files into directory (e.g. a tmpfs such as
+        /dev/shm) and search the copy from now on. Files already copied by
+        an earlier run, with the same size and modification time, are
+        reused; concurrent runs copy them once. Returns the bytes copied."""
+        os.makedirs(directory, exist_ok=True)
+        copied = 0
+        with locked(os.path.join(directory, ".deeprex-hhblits-db.lock")):
+            for filename in database_files(self.db_prefix):
+                target = os.path.join(directory, os.path.basename(filename))
+                stat = os.stat(filename)
+                if os.path.exists(target):
+                    target_stat = os.stat(target)
+                    if target_stat.st_size == stat.st_size and int(target_stat.st_mtime) == int(stat.st_mtime):
+                        continue
+                tmp_file = "%s.%d.tmp" % (target, os.getpid())
+                shutil.copyfile(filename, tmp_file)
+                shutil.copystat(filename, tmp_file)
+                os.replace(tmp_file, target)
+                copied += stat.st_size
+        self.db_prefix = os.path.join(directory, os.path.basename(self.db_prefix))
+        return copied
+
+    def run(self, acc, fasta_file, we, cache_entry=None):
+        """Run HHblits on fasta_file and return its (a3m, hhm) outputs.
+
+        With a cache_entry (a DataCache.entry handle) cached outputs are
+        returned as memory-mapped buffers (see CacheEntry.source), without
+        copying them into the working environment. Searches for the
+        same sequence are serialized through the cache, so concurrent jobs
+        sharing it run HHblits once and the others wait for its outputs.
+        """
+        if cache_entry is None:
+            return self.search(acc, fasta_file, we)
+        outputs = _cached_outputs(cache_entry)
+        if outputs is None:
+            with cache_entry.lock('hhblits'):
+                # another job may have completed the search while we waited
+                if cache_entry.exists('hhblits.hhm') and cache_entry.exists('hhblits.a3m'):
+                    outputs = _cached_outputs(cache_entry)
+                # None also when pruned by another job since the check
+                if outputs is None:
+                    outputs = self.search(acc, fasta_file, we)
+                    cache_entry.store(outputs[1], 'hhblits.hhm')
+                    cache_entry.store(outputs[0], 'hhblits.a3m')
+        return outputs
 
-    try:
-        exec_hhblits = True
-        sequence = "".join([x.strip() for x in open(fasta_file).readlines()[1:]])
-        if data_cache is not None:
-            if data_cache.lookup(sequence, 'hhblits.aln'):
-                if data_cache.lookup(sequence, 'hhblits.hhm'):
-                    if data_cache.lookup(sequence, 'hhblits.a3m'):
-                        exec_hhblits = False
-        if exec_hhblits:
-            subprocess.check_output(['hhblits', '-i', fasta_file,
-                                    '-d', db_prefix,
-                                    '-n', "2",
-                                    '-cpu', str(cpus),
-                                    '-oa3m', hhblits_a3m_out,
-                                    '-ohhm', hhblits_hhm_out,
-                                    '-o', hhblits_stdout],
-                                    stderr=open(hhblits_stderr, 'w'))
-            a3m_to_aln(hhblits_a3m_out, hhblits_aln_out)
-            if data_cache is not None:
-                data_cache.store(hhblits_aln_out, sequence, 'hhblits.aln')
-                data_cache.store(hhblits_hhm_out, sequence, 'hhblits.hhm')
-                data_cache.store(hhblits_a3m_out, sequence, 'hhblits.a3m')
-        else:
-            data_cache.retrieve(sequence, 'hhblits.aln', hhblits_aln_out)
-            data_cache.retrieve(sequence, 'hhblits.hhm', hhblits_hhm_out)
-        seq_c = aln_to_faln(hhblits_aln_out, hhblits_fal_out)
-        if seq_c > 1:
-            msa_conservation = cons.score_conservation(hhblits_fal_out, gap_cutoff=gap_cutoff)
-        else:
-            msa_conservation = [0] * len(sequence)
-    except:
-        logging.error("HHblits failed. For details, please see stderr file %s" % hhblits_stderr)
-        raise
-    return hhblits_aln_out, hhblits_hhm_out, msa_conservation
+    @instrument.stage("hhblits")
+    def search(self, acc, fasta_file, we):
+        """Search the database with fasta_file, retrying failed searches,
+        and return the (a3m, hhm) output files."""
+        hhblits_a3m_out = we.createFile(acc+".hhblits.", ".a3m")
+        hhblits_hhm_out = we.createFile(acc+".hhblits.", ".hhm")
+        hhblits_stdout = we.createFile(acc+".hhblits.stdout.", ".log")
+        hhblits_stderr = we.createFile(acc+".hhblits.stderr.", ".log")
+        command = self.command(fasta_file, hhblits_a3m_out, hhblits_hhm_out, hhblits_stdout)
+        for attempt in range(self.retries + 1):
+            try:
+                with self._jobs, open(hhblits_stderr, 'w') as err:
+                    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=err,
+                                   timeout=self.timeout, check=True)
+                return hhblits_a3m_out, hhblits_hhm_out
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as exc:
+                if isinstance(exc, subprocess.TimeoutExpired):
+                    problem = "timed out after %ss" % self.timeout
+                else:
+                    problem = "exited with status %d" % exc.returncode
+                if attempt < self.retries:
+                    logging.warning("HHblits %s for %s, retrying (attempt %d of %d). For details, please see "
+                                    "stderr file %s" % (problem, acc, attempt + 2, self.retries + 1, hhblits_stderr))
+                else:
+                    logging.error("HHblits %s for %s. For details, please see stderr file %s" %
+                                  (problem, acc, hhblits_stderr))
+                    raise
@@ -0,0 +1,107 @@
+import io
+import numpy
+
+from .datacache import open_source
+from . import instrument
+
+N_EMISSIONS = 20
+N_TRANSITIONS = 7
+N_NEFF = 3
+
+class HHMProfile():
+    """Match-state arrays parsed from an HHblits HHM file.
+
+    emissions: (L, 20) emission probabilities, 2^(-x/1000), 0 for '*'
+    transitions: (L, 7) transition probabilities, 2^(-x/1000), 0 for '*'
+    neff: (L, 3) Neff, Neff_I and Neff_D values divided by 1000
+    sequence: the residues of the match states
+    """
+    def __init__(self, emissions, transitions, neff, sequence):
+        self.emissions = emissions
+        self.transitions = transitions
+        self.neff = neff
+        self.sequence = sequence
+
+    def __len__(self):
+        return self.emissions.shape[0]
+
+    def save(self, npz_file):
+        with open(npz_file, 'wb') as of:
+            numpy.savez(of, emissions=self.emissions, transitions=self.transitions,
+                        neff=self.neff, sequence=numpy.array(self.sequence))
+
+    @classmethod
+    def load(cls, npz_file):
+        with numpy.load(npz_file) as data:
+            return cls(data['emissions'], data['transitions'], data['neff'],
+                       str(data['sequence']))
+
+def _scores_to_probs(tokens, hhm_file):
+    """Convert HHM -1000*log2(p) scores into probabilities ('*' is 0).
+
+    The power is computed with Python floats on the distinct scores only, so
+    that values are identical to the former per-element conversion
+    (numpy.power may differ in the last ulp).
+    """
+    n_cols = len(tokens[0])
+    tokens = " ".join([" ".join(t) for t in tokens]).replace('*', 'inf').split()
+    try:
+        scores = numpy.array(list(map(float, tokens))).reshape(-1, n_cols)
+    except ValueError:
+        raise ValueError("Invalid score in HHM file %s" % hhm_file)
+    values, inverse = numpy.unique(scores, return_inverse=True)
+    probs = numpy.array([2**(v/-1000) for v in values.tolist()])
+    return probs[inverse].reshape(scores.shape)
+
+@instrument.stage("hhm", result_residues=len)
+def parse_hhm(hhm_file):
+    """Parse an HHM file name or buffer (e.g. a cache entry)."""
+    with io.TextIOWrapper(open_source(hhm_file)) as iif:
+        lines = iif.read().splitlines()
+    if not isinstance(hhm_file, str):
+        hhm_file = "<cached buffer>"
+    start = 0
+    while start < len(lines) and lines[start][:4] != "HMM ":
+        start += 1
+    if start == len(lines):
+        raise ValueError("No HMM section found in HHM file %s" % hhm_file)
+    # skip the HMM header, the transitions header and the null transitions
+    start += 3
+    residues = []
+    emission_tokens = []
+    transition_tokens = []
+    neff_tokens = []
+    i = start
+    while i < len(lines) and lines[i][:2] != "//":
+        if len(lines[i].strip()) == 0:
+            i += 1
+            continue
+        emission = lines[i].split()
+        if i + 1 >= len(lines):
+            raise ValueError("Truncated match state %d in HHM file %s" % (len(residues) + 1, hhm_file))
+        transition = lines[i+1].split()
+        if len(emission) != N_EMISSIONS + 3 or len(transition) != N_TRANSITIONS + N_NEFF:
+            raise ValueError("Malformed match state %d at line %d in HHM file %s" %
+                             (len(residues) + 1, i + 1, hhm_file))
+        residues.append(emission[0])
+        emission_tokens.append(emission[2:-1])
+        transition_tokens.append(transition[:N_TRANSITIONS])
+        neff_tokens.append(transition[N_TRANSITIONS:])
+        i += 2
+    if len(residues) == 0:
+        raise ValueError("No match states found in HHM file %s" % hhm_file)
+    emissions = _scores_to_probs(emission_tokens, hhm_file)
+    transitions = _scores_to_probs(transition_tokens, hhm_file)
+    neff = numpy.array(neff_tokens, float)/1000
+    return HHMProfile(emissions, transitions, neff, "".join(residues))
+
+HHM_CACHE_EXT = 'hhblits.hhm.npz'
+
+def load_cached_hhm(cache_entry):
+    """Return the parsed profile cached for a DataCache.entry handle, or
+    None."""
+    cached = cache_entry.open_binary(HHM_CACHE_EXT)
+    if cached is None:
+        return None
+    with cached:
+        return HHMProfile.load(cached)
@@ -0,0 +1,173 @@
+import os
+import re
+import json
+import time
+import resource
+import functools
+import threading
+import contextlib
+
+class Recorder():
+    """Per-stage counters of a DeepREx run.
+
+    For each stage it records the number of calls, wall time, CPU time of
+    the calling thread and residues processed. CPU time spent in other
+    threads (e.g. TensorFlow's thread pool) or in child processes (HHblits)
+    is not attributed to a stage, but is part of the process totals of the
+    report. Worker processes record into their own Recorder; WorkerPool
+    sends the difference back with each result, see delta and merge.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, stage, wall, cpu, residues, calls=1):
+        with self._lock:
+            counters = self.stages.setdefault(stage, [0, 0.0, 0.0, 0])
+            counters[0] += calls
+            counters[1] += wall
+            counters[2] += cpu
+            counters[3] += residues
+
+    @contextlib.contextmanager
+    def timed(self, stage, residues=0):
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - wall, time.thread_time() - cpu, residues)
+
+    def snapshot(self):
+        with self._lock:
+            return dict([(stage, list(counters)) for (stage, counters) in self.stages.items()])
+
+    def delta(self, before):
+        """Counters added since snapshot before."""
+        ret = {}
+        for (stage, counters) in self.snapshot().items():
+            old = before.get(stage, [0, 0.0, 0.0, 0])
+            if counters[0] != old[0]:
+                ret[stage] = [c - o for (c, o) in zip(counters, old)]
+        return ret
+
+    def merge(self, delta):
+        for (stage, (calls, wall, cpu, residues)) in delta.items():
+            self.add(stage, wall, cpu, residues, calls)
+
+    def report(self, data_cache=None, **info):
+        """Run report as a dict: per-stage counters, data cache hits and
+        misses, process totals and any info given as keywords."""
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        ret = dict(info)
+        ret['stages'] = {}
+        for (stage, (calls, wall, cpu, residues)) in sorted(self.snapshot().items()):
+            ret['stages'][stage] = {'calls': calls, 'wall_s': round(wall, 6), 'cpu_s': round(cpu, 6),
+                                    'residues': residues,
+                                    'residues_per_s': round(residues / wall, 1) if wall > 0 else 0.0}
+        ret['cache'] = {}
+        if data_cache is not None:
+            for (ext, hits, misses) in data_cache.stats():
+                ret['cache'][ext] = {'hits': hits, 'misses': misses}
+        # ru_maxrss is in kilobytes on Linux
+        ret['process'] = {'wall_s': round(time.perf_counter() - self.start, 6),
+                          'cpu_s': round(usage.ru_utime + usage.ru_stime, 6),
+                          'children_cpu_s': round(children.ru_utime + children.ru_stime, 6),
+                          'peak_rss_bytes': usage.ru_maxrss * 1024}
+        return ret
+
+recorder = Recorder()
+
+def timed(stage, residues=0):
+    """Context manager timing a block as part of stage."""
+    return recorder.timed(stage, residues)
+
+def stage(name, residues=None, result_residues=None):
+    """Decorator timing every call of a function as part of stage name.
+
+    The number of residues processed is given by residues, called with
+    the same arguments as the function, or by result_residues, called with
+    its return value.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            wall = time.perf_counter()
+            cpu = time.thread_time()
+            n = residues(*args, **kwargs) if residues is not None else 0
+            ret = func(*args, **kwargs)
+            if result_residues is not None:
+                n = result_residues(ret)
+            recorder.add(name, time.perf_counter() - wall, time.thread_time() - cpu, n)
+            return ret
+        return wrapper
+    return decorator
+
+def prometheus(report, prefix="deeprex"):
+    """Format a report in the Prometheus text exposition format, e.g. for
+    the node exporter textfile collector."""
+    lines = []
+    def metric(name, help, kind, samples):
+        lines.append("# HELP %s_%s %s" % (prefix, name, help))
+        lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+        for (labels, value) in samples:
+            labels = ",".join(['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                               for (k, v) in labels])
+            lines.append("%s_%s%s %r" % (prefix, name, "{%s}" % labels if labels else "", value))
+    stages = sorted(report['stages'].items())
+    metric("stage_calls_total", "Calls of each stage.", "counter",
+           [((("stage", s),), v['calls']) for (s, v) in stages])
+    metric("stage_wall_seconds_total", "Wall time spent in each stage.", "counter",
+           [((("stage", s),), v['wall_s']) for (s, v) in stages])
+    metric("stage_cpu_seconds_total", "CPU time of the calling thread in each stage.", "counter",
+           [((("stage", s),), v['cpu_s']) for (s, v) in stages])
+    metric("stage_residues_total", "Residues processed by each stage.", "counter",
+           [((("stage", s),), v['residues']) for (s, v) in stages])
+    cache = sorted(report['cache'].items())
+    metric("cache_hits_total", "Data cache hits per artifact type.", "counter",
+           [((("type", t),), v['hits']) for (t, v) in cache])
+    metric("cache_misses_total", "Data cache misses per artifact type.", "counter",
+           [((("type", t),), v['misses']) for (t, v) in cache])
+    process = report['process']
+    metric("wall_seconds", "Wall time of the run.", "gauge", [((), process['wall_s'])])
+    metric("cpu_seconds", "CPU time of the DeepREx process.", "gauge", [((), process['cpu_s'])])
+    metric("children_cpu_seconds", "CPU time of child processes (e.g. HHblits).", "gauge",
+           [((), process['children_cpu_s'])])
+    metric("peak_rss_bytes", "Peak resident set size of the DeepREx process.", "gauge",
+           [((), process['peak_rss_bytes'])])
+    return "\n".join(lines) + "\n"
+
+def write_report(filename, report):
+    """Write a report as JSON, or in the Prometheus text format if the file
+    name ends in .prom. The file is replaced atomically, as textfile
+    collectors expect."""
+    tmp_file = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp_file, 'w') as of:
+        if filename.endswith(".prom"):
+            of.write(prometheus(report))
+        else:
+            json.dump(report, of, indent=2, sort_keys=True)
+            of.write("\n")
+    os.replace(tmp_file, filename)
+
+def profile_file(prefix, record_id):
+    """cProfile output file of a protein: <prefix>.<id>.prof."""
+    return "%s.%s.prof" % (prefix, re.sub(r"[^A-Za-z0-9_.-]", "_", record_id))
+
+@contextlib.contextmanager
+def profiled(filename):
+    """Profile a block with cProfile and dump the stats to filename (for
+    pstats, snakeviz, ...); does nothing if filename is None."""
+    if filename is None:
+        yield
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
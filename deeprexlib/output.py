@@ -0,0 +1,173 @@
+import os
+import zipfile
+
+import numpy
+
+from . import deeprexconfig as cfg
+from . import instrument
+
+OUTPUT_FORMATS = ("tsv", "npz")
+
+def _rounded_strings(values, ndigits):
+    """str(round(v, ndigits)) for every value, computed once per distinct
+    value. Floats are compared bit by bit, so -0.0 and 0.0 stay apart."""
+    values = numpy.asarray(values)
+    if values.dtype == numpy.float64:
+        (unique, inverse) = numpy.unique(values.view(numpy.int64), return_inverse=True)
+        unique = unique.view(numpy.float64)
+    else:
+        (unique, inverse) = numpy.unique(values, return_inverse=True)
+    strings = numpy.array([str(round(v, ndigits)) for v in unique.tolist()], dtype=object)
+    return strings[inverse.reshape(-1)]
+
+def format_tsv(acc, sequence, predictions, hydrophobicity, conservation):
+    """TSV rows of one protein, as one string.
+
+    Gives the same text as printing the values one residue at a time:
+    reliabilities are rounded with numpy (they were numpy scalars),
+    hydrophobicity and conservation with Python round.
+    """
+    n = len(predictions)
+    if n == 0:
+        return ""
+    probability = numpy.asarray(predictions, dtype=numpy.float64).reshape(n, -1)[:, 0]
+    labels = numpy.where(probability > 0.5, "Exposed", "Buried").tolist()
+    reliability = numpy.round(2.0 * numpy.absolute(probability - 0.5), 2)
+    reliability = _rounded_strings(reliability, 2)
+    hydrophobicity = _rounded_strings(list(hydrophobicity[:n]), 3)
+    conservation = _rounded_strings(list(conservation[:n]), 5)
+    return "".join(["%s\t%d\t%s\t%s\t%s\t%s\t%s\n" % (acc, i + 1, sequence[i], labels[i], reliability[i],
+                                                     hydrophobicity[i], conservation[i])
+                    for i in range(n)])
+
+class TsvWriter():
+    """Per-residue TSV output, one buffered write per protein.
+
+    With resume_offset the file is truncated there and appended to, e.g.
+    to continue from the last checkpoint of an interrupted run.
+    """
+    def __init__(self, filename, resume_offset=None):
+        if resume_offset is None:
+            self.out = open(filename, 'wb', buffering=cfg.OUTPUT_BUFFER_SIZE)
+        else:
+            self.out = open(filename, 'r+b' if os.path.exists(filename) else 'wb',
+                            buffering=cfg.OUTPUT_BUFFER_SIZE)
+            self.out.truncate(resume_offset)
+            self.out.seek(resume_offset)
+
+    def write(self, acc, sequence, predictions, hydrophobicity, conservation):
+        with instrument.timed("output", len(sequence)):
+            self.out.write(format_tsv(acc, sequence, predictions, hydrophobicity,
+                                      conservation).encode("utf-8"))
+
+    def flush(self):
+        """Flush the buffer and return the size of the file."""
+        self.out.flush()
+        return self.out.tell()
+
+    def close(self):
+        self.out.close()
+
+class NpzWriter():
+    """Compressed NPZ output with one record per protein.
+
+    Arrays are streamed into the archive as proteins are written: besides
+    the zip directory (a few hundred bytes per protein) nothing is kept in
+    memory. Record k (numbered from 0 in output order) is stored as the
+    arrays k/id, k/sequence, k/probability, k/label (True for exposed),
+    k/reliability, k/hydrophobicity and k/conservation; read_npz_output
+    reads them back.
+    """
+    def __init__(self, filename):
+        self.archive = zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.n_records = 0
+
+    def _add(self, name, array):
+        with self.archive.open("%d/%s.npy" % (self.n_records, name), 'w', force_zip64=True) as of:
+            numpy.lib.format.write_array(of, numpy.asanyarray(array), allow_pickle=False)
+
+    @instrument.stage("output", lambda self, acc, sequence, *args: len(sequence))
+    def write(self, acc, sequence, predictions, hydrophobicity, conservation):
+        n = len(predictions)
+        probability = numpy.asarray(predictions, dtype=numpy.float32).reshape(n, -1)[:, 0]
+        self._add("id", numpy.array(acc))
+        self._add("sequence", numpy.array(sequence))
+        self._add("probability", probability)
+        self._add("label", probability > 0.5)
+        self._add("reliability", 2.0 * numpy.absolute(probability.astype(numpy.float64) - 0.5))
+        self._add("hydrophobicity", numpy.asarray(hydrophobicity[:n], dtype=numpy.float64))
+        self._add("conservation", numpy.asarray(conservation[:n], dtype=numpy.float64))
+        self.n_records += 1
+
+    def close(self):
+        self.archive.close()
+
+COLUMNS = ("probability", "label", "reliability", "hydrophobicity", "conservation")
+
+def read_npz_output(filename):
+    """Yield one dict per protein of an NpzWriter file, in output order,
+    with keys id, sequence and the per-residue columns."""
+    with numpy.load(filename) as data:
+        k = 0
+        while "%d/id" % k in data:
+            record = {'id': str(data["%d/id" % k]), 'sequence': str(data["%d/sequence" % k])}
+            for column in COLUMNS:
+                record[column] = data["%d/%s" % (k, column)]
+            yield record
+            k += 1
+
+def open_writer(filename, output_format="tsv", resume_offset=None):
+    if output_format == "npz":
+        if resume_offset is not None:
+            raise ValueError("NPZ output cannot be resumed")
+        return NpzWriter(filename)
+    return TsvWriter(filename, resume_offset)
+
+class Checkpoint():
+    """Completion log of an output file, <output file>.done.
+
+    After the output of a protein is flushed, the line "<record
+    index>\t<output size>\t<record id>" is appended and flushed, so an
+    interrupted run can be resumed: read() returns the records already done
+    and the output size to truncate to, dropping a partially written
+    protein.
+    """
+    def __init__(self, out_file):
+        self.filename = out_file + ".done"
+        self.log = None
+
+    def read(self):
+        """Return ({record index: record id}, output size) of the completed
+        records, or ({}, 0) if there is no checkpoint."""
+        done = {}
+        offset = 0
+        if os.path.exists(self.filename):
+            with open(self.filename) as iif:
+                for line in iif:
+                    fields = line.rstrip("\n").split("\t", 2)
+                    if len(fields) < 3 or not line.endswith("\n"):
+                        # torn last line
+                        break
+                    done[int(fields[0])] = fields[2]
+                    offset = int(fields[1])
+        return done, offset
+
+    def open(self, resume=False):
+        if resume and os.path.exists(self.filename):
+            # rewrite the valid lines, dropping a torn last one
+            (done, offset) = self.read()
+            with open(self.filename) as iif:
+                lines = iif.readlines()[:len(done)]
+            self.log = open(self.filename, 'w')
+            self.log.writelines(lines)
+            self.log.flush()
+        else:
+            self.log = open(self.filename, 'w')
+
+    def add(self, index, record_id, offset):
+        self.log.write("%d\t%d\t%s\n" % (index, offset, record_id))
+        self.log.flush()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
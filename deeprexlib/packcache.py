@@ -0,0 +1,234 @@
+import os
+import glob
+import mmap
+import sqlite3
+import threading
+import time
+import zlib
+import fcntl
+
+from .datacache import DataCache, check_content, locked
+
+class PackedDataCache(DataCache):
+    """DataCache backend keeping artifacts in a few append-only pack files.
+
+    Entries are appended to pack-NNNNN.dat files under cacheDir and indexed
+    by (sequence digest, ext) in an SQLite database (index.sqlite) that
+    records pack number, offset, length, CRC32 and last use time. Reads go
+    through read-only memory maps of the pack files, so lookups cost an
+    index query instead of a file open and retrieved data is not copied.
+    Several processes can share the same directory: appends are serialized
+    with a lock on the pack file and the index with SQLite locking, and an
+    entry becomes visible only once its data is on disk. Evicted entries
+    leave dead space in the packs, reclaimed by compact() after a prune.
+    """
+    def __init__(self, cacheDir, forceRebuild=False, pack_size=1 << 30,
+                 max_size=None, max_age=None):
+        DataCache.__init__(self, cacheDir, forceRebuild, max_size=max_size, max_age=max_age)
+        self.pack_size = pack_size
+        os.makedirs(cacheDir, exist_ok=True)
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cacheDir, "index.sqlite"),
+                                   timeout=600, check_same_thread=False)
+        with self._db_lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                             "digest TEXT NOT NULL, ext TEXT NOT NULL, "
+                             "pack INTEGER NOT NULL, offset INTEGER NOT NULL, "
+                             "length INTEGER NOT NULL, crc INTEGER NOT NULL, "
+                             "last_use REAL NOT NULL DEFAULT 0, "
+                             "PRIMARY KEY (digest, ext))")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(entries)")]
+            if 'last_use' not in columns:
+                # index created before eviction support
+                self._db.execute("ALTER TABLE entries ADD COLUMN last_use REAL NOT NULL DEFAULT 0")
+            self._db.commit()
+        self._maps = {}
+        self._maps_lock = threading.Lock()
+        # last use times are written to the index in one go by close()
+        self._touched = {}
+
+    def _pack_file(self, pack):
+        return os.path.join(self.cacheDir, "pack-%05d.dat" % pack)
+
+    def _compact_lock(self, shared):
+        # appends hold it shared, compaction exclusively
+        return locked(os.path.join(self.cacheDir, "compact.lock"), shared=shared)
+
+    def _entry(self, digest, ext):
+        with self._db_lock:
+            return self._db.execute("SELECT pack, offset, length, crc FROM entries "
+                                    "WHERE digest = ? AND ext = ?",
+                                    (digest, ext)).fetchone()
+
+    def _exists(self, digest, ext):
+        return self._entry(digest, ext) is not None and not self.forceRebuild
+
+    def _map(self, pack, end):
+        # pack files only grow, so a map is refreshed when it is too short
+        with self._maps_lock:
+            mapped = self._maps.get(pack)
+            if mapped is None or len(mapped) < end:
+                with open(self._pack_file(pack), 'rb') as iif:
+                    mapped = mmap.mmap(iif.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[pack] = mapped
+            return mapped
+
+    def _read(self, entry):
+        pack, offset, length, crc = entry
+        if length == 0:
+            return memoryview(b'')
+        return memoryview(self._map(pack, offset + length))[offset:offset + length]
+
+    def _read_entry(self, digest, ext):
+        # None if the entry was pruned since it was looked up
+        for attempt in range(2):
+            entry = self._entry(digest, ext)
+            if entry is None:
+                return None
+            try:
+                return self._read(entry)
+            except FileNotFoundError:
+                # the pack was compacted away after the index lookup
+                if attempt > 0:
+                    raise
+
+    def _packs(self):
+        return sorted([int(os.path.basename(f)[5:-4])
+                       for f in glob.glob(os.path.join(self.cacheDir, "pack-*.dat"))])
+
+    def _append(self, data):
+        # always append to the last pack: numbers of compacted packs are
+        # never reused, since other processes may still have them mapped
+        packs = self._packs()
+        pack = packs[-1] if len(packs) > 0 else 0
+        while True:
+            with open(self._pack_file(pack), 'ab') as of:
+                fcntl.flock(of, fcntl.LOCK_EX)
+                try:
+                    offset = of.seek(0, os.SEEK_END)
+                    if offset > 0 and offset + len(data) > self.pack_size:
+                        pack += 1
+                        continue
+                    of.write(data)
+                    of.flush()
+                    os.fsync(of.fileno())
+                finally:
+                    fcntl.flock(of, fcntl.LOCK_UN)
+            return pack, offset
+
+    def _store(self, digest, filename, ext):
+        if not self._exists(digest, ext) or self.forceRebuild:
+            with open(filename, 'rb') as iif:
+                data = iif.read()
+            with self._compact_lock(shared=True):
+                pack, offset = self._append(data)
+                with self._db_lock:
+                    self._db.execute("INSERT OR REPLACE INTO entries "
+                                     "(digest, ext, pack, offset, length, crc, last_use) "
+                                     "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                     (digest, ext, pack, offset, len(data),
+                                      zlib.crc32(data), time.time()))
+                    self._db.commit()
+
+    def _retrieve(self, digest, ext, outfile):
+        data = self._read_entry(digest, ext)
+        if data is not None:
+            with open(outfile, 'wb') as of:
+                of.write(data)
+
+    def _path(self, digest, ext):
+        # packed entries have no file of their own: callers use the buffer
+        return None
+
+    def _buffer(self, digest, ext):
+        return self._read_entry(digest, ext)
+
+    def _touch(self, digest, ext):
+        with self._db_lock:
+            self._touched[(digest, ext)] = time.time()
+
+    def _remove(self, digest, ext):
+        with self._db_lock:
+            self._db.execute("DELETE FROM entries WHERE digest = ? AND ext = ?", (digest, ext))
+            self._db.commit()
+
+    def _check(self, digest, ext):
+        entry = self._entry(digest, ext)
+        if entry is None:
+            return None
+        data = self._read(entry)
+        if len(data) != entry[2]:
+            return "truncated pack file"
+        if zlib.crc32(data) != entry[3]:
+            return "CRC mismatch"
+        return check_content(ext, data)
+
+    def _flush_touched(self):
+        with self._db_lock:
+            touched = self._touched
+            self._touched = {}
+            if len(touched) > 0:
+                self._db.executemany("UPDATE entries SET last_use = ? WHERE digest = ? AND ext = ?",
+                                     [(t, d, e) for ((d, e), t) in touched.items()])
+                self._db.commit()
+
+    def entries(self):
+        self._flush_touched()
+        with self._db_lock:
+            rows = self._db.execute("SELECT digest, ext, length, last_use FROM entries "
+                                    "ORDER BY digest, ext").fetchall()
+        for row in rows:
+            yield row
+
+    def pack_usage(self):
+        """Return (bytes in pack files, bytes of live entries)."""
+        total = sum([os.path.getsize(self._pack_file(p)) for p in self._packs()])
+        with self._db_lock:
+            live = self._db.execute("SELECT COALESCE(SUM(length), 0) FROM entries").fetchone()[0]
+        return total, live
+
+    def compact(self):
+        """Copy the live entries into new pack files and delete the old
+        ones, reclaiming the space of evicted entries."""
+        with self._compact_lock(shared=False):
+            with self._db_lock:
+                rows = self._db.execute("SELECT digest, ext, pack, offset, length, crc FROM entries "
+                                        "ORDER BY pack, offset").fetchall()
+            old_packs = self._packs()
+            if len(old_packs) == 0:
+                return
+            pack = old_packs[-1] + 1
+            moves = []
+            of = open(self._pack_file(pack), 'wb')
+            try:
+                for (digest, ext, old_pack, old_offset, length, crc) in rows:
+                    if of.tell() > 0 and of.tell() + length > self.pack_size:
+                        of.flush()
+                        os.fsync(of.fileno())
+                        of.close()
+                        pack += 1
+                        of = open(self._pack_file(pack), 'wb')
+                    moves.append((pack, of.tell(), digest, ext))
+                    of.write(self._read((old_pack, old_offset, length, crc)))
+                of.flush()
+                os.fsync(of.fileno())
+            finally:
+                of.close()
+            with self._db_lock:
+                self._db.executemany("UPDATE entries SET pack = ?, offset = ? "
+                                     "WHERE digest = ? AND ext = ?", moves)
+                self._db.commit()
+            with self._maps_lock:
+                self._maps = {}
+            for old_pack in old_packs:
+                os.unlink(self._pack_file(old_pack))
+
+    def prune(self, max_size=None, max_age=None):
+        (n_removed, removed_size) = DataCache.prune(self, max_size, max_age)
+        if n_removed > 0:
+            self.compact()
+        return n_removed, removed_size
+
+    def close(self):
+        self._flush_touched()
+        DataCache.close(self)
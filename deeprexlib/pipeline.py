@@ -0,0 +1,209 @@
+import threading
+import queue
+
+from . import deeprexconfig as cfg
+
+_STOP = object()
+
+class Completed():
+    """Returned by a search function when the result of an item is already
+    known (e.g. from a cache): the item skips extraction and inference."""
+    def __init__(self, features, predictions):
+        self.features = features
+        self.predictions = predictions
+
+class Failed():
+    """Features of an item whose search or extraction raised an exception,
+    when the pipeline skips failed items."""
+    def __init__(self, error):
+        self.error = error
+
+class StreamingPipeline():
+    """Three-stage streaming pipeline over an input iterable.
+
+    Items flow through bounded queues between a pool of n_search concurrent
+    search workers (e.g. HHblits), n_extract feature-extraction workers (more
+    than one when extraction runs in a process pool) and a single
+    batched-inference worker. run() yields (item, features,
+    predictions) tuples in input order. At most max_inflight items are
+    in the pipeline at any time, so memory stays bounded. With skip_errors,
+    an item whose search or extraction fails is yielded with a Failed
+    instance as features and None as predictions, instead of stopping the
+    pipeline; inference errors are always fatal.
+    """
+    def __init__(self, search, extract, predict, n_search=1,
+                 batch_size=cfg.PREDICT_BATCH_SIZE,
+                 queue_size=cfg.PIPELINE_QUEUE_SIZE, n_extract=1,
+                 skip_errors=False):
+        self.search = search
+        self.extract = extract
+        self.predict = predict
+        self.n_search = max(1, n_search)
+        self.n_extract = max(1, n_extract)
+        self.batch_size = max(1, batch_size)
+        self.skip_errors = skip_errors
+        self.queue_size = max(1, queue_size)
+        self.max_inflight = self.n_search + self.n_extract + 2 * self.queue_size + self.batch_size
+        self._errors = []
+        self._abort = threading.Event()
+        self._running_lock = threading.Lock()
+        self._running = {}
+
+    def _last_to_stop(self, stage):
+        # the last worker of a stage to finish tells the next stage
+        with self._running_lock:
+            self._running[stage] -= 1
+            return self._running[stage] == 0
+
+    def _put(self, q, obj):
+        while not self._abort.is_set():
+            try:
+                q.put(obj, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._abort.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _STOP
+
+    def _fail(self, exc, out_q):
+        self._errors.append(exc)
+        self._abort.set()
+        try:
+            out_q.put_nowait(_STOP)
+        except queue.Full:
+            pass
+
+    def _feed(self, items, search_q, inflight, out_q):
+        try:
+            for (i, item) in enumerate(items):
+                while not inflight.acquire(timeout=0.1):
+                    if self._abort.is_set():
+                        return
+                if not self._put(search_q, (i, item)):
+                    return
+        except Exception as exc:
+            self._fail(exc, out_q)
+        finally:
+            for _ in range(self.n_search):
+                self._put(search_q, _STOP)
+
+    def _search_worker(self, search_q, extract_q, out_q):
+        try:
+            while True:
+                job = self._get(search_q)
+                if job is _STOP:
+                    break
+                (i, item) = job
+                try:
+                    search_result = self.search(item)
+                except Exception as exc:
+                    if not self.skip_errors:
+                        raise
+                    search_result = Completed(Failed(exc), None)
+                if isinstance(search_result, Completed):
+                    self._put(out_q, (i, item, search_result.features, search_result.predictions))
+                elif not self._put(extract_q, (i, item, search_result)):
+                    break
+        except Exception as exc:
+            self._fail(exc, out_q)
+        finally:
+            if self._last_to_stop("search"):
+                for _ in range(self.n_extract):
+                    self._put(extract_q, _STOP)
+
+    def _extract_worker(self, extract_q, predict_q, out_q):
+        try:
+            while True:
+                job = self._get(extract_q)
+                if job is _STOP:
+                    break
+                (i, item, search_result) = job
+                try:
+                    features = self.extract(item, search_result)
+                except Exception as exc:
+                    if not self.skip_errors:
+                        raise
+                    if not self._put(out_q, (i, item, Failed(exc), None)):
+                        break
+                    continue
+                if not self._put(predict_q, (i, item, features)):
+                    break
+        except Exception as exc:
+            self._fail(exc, out_q)
+        finally:
+            if self._last_to_stop("extract"):
+                self._put(predict_q, _STOP)
+
+    def _predict_worker(self, predict_q, out_q):
+        try:
+            done = False
+            while not done:
+                job = self._get(predict_q)
+                if job is _STOP:
+                    break
+                batch = [job]
+                # Drain whatever is already waiting, up to one full batch
+                while len(batch) < self.batch_size:
+                    try:
+                        job = predict_q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is _STOP:
+                        done = True
+                        break
+                    batch.append(job)
+                predictions = self.predict([features for (i, item, features) in batch])
+                for ((i, item, features), prediction) in zip(batch, predictions):
+                    if not self._put(out_q, (i, item, features, prediction)):
+                        return
+        except Exception as exc:
+            self._fail(exc, out_q)
+        finally:
+            self._put(out_q, _STOP)
+
+    def run(self, items):
+        search_q = queue.Queue(self.queue_size)
+        extract_q = queue.Queue(self.queue_size)
+        predict_q = queue.Queue(self.queue_size + self.batch_size)
+        out_q = queue.Queue()
+        inflight = threading.Semaphore(self.max_inflight)
+        self._running = {"search": self.n_search, "extract": self.n_extract}
+        # named after their stage, e.g. for py-spy dump
+        threads = [threading.Thread(target=self._feed, name="pipeline-feed",
+                                    args=(items, search_q, inflight, out_q))]
+        for k in range(self.n_search):
+            threads.append(threading.Thread(target=self._search_worker, name="pipeline-search-%d" % k,
+                                            args=(search_q, extract_q, out_q)))
+        for k in range(self.n_extract):
+            threads.append(threading.Thread(target=self._extract_worker, name="pipeline-extract-%d" % k,
+                                            args=(extract_q, predict_q, out_q)))
+        threads.append(threading.Thread(target=self._predict_worker, name="pipeline-predict",
+                                        args=(predict_q, out_q)))
+        for t in threads:
+            t.daemon = True
+            t.start()
+        pending = {}
+        next_i = 0
+        try:
+            while True:
+                result = out_q.get()
+                if result is _STOP:
+                    break
+                pending[result[0]] = result[1:]
+                while next_i in pending:
+                    yield pending.pop(next_i)
+                    next_i += 1
+                    inflight.release()
+        finally:
+            self._abort.set()
+            for t in threads:
+                t.join()
+        if len(self._errors) > 0:
+            raise self._errors[0]
@@ -0,0 +1,280 @@
+import os
+import json
+import shutil
+import threading
+import time
+import hashlib
+import numpy
+
+from . import deeprexconfig as cfg
+from . import instrument
+
+# TensorFlow and Keras take seconds to import: they are only imported when a
+# model is actually loaded, so that e.g. --help and argument errors are fast
+
+def make_buckets(lengths, batch_size, max_padded_length):
+    """Group protein indexes into batches of similar length.
+
+    Indexes are sorted by length and packed into batches of at most
+    batch_size proteins. Proteins longer than max_padded_length are put in
+    a batch of their own, so that a padded batch never exceeds
+    batch_size x max_padded_length residues.
+    """
+    buckets = []
+    current = []
+    for i in sorted(range(len(lengths)), key=lambda k: lengths[k]):
+        if lengths[i] > max_padded_length:
+            buckets.append([i])
+            continue
+        current.append(i)
+        if len(current) == batch_size:
+            buckets.append(current)
+            current = []
+    if len(current) > 0:
+        buckets.append(current)
+    return buckets
+
+def make_windows(length, window_length, overlap):
+    """Split a protein into windows for prediction.
+
+    Returns (start, end, keep_start, keep_end) tuples: the window covers
+    residues start to end and its predictions are kept for residues
+    keep_start to keep_end. Windows are window_length long (the last one
+    ends at the C-terminus) and consecutive windows share at least overlap
+    residues, split half and half, so that every kept prediction has at
+    least overlap / 2 residues of context on both sides, except at the
+    termini.
+    """
+    if length <= window_length:
+        return [(0, length, 0, length)]
+    if not 0 <= overlap < window_length:
+        raise ValueError("Window overlap must be less than the window length")
+    step = window_length - overlap
+    starts = list(range(0, length - window_length, step)) + [length - window_length]
+    windows = []
+    for (k, start) in enumerate(starts):
+        keep_start = 0 if k == 0 else (start + starts[k - 1] + window_length) // 2
+        keep_end = length if k == len(starts) - 1 else (starts[k + 1] + start + window_length) // 2
+        windows.append((start, start + window_length, keep_start, keep_end))
+    return windows
+
+def pad_batch(proteins, buffer=None):
+    """Stack (L, F) encoded proteins into a zero-padded (N, Lmax, F) float32
+    batch.
+
+    Padding rows are all zeros, which the model masking layer skips. If
+    buffer, a 1-D float32 array, is large enough the batch is a contiguous
+    view on it, filled in place.
+    """
+    max_len = max([p.shape[0] for p in proteins])
+    shape = (len(proteins), max_len, proteins[0].shape[-1])
+    size = shape[0] * shape[1] * shape[2]
+    if buffer is not None and buffer.size >= size:
+        batch = buffer[:size].reshape(shape)
+    else:
+        batch = numpy.empty(shape, dtype=numpy.float32)
+    for (i, p) in enumerate(proteins):
+        batch[i, :p.shape[0]] = p
+        batch[i, p.shape[0]:] = 0.0
+    return batch
+
+class Predictor():
+    """Holds a DeepREx Keras model, loaded and warmed up once per process.
+
+    The same instance can be shared between worker threads: loading is
+    guarded by a lock and forward passes are serialized. Batches are padded
+    into a float32 input buffer reused by all forward passes, grown to the
+    largest batch seen (batch size x padded length x features).
+    """
+    def __init__(self, model_file, use_export=cfg.USE_MODEL_EXPORT):
+        self.model_file = model_file
+        self.use_export = use_export
+        self.model_format = None
+        self.model = None
+        self.load_time = 0.0
+        self.warmup_time = 0.0
+        self.inference_time = 0.0
+        self.n_batches = 0
+        self.n_proteins = 0
+        self._load_lock = threading.Lock()
+        self._predict_lock = threading.Lock()
+        self._input_buffer = numpy.empty(0, dtype=numpy.float32)
+
+    def load(self):
+        if self.model is None:
+            with self._load_lock:
+                if self.model is None:
+                    self._load()
+        return self.model
+
+    @instrument.stage("model_load")
+    def _load(self):
+        start = time.perf_counter()
+        export_dir = usable_export(self.model_file) if self.use_export else None
+        if export_dir is not None:
+            model = ExportedModel(export_dir)
+            self.model_format = "SavedModel"
+        else:
+            from keras.models import load_model
+            model = load_model(self.model_file)
+            self.model_format = "HDF5"
+        self.load_time = time.perf_counter() - start
+        start = time.perf_counter()
+        n_features = model.input_shape[-1]
+        model.predict_on_batch(numpy.ones((1, 8, n_features), dtype=numpy.float32))
+        self.warmup_time = time.perf_counter() - start
+        self.model = model
+
+    def predict_batch(self, proteins, batch_size=cfg.PREDICT_BATCH_SIZE,
+                      max_padded_length=cfg.PREDICT_MAX_PADDED_LENGTH,
+                      window_length=None, window_overlap=cfg.PREDICT_WINDOW_OVERLAP):
+        """Predict many encoded proteins with length-bucketed batches.
+
+        proteins is a list of arrays as returned by encode_protein or
+        encode_protein_single_seq. Returns one list of per-residue
+        predictions per protein, in input order. With window_length, longer
+        proteins are predicted in overlapping windows (see make_windows)
+        batched with the other proteins and stitched back together.
+        """
+        model = self.load()
+        proteins = [numpy.asarray(p).reshape(-1, p.shape[-1]) for p in proteins]
+        # (protein, window start, kept start, kept end) of each piece predicted
+        pieces = []
+        inputs = []
+        for (i, p) in enumerate(proteins):
+            if window_length is None:
+                windows = [(0, p.shape[0], 0, p.shape[0])]
+            else:
+                windows = make_windows(p.shape[0], window_length, window_overlap)
+            for (start, end, keep_start, keep_end) in windows:
+                pieces.append((i, start, keep_start, keep_end))
+                inputs.append(p[start:end])
+        lengths = [p.shape[0] for p in inputs]
+        outputs = [None] * len(inputs)
+        for bucket in make_buckets(lengths, batch_size, max_padded_length):
+            with self._predict_lock:
+                batch = self._pad([inputs[j] for j in bucket])
+                with instrument.timed("inference", sum([lengths[j] for j in bucket])):
+                    start = time.perf_counter()
+                    ys = model.predict_on_batch(batch)
+                    self.inference_time += time.perf_counter() - start
+                self.n_batches += 1
+                self.n_proteins += len(bucket)
+            ys = numpy.asarray(ys)
+            for (k, j) in enumerate(bucket):
+                outputs[j] = ys[k, :lengths[j]]
+        predictions = [[] for p in proteins]
+        for ((i, start, keep_start, keep_end), ys) in zip(pieces, outputs):
+            predictions[i] += ys[keep_start - start:keep_end - start].tolist()
+        return predictions
+
+    def _pad(self, proteins):
+        """pad_batch into the input buffer; call with the predict lock held."""
+        size = len(proteins) * max([p.shape[0] for p in proteins]) * proteins[0].shape[-1]
+        if self._input_buffer.size < size:
+            self._input_buffer = numpy.empty(size, dtype=numpy.float32)
+        return pad_batch(proteins, self._input_buffer)
+
+    def summary(self):
+        return ("Model load %.2fs (%s), warm-up %.2fs, inference %.2fs "
+                "(%d proteins, %d batches)" % (self.load_time, self.model_format, self.warmup_time,
+                                               self.inference_time, self.n_proteins,
+                                               self.n_batches))
+
+EXPORT_INFO = "deeprex_export.json"
+
+def export_path(model_file):
+    """Directory of the SavedModel export of a model file, next to it."""
+    return os.path.splitext(model_file)[0] + ".savedmodel"
+
+def read_export_info(export_dir):
+    """Contents of the EXPORT_INFO file of an export, None if missing."""
+    try:
+        with open(os.path.join(export_dir, EXPORT_INFO)) as iif:
+            return json.load(iif)
+    except (OSError, ValueError):
+        return None
+
+def usable_export(model_file):
+    """The export directory of model_file if it was made from this very
+    file (same SHA-256), else None."""
+    export_dir = export_path(model_file)
+    info = read_export_info(export_dir)
+    if info is None or info.get('source_sha256') != model_checksum(model_file):
+        return None
+    return export_dir
+
+def model_tag(model_file, use_export=cfg.USE_MODEL_EXPORT):
+    """Short identifier of the model predictions come from: the checksum
+    of the model file, marked when its export is used (the two agree only
+    to within float32 rounding)."""
+    tag = model_checksum(model_file)[:16]
+    if use_export and usable_export(model_file) is not None:
+        tag += ".sm"
+    return tag
+
+def export_model(model_file, export_dir=None):
+    """Convert a Keras model file into a TensorFlow SavedModel.
+
+    The export holds the model weights and a single traced function taking
+    float32 (N, L, F) batches, so that loading restores neither the Keras
+    layers nor the HDF5 file and no function is retraced for new batch
+    shapes. The checksum of model_file is recorded in EXPORT_INFO. The
+    export is written next to a temporary name and then renamed, replacing
+    an older export. Returns the export directory.
+    """
+    import tensorflow as tf
+    from keras.models import load_model
+    if export_dir is None:
+        export_dir = export_path(model_file)
+    model = load_model(model_file)
+    n_features = model.input_shape[-1]
+    module = tf.Module()
+    module.weights = list(model.weights)
+    @tf.function(input_signature=[tf.TensorSpec([None, None, n_features], tf.float32)])
+    def predict(x):
+        return model(x, training=False)
+    module.predict = predict
+    tmp_dir = "%s.%d.tmp" % (export_dir, os.getpid())
+    tf.saved_model.save(module, tmp_dir)
+    with open(os.path.join(tmp_dir, EXPORT_INFO), 'w') as of:
+        json.dump({'source': os.path.basename(model_file),
+                   'source_sha256': model_checksum(model_file),
+                   'n_features': n_features, 'tensorflow': tf.__version__}, of, indent=2)
+    if os.path.isdir(export_dir):
+        shutil.rmtree(export_dir)
+    os.rename(tmp_dir, export_dir)
+    return export_dir
+
+class ExportedModel():
+    """A model exported by export_model, with the part of the Keras model
+    interface Predictor uses."""
+    def __init__(self, export_dir):
+        import tensorflow as tf
+        # the function only holds weak references to the restored weights
+        self.module = tf.saved_model.load(export_dir)
+        self.input_shape = (None, None, read_export_info(export_dir)['n_features'])
+
+    def predict_on_batch(self, batch):
+        return self.module.predict(batch).numpy()
+
+_predictors = {}
+_predictors_lock = threading.Lock()
+_checksums = {}
+
+def model_checksum(model_file):
+    """SHA-256 of the model file, computed once per process."""
+    with _predictors_lock:
+        if model_file not in _checksums:
+            digest = hashlib.sha256()
+            with open(model_file, 'rb') as iif:
+                for block in iter(lambda: iif.read(1 << 20), b''):
+                    digest.update(block)
+            _checksums[model_file] = digest.hexdigest()
+        return _checksums[model_file]
+
+def get_predictor(model_file):
+    with _predictors_lock:
+        if model_file not in _predictors:
+            _predictors[model_file] = Predictor(model_file)
+        return _predictors[model_file]
@@ -0,0 +1,323 @@
+import io
+import os
+import json
+import time
+import hashlib
+import queue
+import threading
+import socketserver
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy
+from Bio import SeqIO
+
+from . import deeprexconfig as cfg
+from . import utils
+from . import alignment
+from . import hhm
+from . import output
+from . import predictor as dpred
+
+class Job():
+    """One encoded protein waiting for a forward pass."""
+    def __init__(self, protein):
+        self.protein = protein
+        self.prediction = None
+        self.error = None
+        self.done = threading.Event()
+
+class MicroBatcher():
+    """Collects proteins submitted by concurrent requests and predicts them
+    together.
+
+    A single worker thread takes the first waiting job, waits at most
+    max_delay seconds for more jobs (up to batch_size proteins) and runs
+    them through Predictor.predict_batch in one go.
+    """
+    def __init__(self, model_file, batch_size=cfg.PREDICT_BATCH_SIZE,
+                 max_padded_length=cfg.PREDICT_MAX_PADDED_LENGTH,
+                 max_delay=cfg.SERVE_BATCH_DELAY):
+        self.predictor = dpred.get_predictor(model_file)
+        self.batch_size = max(1, batch_size)
+        self.max_padded_length = max_padded_length
+        self.max_delay = max_delay
+        self.jobs = queue.Queue()
+        self.n_batches = 0
+        self.n_proteins = 0
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+
+    def start(self):
+        self.predictor.load()
+        self._worker.start()
+
+    def depth(self):
+        return self.jobs.qsize()
+
+    def submit(self, proteins):
+        """Predict a list of encoded proteins, blocking until done."""
+        jobs = [Job(protein) for protein in proteins]
+        for job in jobs:
+            self.jobs.put(job)
+        for job in jobs:
+            job.done.wait()
+            if job.error is not None:
+                raise job.error
+        return [job.prediction for job in jobs]
+
+    def _run(self):
+        while True:
+            batch = [self.jobs.get()]
+            deadline = time.perf_counter() + self.max_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.jobs.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                predictions = self.predictor.predict_batch([job.protein for job in batch],
+                                                           self.batch_size, self.max_padded_length)
+                for (job, prediction) in zip(batch, predictions):
+                    job.prediction = prediction
+            except Exception as exc:
+                for job in batch:
+                    job.error = exc
+            self.n_batches += 1
+            self.n_proteins += len(batch)
+            for job in batch:
+                job.done.set()
+
+class LatencyTracker():
+    """Latencies of the last window requests of each kind."""
+    def __init__(self, window=cfg.SERVE_LATENCY_WINDOW):
+        self.window = window
+        self.latencies = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, kind, seconds):
+        with self._lock:
+            if kind not in self.latencies:
+                self.latencies[kind] = collections.deque(maxlen=self.window)
+                self.counts[kind] = 0
+            self.latencies[kind].append(seconds)
+            self.counts[kind] += 1
+
+    def report(self):
+        ret = {}
+        with self._lock:
+            for (kind, latencies) in self.latencies.items():
+                values = numpy.array(latencies) * 1000.0
+                ret[kind] = {'requests': self.counts[kind],
+                             'p50_ms': round(float(numpy.percentile(values, 50)), 2),
+                             'p90_ms': round(float(numpy.percentile(values, 90)), 2),
+                             'p99_ms': round(float(numpy.percentile(values, 99)), 2),
+                             'max_ms': round(float(values.max()), 2)}
+        return ret
+
+class ResultCache():
+    """In-memory LRU of per-protein results."""
+    def __init__(self, size=cfg.SERVE_RESULT_CACHE_SIZE):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            result = self.items.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.items.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self.items[key] = result
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+class BadRequest(Exception):
+    pass
+
+class DeepRExService():
+    """Prediction service behind the HTTP handler.
+
+    Requests are JSON objects. singleseq: {"fasta": multi-FASTA text,
+    "hp_window": 5}. aln: {"fasta": single-sequence FASTA text, "a3m": A3M
+    text, "hhm": HHM text, "gap_th": 0.7, "hp_window": 5}. Both return the
+    TSV rows written by write_tsv_output for the whole request.
+    """
+    def __init__(self, model_file, we, batch_size=cfg.PREDICT_BATCH_SIZE,
+                 max_padded_length=cfg.PREDICT_MAX_PADDED_LENGTH,
+                 max_delay=cfg.SERVE_BATCH_DELAY):
+        self.we = we
+        self.batcher = MicroBatcher(model_file, batch_size, max_padded_length, max_delay)
+        self.results = ResultCache()
+        self.latency = LatencyTracker()
+        self.started = time.time()
+
+    def start(self):
+        self.batcher.start()
+
+    def _param(self, request, name, type, default):
+        try:
+            return type(request.get(name, default))
+        except (TypeError, ValueError):
+            raise BadRequest("invalid '%s'" % name)
+
+    def _records(self, request):
+        if not isinstance(request.get('fasta'), str):
+            raise BadRequest("missing 'fasta'")
+        records = list(SeqIO.parse(io.StringIO(request['fasta']), 'fasta'))
+        if len(records) == 0:
+            raise BadRequest("no sequences in 'fasta'")
+        return records
+
+    def singleseq(self, request):
+        hpwin = self._param(request, 'hp_window', int, 5)
+        records = self._records(request)
+        results = [None] * len(records)
+        todo = []
+        for (i, record) in enumerate(records):
+            results[i] = self.results.get(('singleseq', hpwin, str(record.seq)))
+            if results[i] is None:
+                todo.append(i)
+        sequences = [str(records[i].seq) for i in todo]
+        proteins = utils.encode_proteins_single_seq(sequences)
+        hydrophobicities = utils.score_hp_batch(sequences, hpwin)
+        predictions = self.batcher.submit(proteins)
+        for (i, sequence, prediction, hydrophobicity) in zip(todo, sequences, predictions, hydrophobicities):
+            results[i] = (prediction, hydrophobicity, [0.0]*len(sequence))
+            self.results.put(('singleseq', hpwin, sequence), results[i])
+        return self._tsv(records, results)
+
+    def aln(self, request):
+        hpwin = self._param(request, 'hp_window', int, 5)
+        gapth = self._param(request, 'gap_th', float, 0.7)
+        records = self._records(request)
+        if len(records) != 1:
+            raise BadRequest("aln requests take a single sequence")
+        for key in ('a3m', 'hhm'):
+            if not isinstance(request.get(key), str):
+                raise BadRequest("missing '%s'" % key)
+        record = records[0]
+        sequence = str(record.seq)
+        digest = hashlib.sha1()
+        for key in ('a3m', 'hhm'):
+            digest.update(request[key].encode("utf-8"))
+        key = ('aln', hpwin, gapth, sequence, digest.hexdigest())
+        result = self.results.get(key)
+        if result is None:
+            try:
+                msa = alignment.read_a3m(request['a3m'].encode("utf-8"))
+                hhm_profile = hhm.parse_hhm(request['hhm'].encode("utf-8"))
+                msa_conservation = utils.score_conservation(msa, gap_cutoff=gapth)
+                sequence_profile = utils.build_sequence_profile(record.id.replace("|","_"), msa, self.we)
+                protein = utils.encode_protein(sequence, sequence_profile, hhm_profile)
+            except ValueError as exc:
+                raise BadRequest(str(exc))
+            prediction = self.batcher.submit([protein])[0]
+            result = (prediction, utils.score_hp(sequence, hpwin), msa_conservation)
+            self.results.put(key, result)
+        return self._tsv(records, [result])
+
+    def _tsv(self, records, results):
+        return "".join([output.format_tsv(record.id, str(record.seq), prediction,
+                                          hydrophobicity, conservation)
+                        for (record, (prediction, hydrophobicity, conservation)) in zip(records, results)])
+
+    def stats(self):
+        return {'uptime_s': round(time.time() - self.started, 1),
+                'queue_depth': self.batcher.depth(),
+                'batches': self.batcher.n_batches,
+                'proteins': self.batcher.n_proteins,
+                'result_cache': {'entries': len(self.results.items),
+                                 'hits': self.results.hits,
+                                 'misses': self.results.misses},
+                'latency': self.latency.report(),
+                'model': self.batcher.predictor.summary()}
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """POST /singleseq and /aln (JSON in, TSV out); GET /stats (JSON) and
+    /health."""
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            utils.print_date("%s %s" % (self.address_string(), format % args))
+
+    def _send(self, code, body, content_type):
+        body = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/stats":
+            self._send(200, json.dumps(service.stats(), indent=2) + "\n", "application/json")
+        elif self.path == "/health":
+            self._send(200, "OK\n", "text/plain")
+        else:
+            self._send(404, "Unknown path %s\n" % self.path, "text/plain")
+
+    def do_POST(self):
+        service = self.server.service
+        start = time.perf_counter()
+        kind = self.path.strip("/")
+        if kind not in ("singleseq", "aln"):
+            self._send(404, "Unknown path %s\n" % self.path, "text/plain")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length > cfg.SERVE_MAX_REQUEST_SIZE:
+                raise BadRequest("request larger than %d bytes" % cfg.SERVE_MAX_REQUEST_SIZE)
+            try:
+                request = json.loads(self.rfile.read(length))
+            except ValueError:
+                raise BadRequest("the request body is not valid JSON")
+            if not isinstance(request, dict):
+                raise BadRequest("the request body must be a JSON object")
+            tsv = getattr(service, kind)(request)
+        except BadRequest as exc:
+            self._send(400, "%s\n" % exc, "text/plain")
+            return
+        except Exception as exc:
+            self._send(500, "%s: %s\n" % (type(exc).__name__, exc), "text/plain")
+            raise
+        service.latency.add(kind, time.perf_counter() - start)
+        self._send(200, tsv, "text/tab-separated-values")
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, host=cfg.SERVE_HOST, port=cfg.SERVE_PORT, unix_socket=None, quiet=False):
+    """HTTP server for service on host:port, or on unix_socket if given."""
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        server = UnixHTTPServer(unix_socket, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.service = service
+    server.quiet = quiet
+    return server
@@ -1,138 +1,391 @@
 import numpy
-from keras.models import load_model
-from keras import backend as K
+import hashlib
 from time import localtime, strftime
 
 from . import deeprexconfig as cfg
+from . import predictor as dpred
+from . import conservation
+from . import hhm as hhmparser
+from . import output
+from . import instrument
 
 def print_date(msg):
     print ("[%s] %s" % (strftime("%a, %d %b %Y %H:%M:%S", localtime()), msg))
 
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def parse_size(size):
+    """Parse a size in bytes with an optional K, M, G or T suffix."""
+    size = size.strip().upper().rstrip('B')
+    unit = size[-1:] if size[-1:] in SIZE_UNITS else ''
+    try:
+        return int(float(size[:len(size) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError("Invalid size '%s' (e.g. 500M, 20G)" % size)
+
+def format_size(size):
+    for unit in ['T', 'G', 'M', 'K']:
+        if size >= SIZE_UNITS[unit]:
+            return "%.1f%s" % (size / SIZE_UNITS[unit], unit)
+    return "%dB" % size
+
 def get_data_cache():
+    """Return the DataCache in DEEPREX_DATA_CACHE_DIR, or None if unset.
+
+    DEEPREX_DATA_CACHE_BACKEND selects the backend (files or packed);
+    DEEPREX_DATA_CACHE_MAX_SIZE (e.g. 50G) and DEEPREX_DATA_CACHE_MAX_AGE
+    (days) bound the cache, enforced when a run closes it.
+    """
     import os
     from . import datacache
     ret = None
     if 'DEEPREX_DATA_CACHE_DIR' in os.environ:
-        ret = datacache.DataCache(os.environ['DEEPREX_DATA_CACHE_DIR'])
+        backend = os.environ.get('DEEPREX_DATA_CACHE_BACKEND', 'files')
+        max_size = None
+        if os.environ.get('DEEPREX_DATA_CACHE_MAX_SIZE', '') != '':
+            max_size = parse_size(os.environ['DEEPREX_DATA_CACHE_MAX_SIZE'])
+        max_age = None
+        if os.environ.get('DEEPREX_DATA_CACHE_MAX_AGE', '') != '':
+            max_age = float(os.environ['DEEPREX_DATA_CACHE_MAX_AGE']) * 86400
+        if backend == 'packed':
+            from . import packcache
+            ret = packcache.PackedDataCache(os.environ['DEEPREX_DATA_CACHE_DIR'],
+                                            max_size=max_size, max_age=max_age)
+        elif backend == 'files':
+            ret = datacache.DataCache(os.environ['DEEPREX_DATA_CACHE_DIR'],
+                                      max_size=max_size, max_age=max_age)
+        else:
+            raise ValueError("Unknown DEEPREX_DATA_CACHE_BACKEND '%s' (valid: files, packed)" % backend)
     return ret
 
-def build_sequence_profile(acc, aln_file, we):
-    aa_order = '-ARNDCQEGHILKMFPSTWYV'
-    sequence_profile_file = we.createFile(acc+".profile.", ".prof")
-    matrix = []
-    #Parse aln file
-    with open(aln_file) as iif:
-        seq_all = [line.rstrip() for line in iif.readlines() if len(line)>1]
-        l = len(seq_all[0])
-        iif.close()
-
-    #For each column:
-    for i in range(l):
-        counts = numpy.zeros(len(aa_order))
-        for seq in seq_all:
-            try:
-                counts[aa_order.index(seq[i])] += 1.0
-            except:
-                pass
-        n = numpy.sum(counts)
-        if numpy.sum(counts[1:]) != 0:
-            counts[1:] /= numpy.sum(counts[1:])
-        if n != 0:
-            counts[0] /= n
-        matrix.append(counts)
-    matrix = numpy.array(matrix)
-    numpy.savetxt(sequence_profile_file, matrix, fmt="%.2f")
-    return sequence_profile_file
+def close_data_cache(data_cache):
+    if data_cache is not None:
+        data_cache.close()
+
+PROFILE_ORDER = '-ARNDCQEGHILKMFPSTWYV'
+PROFILE_SKIP_CODE = len(PROFILE_ORDER)
+profile_code_table = numpy.full(256, PROFILE_SKIP_CODE, dtype=numpy.uint8)
+for (i, aa) in enumerate(PROFILE_ORDER):
+    profile_code_table[ord(aa)] = i
+
+def round2(matrix):
+    """Round to two decimals exactly as writing with %.2f and reading back.
+
+    numpy.round may disagree with %.2f on values whose scaled fractional
+    part is within rounding error of one half; those few entries are
+    formatted explicitly.
+    """
+    rounded = numpy.round(matrix, 2)
+    scaled = matrix * 100.0
+    ties = numpy.abs(scaled - numpy.floor(scaled) - 0.5) < 1e-6
+    for idx in zip(*numpy.nonzero(ties)):
+        rounded[idx] = float("%.2f" % matrix[idx])
+    return rounded
+
+def feature_cache_ext(gap_cutoff, hp_window, max_msa_rows=None, msa_selection="first"):
+    ext = "features.%s.g%s.w%d" % (cfg.FEATURE_VERSION, gap_cutoff, hp_window)
+    if max_msa_rows is not None:
+        ext += ".r%d" % max_msa_rows
+        if msa_selection != "first":
+            ext += ".%s" % msa_selection
+    return ext + ".npz"
+
+def window_tag(window_length, window_overlap):
+    """Part of prediction cache keys for windowed prediction."""
+    if window_length is None:
+        return ""
+    return ".W%d.o%d" % (window_length, window_overlap)
+
+def load_cached_features(cache_entry, ext):
+    cached = cache_entry.open_binary(ext)
+    if cached is None:
+        return None
+    with cached, numpy.load(cached) as data:
+        return (data['protein'], data['hydrophobicity'].tolist(),
+                data['conservation'].tolist())
+
+def store_cached_features(cache_entry, ext, we, protein, hydrophobicity,
+                          conservation):
+    # the model runs in float32, so storing features as float32 does not
+    # change predictions
+    npz_file = we.createFile("features.", ".npz")
+    with open(npz_file, 'wb') as of:
+        numpy.savez(of, protein=numpy.asarray(protein, dtype=numpy.float32),
+                    hydrophobicity=numpy.asarray(hydrophobicity),
+                    conservation=numpy.asarray(conservation))
+    cache_entry.store(npz_file, ext)
+
+def prediction_cache_ext(model_file, features_tag):
+    """Cache entry name for final predictions: changing the model file or
+    the feature parameters (features_tag) gives a different entry."""
+    return "predictions.%s.%s.npz" % (dpred.model_tag(model_file), features_tag)
+
+def load_cached_predictions(cache_entry, ext):
+    cached = cache_entry.open_binary(ext)
+    if cached is None:
+        return None
+    with cached, numpy.load(cached) as data:
+        return (data['predictions'].tolist(), data['hydrophobicity'].tolist(),
+                data['conservation'].tolist())
+
+def store_cached_predictions(cache_entry, ext, we, predictions, hydrophobicity,
+                             conservation):
+    npz_file = we.createFile("predictions.", ".npz")
+    with open(npz_file, 'wb') as of:
+        numpy.savez(of, predictions=numpy.asarray(predictions, dtype=numpy.float32),
+                    hydrophobicity=numpy.asarray(hydrophobicity),
+                    conservation=numpy.asarray(conservation))
+    cache_entry.store(npz_file, ext)
+
+class SequenceDeduplicator():
+    """Compute results once per distinct sequence of a stream of records.
+
+    unique() filters an input stream of records down to the first
+    occurrence of each sequence; fan_out() walks all records again, in input
+    order, yielding each one with the result computed for its sequence and
+    whether the record is the first occurrence of that sequence. Only
+    results of sequences that still have pending duplicates are kept in
+    memory.
+    """
+    def __init__(self, records):
+        counts = {}
+        for record in records:
+            digest = self._digest(record)
+            counts[digest] = counts.get(digest, 0) + 1
+        self.remaining = dict([(d, c) for (d, c) in counts.items() if c > 1])
+        self.submitted = set()
+        self.results = {}
+
+    def _digest(self, record):
+        return hashlib.sha1(str(record.seq).encode("utf-8")).digest()
+
+    def n_duplicates(self):
+        return sum(self.remaining.values()) - len(self.remaining)
+
+    def unique(self, records):
+        for record in records:
+            digest = self._digest(record)
+            if digest in self.remaining:
+                if digest in self.submitted:
+                    continue
+                self.submitted.add(digest)
+            yield record
+
+    def fan_out(self, records, results):
+        for record in records:
+            digest = self._digest(record)
+            first = digest not in self.results
+            if first:
+                result = next(results)
+            else:
+                result = self.results[digest]
+            if digest in self.remaining:
+                self.remaining[digest] -= 1
+                if self.remaining[digest] == 0:
+                    self.results.pop(digest, None)
+                    del self.remaining[digest]
+                else:
+                    self.results[digest] = result
+            yield record, result, first
 
+def parse_shard(shard):
+    """Parse a shard specification "i/N" (1 <= i <= N) into (i, N)."""
+    try:
+        (i, n) = [int(x) for x in shard.split("/")]
+    except ValueError:
+        raise ValueError("Invalid shard %r, expected i/N" % shard)
+    if n < 1 or i < 1 or i > n:
+        raise ValueError("Invalid shard %r, expected i/N with 1 <= i <= N" % shard)
+    return i, n
+
+def shard_records(records, shard=None):
+    """Yield (index, record) for the records of a stream, indexed from 0;
+    with shard = (i, N) only every N-th record, starting from the i-th."""
+    for (index, record) in enumerate(records):
+        if shard is None or index % shard[1] == shard[0] - 1:
+            yield index, record
+
+def print_cache_summary(data_cache):
+    if data_cache is not None:
+        for (ext, hits, misses) in data_cache.stats():
+            print_date("Data cache %s: %d hits, %d misses" % (ext, hits, misses))
+
+@instrument.stage("profile", lambda acc, msa, *args, **kwargs: msa.shape[1])
+def build_sequence_profile(acc, msa, we, debug=cfg.DEBUG):
+    """Build the sequence profile of an alignment given as a (sequences x
+    columns) uint8 matrix of ASCII symbols, e.g. from alignment.read_a3m.
+
+    Symbols other than gaps and the 20 standard residues are not counted.
+    Columns are counted in blocks of conservation.BLOCK_CELLS cells.
+    """
+    l = msa.shape[1]
+    counts = numpy.empty((l, PROFILE_SKIP_CODE))
+    block = max(1, conservation.BLOCK_CELLS // max(1, msa.shape[0]))
+    for s in range(0, l, block):
+        e = min(l, s + block)
+        codes = profile_code_table[msa[:, s:e]].astype(numpy.intp) + (PROFILE_SKIP_CODE + 1) * numpy.arange(e - s)
+        block_counts = numpy.bincount(codes.ravel(), minlength=(PROFILE_SKIP_CODE + 1) * (e - s))
+        counts[s:e] = block_counts.reshape(e - s, PROFILE_SKIP_CODE + 1)[:, :PROFILE_SKIP_CODE]
+    n = counts.sum(axis=1)
+    n_aa = counts[:, 1:].sum(axis=1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        counts[:, 1:] = numpy.where(n_aa[:, None] != 0, counts[:, 1:] / n_aa[:, None], counts[:, 1:])
+        counts[:, 0] = numpy.where(n != 0, counts[:, 0] / n, counts[:, 0])
+    matrix = round2(counts)
+    if debug:
+        sequence_profile_file = we.createFile(acc+".profile.", ".prof")
+        numpy.savetxt(sequence_profile_file, matrix, fmt="%.2f")
+    return matrix
+
+@instrument.stage("conservation", lambda msa, *args, **kwargs: msa.shape[1])
+def score_conservation(msa, gap_cutoff=0.7):
+    if msa.shape[0] > 1:
+        return conservation.score_msa(msa, gap_cutoff=gap_cutoff)
+    return [0] * msa.shape[1]
+
+
+SINGLE_SEQ_ORDER = 'ARNDCQEGHILKMFPSTWYV'
+# one row of single-sequence features per byte value: the one-hot block
+# repeated as in the original encoding, rows of unknown residues are zero
+single_seq_table = numpy.zeros((256, 71), dtype=numpy.float32)
+for (i, aa) in enumerate(SINGLE_SEQ_ORDER):
+    for offset in (0, 21, 41):
+        single_seq_table[ord(aa), offset + (i - 1) % 20] = 1.0
+
+def residue_codes(sequence):
+    """Byte codes of a sequence, one per residue (? for non-ASCII)."""
+    return numpy.frombuffer(sequence.encode("ascii", "replace"), dtype=numpy.uint8)
+
+@instrument.stage("encode", lambda sequences: sum([len(s) for s in sequences]))
+def encode_single_seq_features(sequences):
+    """Single-sequence features of a batch of sequences, stacked in one
+    (total length, 71) float32 matrix, with one table lookup."""
+    return single_seq_table[residue_codes("".join(sequences))]
+
+def encode_proteins_single_seq(sequences):
+    """Encode a batch of sequences; returns a list of (1, L, 71) arrays,
+    views on a single feature matrix."""
+    encoded = encode_single_seq_features(sequences)
+    proteins = []
+    start = 0
+    for sequence in sequences:
+        proteins.append(encoded[None, start:start + len(sequence)])
+        start += len(sequence)
+    return proteins
 
 def encode_protein_single_seq(sequence):
-    aa_order = 'ARNDCQEGHILKMFPSTWYV'
-    prot = []
-    for (i, residue) in enumerate(sequence):
-        one_hot = [0.0] * 20
-        try:
-            one_hot[aa_order.index(residue)-1] = 1.0
-        except:
-            pass
-        vect = numpy.concatenate((numpy.array(one_hot),
-                                  numpy.array([0.0]+one_hot),
-                                  numpy.array(one_hot),
-                                  numpy.array([0.0]*10)))
-        prot.append(vect)
-    prot = numpy.array([prot])
-    return prot
+    return encode_proteins_single_seq([sequence])[0]
 
-def encode_protein(sequence, sequence_profile_file, hhblits_hhm_out):
-    aa_order = '-ARNDCQEGHILKMFPSTWYV'
-    profile = numpy.loadtxt(sequence_profile_file)
-    hhm_file  = open(hhblits_hhm_out)
-    hhm_line = hhm_file.readline()
-    while hhm_line[:4] != "HMM ":
-        hhm_line = hhm_file.readline()
-    hhm_file.readline()
-    hhm_file.readline()
-    prot = []
-    for (i, residue) in enumerate(sequence):
-        one_hot = [0.0] * 20
-        try:
-            one_hot[aa_order.index(residue)-1] = 1.0
-        except:
-            pass
-        one_hot = numpy.array(one_hot)
-
-        hhm_line = hhm_file.readline().strip()
-        hhm_line = hhm_line.split()
-
-        #Parse hhm profile
-        hhm_profile = []
-        for prob in hhm_line[2:-1]:
-            try:
-                hhm_profile.append(2**(float(prob)/-1000))
-            except ValueError:
-                hhm_profile.append(0.0)
-        hhm_profile = numpy.array(hhm_profile)
-        if hhm_profile.sum() == 0:
-            hhm_profile = one_hot
-        else:
-            hhm_profile /= hhm_profile.sum()
-
-        #Parse transitions and neff from hhm file
-        tra_neff = hhm_file.readline().strip().split('\t')
-        transitions = []
-        for tra in tra_neff[:7]:
-            try:
-                transitions.append(2**(float(tra)/-1000))
-            except ValueError:
-                transitions.append(0.0)
-        transitions = numpy.array(transitions)
-        neff = numpy.array(tra_neff[7:],float)/1000
-        hhm_file.readline()
-        vect = numpy.concatenate((one_hot, profile[i], hhm_profile, transitions, neff))
-        prot.append(vect)
-    prot = numpy.array([prot])
+# one-hot columns per byte value, as aa_order.index(residue) - 1 with
+# aa_order = '-ARNDCQEGHILKMFPSTWYV' (so gaps set the last column); rows of
+# unknown residues are zero
+one_hot_table = numpy.zeros((256, 20), dtype=numpy.float32)
+for (i, aa) in enumerate('-' + SINGLE_SEQ_ORDER):
+    one_hot_table[ord(aa), (i - 1) % 20] = 1.0
+
+# column offsets of the MSA-based features: one-hot encoding, sequence
+# profile, HHM emissions, transitions and Neff
+ENCODING_BLOCKS = (0, 20, 41, 61, 68, 71)
+
+@instrument.stage("encode", lambda sequence, *args, **kwargs: len(sequence))
+def encode_protein(sequence, profile, hhm):
+    """Encode a protein as a (1, L, 71) float32 array, filled in place.
+
+    HHM emissions are normalized in float64 and rounded to float32 once, as
+    the model input always was.
+    """
+    if isinstance(profile, str):
+        profile = numpy.loadtxt(profile)
+    if isinstance(hhm, str):
+        hhm = hhmparser.parse_hhm(hhm)
+    if len(hhm) != len(sequence):
+        raise ValueError("HHM profile has %d match states but the sequence has %d residues" %
+                         (len(hhm), len(sequence)))
+    n = len(sequence)
+    prot = numpy.empty((1, n, ENCODING_BLOCKS[-1]), dtype=numpy.float32)
+    blocks = [prot[0, :, s:e] for (s, e) in zip(ENCODING_BLOCKS[:-1], ENCODING_BLOCKS[1:])]
+    codes = residue_codes(sequence)
+    numpy.take(one_hot_table, codes, axis=0, out=blocks[0])
+    blocks[1][:] = profile[:n]
+    totals = hhm.emissions.sum(axis=1)
+    empty = totals == 0
+    numpy.divide(hhm.emissions, numpy.where(empty, 1.0, totals)[:, None], out=blocks[2])
+    blocks[2][empty] = blocks[0][empty]
+    blocks[3][:] = hhm.transitions
+    blocks[4][:] = hhm.neff
     return prot
 
-def predict(protein, model_file):
-    model = load_model(model_file)
-    xs = K.constant(protein)
-    predictions = model.predict_on_batch(xs).tolist()[0]
-    return predictions
+def predict_batch(proteins, model_file, batch_size=cfg.PREDICT_BATCH_SIZE,
+                  max_padded_length=cfg.PREDICT_MAX_PADDED_LENGTH,
+                  window_length=None, window_overlap=cfg.PREDICT_WINDOW_OVERLAP):
+    return dpred.get_predictor(model_file).predict_batch(proteins, batch_size,
+                                                         max_padded_length,
+                                                         window_length, window_overlap)
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def print_model_summary(model_file):
+    print_date(dpred.get_predictor(model_file).summary())
+
+kd_table = numpy.zeros(256)
+kd_known = numpy.zeros(256, dtype=bool)
+for (aa, value) in cfg.KD.items():
+    kd_table[ord(aa)] = value
+    kd_known[ord(aa)] = True
+
+@instrument.stage("hydrophobicity", lambda sequences, *args, **kwargs: sum([len(s) for s in sequences]))
+def score_hp_batch(sequences, window):
+    """Kyte-Doolittle profiles of a batch of sequences, averaged over a
+    sliding window; returns one list of values per sequence.
+
+    Gives the same numbers as Biopython ProteinAnalysis.protein_scale on
+    the sequence padded with window/2 X on both sides: window sums add
+    the residue pairs from the outside in and then the central residue,
+    in the same order, skipping pairs with residues missing from cfg.KD.
+    """
+    if window <= 1:
+        values = kd_table[residue_codes("".join(sequences))]
+        ret = []
+        start = 0
+        for sequence in sequences:
+            ret.append(values[start:start + len(sequence)].tolist())
+            start += len(sequence)
+        return ret
+    half = int(window/2)
+    padded = [("X" * half + sequence + "X" * half).upper() for sequence in sequences]
+    codes = residue_codes("".join(padded))
+    values = kd_table[codes]
+    known = kd_known[codes]
+    n = max(0, len(codes) - window + 1)
+    score = numpy.zeros(n)
+    for j in range(window // 2):
+        back = window - j - 1
+        pair = values[j:j + n] + values[back:back + n]
+        score += numpy.where(known[j:j + n] & known[back:back + n], pair, 0.0)
+    middle = window // 2
+    score += numpy.where(known[middle:middle + n], values[middle:middle + n], 0.0)
+    score /= sum([1.0] * (window // 2)) * 2 + 1
+    # windows overlapping two sequences are dropped
+    ret = []
+    start = 0
+    for sequence in padded:
+        ret.append(score[start:start + max(0, len(sequence) - window + 1)].tolist())
+        start += len(sequence)
+    return ret
 
 def score_hp(sequence, window):
-    from Bio.SeqUtils import ProtParam, ProtParamData
-    if window > 1:
-        pad_seq = "X" * int(window/2) + sequence + "X" * int(window/2)
-        hydro = ProtParam.ProteinAnalysis(pad_seq).protein_scale(cfg.KD, window)
-    else:
-        hydro = [cfg.KD.get(aa, 0.0) for aa in sequence]
-    return hydro
+    return score_hp_batch([sequence], window)[0]
 
+@instrument.stage("output", lambda acc, sequence, *args, **kwargs: len(sequence))
 def write_tsv_output(acc, sequence, predictions,
                      hydrophobicity, conservation, out_file):
-    for i in range(len(predictions)):
-        label = "Buried"
-        if predictions[i][0] > 0.5:
-            label = "Exposed"
-        reliability = round(2.0 * numpy.absolute(predictions[i][0] - 0.5), 2)
-        print(acc, i+1, sequence[i], label, reliability,
-              round(hydrophobicity[i], 3), round(conservation[i], 5), sep="\t", file=out_file)
+    out_file.write(output.format_tsv(acc, sequence, predictions,
+                                     hydrophobicity, conservation))